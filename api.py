@@ -1,16 +1,42 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 import os
+import asyncio
+import copy
+import errno
+import hashlib
+import inspect
+import io
+import functools
+from contextlib import asynccontextmanager, suppress
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import aiohttp
 from dotenv import load_dotenv
 import uuid
 import json
+import mimetypes
+import queue
 import zipfile
 import shutil
+import struct
+import tarfile
+import tempfile
+import threading
 import time
-from typing import Any, Dict, List, Optional
+import zlib
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
 import logging
 from pathlib import Path
+from urllib.parse import quote
+
+try:
+    import xxhash
+except ImportError:  # optional, only needed for CONTENT_HASH=xxh3_64
+    xxhash = None
 
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), ".env"))
 MD_URL = os.getenv("MD_URL", "http://localhost:8200")
@@ -20,6 +46,93 @@ STORAGE_MODE = (os.getenv("STORAGE_MODE") or os.getenv("FILE_STORAGE_MODE") or "
 DEFAULT_ALLOWED_EXTENSIONS = ('txt', 'jpg', 'jpeg', 'png', 'pdf', 'json')
 REQUEST_READ_CHUNK_SIZE = int(os.getenv("REQUEST_READ_CHUNK_SIZE", str(1024 * 1024)))
 COPY_CHUNK_SIZE = int(os.getenv("COPY_CHUNK_SIZE", str(1024 * 1024)))
+# Max number of unzip/zip jobs running at once; extra jobs wait in the pool queue.
+JOB_WORKERS = max(1, int(os.getenv("JOB_WORKERS", str(min(4, os.cpu_count() or 1)))))
+# Threads shared by all jobs for extracting entries of one archive in parallel.
+EXTRACT_WORKERS = max(1, int(os.getenv("EXTRACT_WORKERS", str(os.cpu_count() or 1))))
+# STORED entries are copied kernel-side; the CRC check is a separate read pass.
+VERIFY_STORED_CRC = os.getenv("VERIFY_STORED_CRC", "true").strip().lower() in ("1", "true", "yes", "on")
+# Set-zip compression: "stored" (default), "deflate" (compressed in a process pool)
+# or "auto" (chosen per entry, see choose_entry_compression).
+ZIP_COMPRESSION = os.getenv("ZIP_COMPRESSION", "stored").strip().lower()
+ZIP_COMPRESS_LEVEL = int(os.getenv("ZIP_COMPRESS_LEVEL", "6"))
+AUTO_COMPRESS_SAMPLE_BYTES = int(os.getenv("AUTO_COMPRESS_SAMPLE_BYTES", str(64 * 1024)))
+AUTO_COMPRESS_MAX_RATIO = float(os.getenv("AUTO_COMPRESS_MAX_RATIO", "0.9"))
+ZIP_COMPRESS_WORKERS = max(1, int(os.getenv("ZIP_COMPRESS_WORKERS", str(os.cpu_count() or 1))))
+# Set-zip source read-ahead: files read ahead of the archive writer (0 disables),
+# reader threads, memory held by read-ahead buffers, and the largest file that
+# is buffered (bigger files only get a kernel read-ahead hint).
+PREFETCH_FILES = max(0, int(os.getenv("PREFETCH_FILES", "8")))
+PREFETCH_WORKERS = max(1, int(os.getenv("PREFETCH_WORKERS", "4")))
+PREFETCH_MEMORY_BYTES = int(os.getenv("PREFETCH_MEMORY_BYTES", str(64 * 1024 ** 2)))
+PREFETCH_MAX_FILE_BYTES = int(os.getenv("PREFETCH_MAX_FILE_BYTES", str(8 * 1024 ** 2)))
+# Incremental set zips (opt-in): keep a manifest and a hardlinked copy of each
+# set's last archive under data/<db>/zipfs/manifests for this long. Retained
+# archives are not counted by TMP_QUOTA_BYTES.
+ZIP_MANIFEST_ENABLED = os.getenv("ZIP_MANIFEST_ENABLED", "false").strip().lower() in ("1", "true", "yes", "on")
+ZIP_MANIFEST_MAX_AGE_SEC = int(os.getenv("ZIP_MANIFEST_MAX_AGE_SEC", str(7 * 24 * 3600)))
+# Central-directory index cache: total entry records kept in memory and
+# number of per-archive index files kept on disk per db.
+INDEX_CACHE_MAX_ENTRIES = int(os.getenv("INDEX_CACHE_MAX_ENTRIES", "1000000"))
+INDEX_CACHE_DISK_MAX_FILES = int(os.getenv("INDEX_CACHE_DISK_MAX_FILES", "256"))
+# Content digest added to output descriptors: sha256 (default), blake2b,
+# xxh3_64 (needs the optional xxhash package) or none.
+CONTENT_HASH = os.getenv("CONTENT_HASH", "sha256").strip().lower()
+# Content-addressed store of extracted entries under data/<db>/zipfs/blobs;
+# repeat extractions become hardlinks. Needs a CONTENT_HASH other than none.
+DEDUP_STORE_ENABLED = os.getenv("DEDUP_STORE", "false").strip().lower() in ("1", "true", "yes", "on")
+DEDUP_STORE_MAX_BYTES = int(os.getenv("DEDUP_STORE_MAX_BYTES", str(10 * 1024 ** 3)))
+DEDUP_STORE_MAX_AGE_SEC = int(os.getenv("DEDUP_STORE_MAX_AGE_SEC", str(7 * 24 * 3600)))
+DEDUP_PRUNE_INTERVAL_SEC = int(os.getenv("DEDUP_PRUNE_INTERVAL_SEC", "300"))
+# Identical unzip/zip jobs share one execution; finished results are reused
+# for redelivered messages within this many seconds.
+SINGLE_FLIGHT_TTL_SEC = float(os.getenv("SINGLE_FLIGHT_TTL_SEC", "30"))
+SINGLE_FLIGHT_MAX_RESULTS = int(os.getenv("SINGLE_FLIGHT_MAX_RESULTS", "256"))
+# Async job API: max jobs kept in the registry and how long finished jobs stay.
+JOB_REGISTRY_MAX = int(os.getenv("JOB_REGISTRY_MAX", "1000"))
+JOB_RESULT_TTL_SEC = int(os.getenv("JOB_RESULT_TTL_SEC", "3600"))
+# Optional direct delivery of extracted files to MessyDesk while the job runs.
+MD_CALLBACK_ENABLED = os.getenv("MD_CALLBACK_ENABLED", "false").strip().lower() in ("1", "true", "yes", "on")
+MD_CALLBACK_PATH = os.getenv("MD_CALLBACK_PATH", "/api/nomad/process/files/tmp")
+MD_CALLBACK_WORKERS = max(1, int(os.getenv("MD_CALLBACK_WORKERS", "4")))
+MD_CALLBACK_CONNECT_TIMEOUT = float(os.getenv("MD_CALLBACK_CONNECT_TIMEOUT", "5"))
+MD_CALLBACK_READ_TIMEOUT = float(os.getenv("MD_CALLBACK_READ_TIMEOUT", "30"))
+MD_CALLBACK_RETRIES = max(0, int(os.getenv("MD_CALLBACK_RETRIES", "3")))
+MD_CALLBACK_RETRY_BACKOFF_SEC = float(os.getenv("MD_CALLBACK_RETRY_BACKOFF_SEC", "1"))
+MD_CALLBACK_BATCH_SIZE = max(1, int(os.getenv("MD_CALLBACK_BATCH_SIZE", "1")))
+# Buffered NDJSON records before extraction waits for a slow client.
+NDJSON_QUEUE_SIZE = max(1, int(os.getenv("NDJSON_QUEUE_SIZE", "1024")))
+# Admission control for work that writes to data/<db>/tmp: a job is admitted when
+# its uncompressed size fits in free space (minus the in-flight reservations and
+# ADMISSION_MIN_FREE_BYTES) and in the global in-flight budget (0 = no budget).
+# Otherwise it waits up to ADMISSION_QUEUE_TIMEOUT_SEC, then gets a 503.
+ADMISSION_MAX_INFLIGHT_BYTES = int(os.getenv("ADMISSION_MAX_INFLIGHT_BYTES", "0"))
+ADMISSION_MIN_FREE_BYTES = int(os.getenv("ADMISSION_MIN_FREE_BYTES", str(1024 ** 3)))
+ADMISSION_QUEUE_TIMEOUT_SEC = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SEC", "60"))
+ADMISSION_RETRY_AFTER_SEC = int(os.getenv("ADMISSION_RETRY_AFTER_SEC", "30"))
+# Background GC of files this service leaves in data/<db>/tmp: zipfs_* extractions
+# and set zips are removed after TMP_MAX_AGE_SEC since last use and, least recently
+# used first, above TMP_QUOTA_BYTES per db (0 = no quota). Orphaned .part files of
+# crashed set zips go after TMP_GC_PART_GRACE_SEC.
+TMP_GC_ENABLED = os.getenv("TMP_GC_ENABLED", "true").strip().lower() in ("1", "true", "yes", "on")
+TMP_GC_INTERVAL_SEC = float(os.getenv("TMP_GC_INTERVAL_SEC", "300"))
+TMP_MAX_AGE_SEC = int(os.getenv("TMP_MAX_AGE_SEC", str(24 * 3600)))
+TMP_QUOTA_BYTES = int(os.getenv("TMP_QUOTA_BYTES", "0"))
+TMP_GC_PART_GRACE_SEC = int(os.getenv("TMP_GC_PART_GRACE_SEC", "3600"))
+TMP_GC_MAX_REMOVALS = max(1, int(os.getenv("TMP_GC_MAX_REMOVALS", "1000")))
+# Unzips of at least CHECKPOINT_MIN_ENTRIES files with a process rid journal finished
+# entries under data/<db>/zipfs/checkpoints so a redelivered message resumes.
+CHECKPOINT_ENABLED = os.getenv("CHECKPOINT_ENABLED", "true").strip().lower() in ("1", "true", "yes", "on")
+CHECKPOINT_MIN_ENTRIES = int(os.getenv("CHECKPOINT_MIN_ENTRIES", "100"))
+# Recursive unzip: archives inside the archive are expanded up to NESTED_MAX_DEPTH
+# levels and NESTED_MAX_TOTAL_BYTES uncompressed in total. Inner archives are read
+# into memory up to NESTED_SPOOL_MEMORY_BYTES and spooled to disk above that.
+NESTED_MAX_DEPTH = max(1, int(os.getenv("NESTED_MAX_DEPTH", "3")))
+NESTED_MAX_TOTAL_BYTES = int(os.getenv("NESTED_MAX_TOTAL_BYTES", str(10 * 1024 ** 3)))
+NESTED_SPOOL_MEMORY_BYTES = int(os.getenv("NESTED_SPOOL_MEMORY_BYTES", str(64 * 1024 ** 2)))
+NESTED_ARCHIVE_EXTENSIONS = ('zip',)
+# /metrics walks data/<db>/tmp for the disk usage gauge at most this often.
+METRICS_TMP_SCAN_INTERVAL_SEC = float(os.getenv("METRICS_TMP_SCAN_INTERVAL_SEC", "30"))
 
 logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger("md-zip-fs")
@@ -83,10 +196,24 @@ except RuntimeError as err:
     print(f"ERROR: {err} \nexiting...")
     exit(1)
 
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    gc_task = asyncio.create_task(run_tmp_gc_loop()) if TMP_GC_ENABLED else None
+    yield
+    if gc_task is not None:
+        gc_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await gc_task
+    await stop_callback_workers()
+    await close_callback_session()
+
+
 app = FastAPI(
     title="zip API",
     description="API for zip",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
 )
 
 # Add CORS middleware
@@ -108,6 +235,636 @@ def log_event(level: str, event: str, **fields):
     getattr(logger, level, logger.info)(log_line)
 
 
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+THROUGHPUT_BUCKETS = tuple(float(2 ** shift) for shift in range(16, 33, 2))  # 64 KiB/s .. 4 GiB/s
+
+# Prometheus text exposition is written by hand; name -> (type, help, buckets).
+METRICS: Dict[str, Tuple[str, str, Tuple[float, ...]]] = {
+    "zipfs_requests_total": ("counter", "Processed requests by task, db and status.", ()),
+    "zipfs_request_duration_seconds": ("histogram", "End-to-end request time.", LATENCY_BUCKETS),
+    "zipfs_request_parse_seconds": ("histogram", "Time to read and parse the queue message.", LATENCY_BUCKETS),
+    "zipfs_index_load_seconds": (
+        "histogram",
+        "Central-directory index load time by source (memory, disk or archive scan).",
+        LATENCY_BUCKETS,
+    ),
+    "zipfs_entry_throughput_bytes_per_second": (
+        "histogram",
+        "Per-entry extraction throughput.",
+        THROUGHPUT_BUCKETS,
+    ),
+    "zipfs_entries_total": ("counter", "Entries extracted or zipped.", ()),
+    "zipfs_bytes_read_total": ("counter", "Archive or source file bytes read.", ()),
+    "zipfs_bytes_written_total": ("counter", "Bytes written to tmp or streamed to the client.", ()),
+    "zipfs_zip_assembly_seconds": ("histogram", "Time to write a set zip.", LATENCY_BUCKETS),
+    "zipfs_jobs_in_flight": ("gauge", "Requests currently being processed.", ()),
+    "zipfs_executor_queue_depth": ("gauge", "Work items waiting for a worker, by pool.", ()),
+    "zipfs_tmp_disk_usage_bytes": ("gauge", "Size of files in data/<db>/tmp.", ()),
+    "zipfs_tmp_gc_removed_total": ("counter", "Tmp files removed by the GC, by reason (age, quota, orphan_part, checkpoint, manifest).", ()),
+    "zipfs_zip_reused_entries_total": ("counter", "Set zip entries copied raw from the set's previous archive.", ()),
+    "zipfs_job_registry_jobs": ("gauge", "Jobs known to the job API, by status.", ()),
+    "zipfs_admission_in_flight_bytes": ("gauge", "Bytes reserved by admitted jobs.", ()),
+    "zipfs_admission_waiting": ("gauge", "Jobs queued for admission.", ()),
+    "zipfs_admission_rejected_total": ("counter", "Jobs rejected with 503 by admission control.", ()),
+}
+
+_metrics_lock = threading.Lock()
+_metric_values: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Any] = {}
+_tmp_usage_cache: Tuple[float, Dict[str, int]] = (0.0, {})
+
+
+def _metric_key(name: str, labels: Dict[str, Any]) -> Tuple[str, Tuple[Tuple[str, str], ...]]:
+    return name, tuple(sorted((key, "unknown" if value is None else str(value)) for key, value in labels.items()))
+
+
+def inc_metric(name: str, value: float = 1, **labels) -> None:
+    """Add value to a counter or gauge; gauges may go down with a negative value."""
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        _metric_values[key] = _metric_values.get(key, 0) + value
+
+
+def observe_metric(name: str, value: float, **labels) -> None:
+    buckets = METRICS[name][2]
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        state = _metric_values.get(key)
+        if state is None:
+            state = _metric_values[key] = [[0] * len(buckets), 0.0, 0]
+        for position, bound in enumerate(buckets):
+            if value <= bound:
+                state[0][position] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+
+def get_metric_labels(request_json: Any) -> Dict[str, str]:
+    """Best-effort task and db labels for a queue message; never raises."""
+    if not isinstance(request_json, dict):
+        return {"task": "unknown", "db": "unknown"}
+    task = request_json.get('task')
+    task_id = task.get('id') if isinstance(task, dict) else None
+    db_name = None
+    try:
+        if task_id == 'zip':
+            db_name = get_set_db_name(request_json, get_set_files(request_json))
+        elif isinstance(request_json.get('file'), dict) and isinstance(request_json['file'].get('path'), str):
+            db_name = get_db_name_from_file_path(request_json['file']['path'])
+    except Exception:
+        pass
+    return {"task": str(task_id or "unknown"), "db": db_name or "unknown"}
+
+
+def get_tmp_disk_usage() -> Dict[str, int]:
+    """Bytes in each data/<db>/tmp, rescanned at most every METRICS_TMP_SCAN_INTERVAL_SEC."""
+    global _tmp_usage_cache
+    expires, usage = _tmp_usage_cache
+    if time.monotonic() < expires:
+        return usage
+    usage = {}
+    data_root = os.path.join(MD_ROOT, "data")
+    try:
+        db_dirs = [entry for entry in os.scandir(data_root) if entry.is_dir()]
+    except OSError:
+        db_dirs = []
+    for db_dir in db_dirs:
+        total = 0
+        try:
+            with os.scandir(os.path.join(db_dir.path, "tmp")) as items:
+                for item in items:
+                    try:
+                        if item.is_file(follow_symlinks=False):
+                            total += item.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+        usage[db_dir.name] = total
+    _tmp_usage_cache = (time.monotonic() + METRICS_TMP_SCAN_INTERVAL_SEC, usage)
+    return usage
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        f'{key}="' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for key, value in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def render_metrics() -> str:
+    """Render all metrics in the Prometheus text format (version 0.0.4)."""
+    with _metrics_lock:
+        values = {key: copy.deepcopy(value) for key, value in _metric_values.items()}
+
+    # Point-in-time gauges are read at scrape time.
+    pools = {"job": _job_executor, "extract": _extract_executor, "prefetch": _prefetch_executor}
+    for pool, executor in pools.items():
+        work_queue = getattr(executor, "_work_queue", None)
+        values[_metric_key("zipfs_executor_queue_depth", {"pool": pool})] = work_queue.qsize() if work_queue else 0
+    pending = getattr(_compress_executor, "_pending_work_items", None)
+    values[_metric_key("zipfs_executor_queue_depth", {"pool": "compress"})] = len(pending) if pending else 0
+    for db_name, size in get_tmp_disk_usage().items():
+        values[_metric_key("zipfs_tmp_disk_usage_bytes", {"db": db_name})] = size
+    job_counts: Dict[str, int] = {}
+    for job in list(_jobs.values()):
+        job_counts[job["status"]] = job_counts.get(job["status"], 0) + 1
+    for job_status, count in job_counts.items():
+        values[_metric_key("zipfs_job_registry_jobs", {"status": job_status})] = count
+    values[_metric_key("zipfs_admission_in_flight_bytes", {})] = _admission.in_flight_bytes
+    values[_metric_key("zipfs_admission_waiting", {})] = _admission.waiting
+    values[_metric_key("zipfs_admission_rejected_total", {})] = _admission.rejected_total
+
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for (metric, labels), value in sorted(values.items()):
+            if metric != name:
+                continue
+            if kind != "histogram":
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+_job_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_job_executor() -> ThreadPoolExecutor:
+    """Return the shared bounded pool that runs blocking unzip/zip work."""
+    global _job_executor
+    if _job_executor is None:
+        _job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="zipfs-job")
+    return _job_executor
+
+
+async def run_in_worker(func, *args, **kwargs):
+    """Run a blocking task in the job pool so the event loop stays responsive."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_job_executor(), functools.partial(func, *args, **kwargs))
+
+
+async def run_in_io(func, *args, **kwargs):
+    """Run a short blocking read in the default executor, not the job pool.
+
+    Archive headers, central directories and stat passes must not queue
+    behind multi-minute extractions.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+async def iter_in_worker(chunks: Iterator[bytes]):
+    """Drive a blocking byte generator in the job pool, one chunk per call.
+
+    Streamed bodies (e.g. set zips compressed inline) then count against
+    JOB_WORKERS like any other job instead of running in Starlette's threadpool.
+    """
+    try:
+        while True:
+            chunk = await run_in_worker(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        chunks.close()
+
+
+class JobCancelled(Exception):
+    """Raised inside worker code when its job has been cancelled."""
+
+
+class JobControl:
+    """Progress counters and cancel flag shared by an async job and its workers."""
+
+    def __init__(self):
+        self.cancel_event = threading.Event()
+        self.started_at = time.time()
+        self.entries_total = 0
+        self.bytes_total = 0
+        self.entries_done = 0
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+
+    def set_totals(self, entries: int, total_bytes: int) -> None:
+        with self._lock:
+            self.entries_total = entries
+            self.bytes_total = total_bytes
+
+    def add_totals(self, entries: int, total_bytes: int) -> None:
+        """Grow the totals when more work is discovered, e.g. inside nested archives."""
+        with self._lock:
+            self.entries_total += entries
+            self.bytes_total += total_bytes
+
+    def advance(self, entries: int = 1, written: int = 0) -> None:
+        with self._lock:
+            self.entries_done += entries
+            self.bytes_written += written
+
+    def check_cancelled(self) -> None:
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            elapsed = time.time() - self.started_at
+            eta = None
+            if self.bytes_written and self.bytes_total:
+                eta = round(elapsed * (self.bytes_total - self.bytes_written) / self.bytes_written, 1)
+            return {
+                "entries_done": self.entries_done,
+                "entries_total": self.entries_total,
+                "bytes_written": self.bytes_written,
+                "bytes_total": self.bytes_total,
+                "elapsed_sec": round(elapsed, 1),
+                "eta_sec": eta,
+            }
+
+
+_single_flight_inflight: Dict[Any, "asyncio.Future"] = {}
+_single_flight_results: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+
+
+def _single_flight_done(key: Any, task: "asyncio.Future") -> None:
+    _single_flight_inflight.pop(key, None)
+    if task.cancelled() or task.exception() is not None or SINGLE_FLIGHT_TTL_SEC <= 0:
+        return
+    _single_flight_results[key] = (time.monotonic() + SINGLE_FLIGHT_TTL_SEC, task.result())
+    _single_flight_results.move_to_end(key)
+    while len(_single_flight_results) > SINGLE_FLIGHT_MAX_RESULTS:
+        _single_flight_results.popitem(last=False)
+
+
+async def run_single_flight(key: Any, validate, func, *args, admission=None, **kwargs):
+    """Run func in the job pool once per key, sharing the result with identical callers.
+
+    Callers arriving while the job runs await the same execution. Within
+    SINGLE_FLIGHT_TTL_SEC a finished result is returned again if
+    validate(result) still holds (e.g. its tmp files exist). Results are
+    handed out as copies; the job keeps running if its first caller goes away.
+    Only the executing caller goes through admission, so joiners reserve nothing.
+    """
+    now = time.monotonic()
+    cached = _single_flight_results.get(key)
+    if cached is not None:
+        expires_at, result = cached
+        if expires_at > now and validate(result):
+            log_event("info", "single_flight_cache_hit", key=str(key))
+            return copy.deepcopy(result)
+        _single_flight_results.pop(key, None)
+
+    task = _single_flight_inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(run_admitted(admission, func, *args, **kwargs))
+        _single_flight_inflight[key] = task
+        task.add_done_callback(functools.partial(_single_flight_done, key))
+    else:
+        log_event("info", "single_flight_joined", key=str(key))
+    return copy.deepcopy(await asyncio.shield(task))
+
+
+async def run_job_work(control: Optional[JobControl], key: Any, validate, func, *args, admission=None, **kwargs):
+    """Coalesce plain requests; jobs with a control object run on their own.
+
+    admission is an optional callable returning the (bytes, tmp_root) pair
+    reserved for the run; joiners and cache hits never evaluate it.
+    """
+    if control is None:
+        return await run_single_flight(key, validate, func, *args, admission=admission, **kwargs)
+    return await run_admitted(admission, func, *args, control=control, **kwargs)
+
+
+class AdmissionController:
+    """Admit tmp-writing work against free disk space and an in-flight byte budget.
+
+    Reservations are held for the whole run. A job larger than the budget is
+    still admitted when nothing else is in flight, so it is never starved.
+    """
+
+    def __init__(self):
+        self.in_flight_bytes = 0
+        self.in_flight_jobs = 0
+        self.waiting = 0
+        self.admitted_total = 0
+        self.rejected_total = 0
+        self._condition: Optional[asyncio.Condition] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _get_condition(self) -> asyncio.Condition:
+        loop = asyncio.get_running_loop()
+        if self._condition is None or self._loop is not loop:
+            self._condition = asyncio.Condition()
+            self._loop = loop
+        return self._condition
+
+    def _free_bytes(self, tmp_root: str) -> int:
+        return shutil.disk_usage(tmp_root).free - self.in_flight_bytes - ADMISSION_MIN_FREE_BYTES
+
+    def _fits(self, nbytes: int, tmp_root: str) -> bool:
+        over_budget = ADMISSION_MAX_INFLIGHT_BYTES > 0 and self.in_flight_bytes + nbytes > ADMISSION_MAX_INFLIGHT_BYTES
+        if self.in_flight_jobs and over_budget:
+            return False
+        return self._free_bytes(tmp_root) >= nbytes
+
+    def _reject(self, nbytes: int, reason: str) -> HTTPException:
+        self.rejected_total += 1
+        log_event("warning", "admission_rejected", bytes=nbytes, reason=reason, in_flight_bytes=self.in_flight_bytes)
+        return HTTPException(
+            503,
+            f"Not enough tmp capacity for {nbytes} bytes ({reason}); retry later",
+            headers={"Retry-After": str(ADMISSION_RETRY_AFTER_SEC)},
+        )
+
+    async def acquire(self, nbytes: int, tmp_root: str) -> None:
+        condition = self._get_condition()
+        async with condition:
+            if not self._fits(nbytes, tmp_root):
+                if not self.in_flight_jobs:
+                    # Nothing will be released; only outside cleanup could help.
+                    raise self._reject(nbytes, "disk full")
+                deadline = time.monotonic() + ADMISSION_QUEUE_TIMEOUT_SEC
+                self.waiting += 1
+                try:
+                    while not self._fits(nbytes, tmp_root):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise self._reject(nbytes, "queue timeout")
+                        try:
+                            # Re-check periodically: space can also be freed outside the service.
+                            await asyncio.wait_for(condition.wait(), timeout=min(remaining, 1.0))
+                        except asyncio.TimeoutError:
+                            pass
+                finally:
+                    self.waiting -= 1
+            self.in_flight_bytes += nbytes
+            self.in_flight_jobs += 1
+            self.admitted_total += 1
+
+    async def release(self, nbytes: int) -> None:
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight_bytes -= nbytes
+            self.in_flight_jobs -= 1
+            condition.notify_all()
+
+    def release_threadsafe(self, nbytes: int) -> None:
+        """Release from a worker thread, e.g. when a streamed response ends."""
+        asyncio.run_coroutine_threadsafe(self.release(nbytes), self._loop)
+
+    def snapshot(self, tmp_roots: List[str]) -> Dict[str, Any]:
+        disks = {}
+        for tmp_root in tmp_roots:
+            try:
+                disks[tmp_root] = shutil.disk_usage(tmp_root).free
+            except OSError:
+                continue
+        return {
+            "max_in_flight_bytes": ADMISSION_MAX_INFLIGHT_BYTES or None,
+            "min_free_bytes": ADMISSION_MIN_FREE_BYTES,
+            "queue_timeout_sec": ADMISSION_QUEUE_TIMEOUT_SEC,
+            "in_flight_bytes": self.in_flight_bytes,
+            "in_flight_jobs": self.in_flight_jobs,
+            "waiting": self.waiting,
+            "admitted_total": self.admitted_total,
+            "rejected_total": self.rejected_total,
+            "tmp_free_bytes": disks,
+        }
+
+
+_admission = AdmissionController()
+
+
+async def run_admitted(admission: Optional[Callable[[], Tuple[int, str]]], func, *args, **kwargs):
+    """Run func in the job pool, holding an admission reservation when one is given.
+
+    The estimate is computed here, outside the job pool, so only the caller
+    that actually executes pays for it.
+    """
+    if admission is None:
+        return await run_in_worker(func, *args, **kwargs)
+    nbytes, tmp_root = await run_in_io(admission)
+    await _admission.acquire(nbytes, tmp_root)
+    try:
+        return await run_in_worker(func, *args, **kwargs)
+    finally:
+        await _admission.release(nbytes)
+
+
+_callback_session: Dict[str, Any] = {"session": None, "loop": None}
+
+
+async def get_callback_session() -> aiohttp.ClientSession:
+    """Return the shared pooled session for MessyDesk callbacks on the running loop."""
+    loop = asyncio.get_running_loop()
+    session = _callback_session["session"]
+    if session is None or session.closed or _callback_session["loop"] is not loop:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=MD_CALLBACK_WORKERS),
+            timeout=aiohttp.ClientTimeout(
+                connect=MD_CALLBACK_CONNECT_TIMEOUT,
+                sock_read=MD_CALLBACK_READ_TIMEOUT,
+            ),
+        )
+        _callback_session["session"] = session
+        _callback_session["loop"] = loop
+    return session
+
+
+async def close_callback_session() -> None:
+    session = _callback_session["session"]
+    _callback_session["session"] = None
+    if session is not None and not session.closed:
+        await session.close()
+
+
+def is_callback_enabled(request_json: dict) -> bool:
+    task = request_json.get('task')
+    params = task.get('params', {}) if isinstance(task, dict) else {}
+    value = params.get('callback') if isinstance(params, dict) else None
+    if value is None:
+        return MD_CALLBACK_ENABLED
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+
+_callback_pool: Dict[str, Any] = {"queue": None, "loop": None, "workers": []}
+# Dispatcher of each coalesced extraction with callbacks, by single-flight key.
+_flight_dispatchers: Dict[Any, "CallbackDispatcher"] = {}
+
+
+def get_callback_queue() -> "asyncio.Queue[Tuple[CallbackDispatcher, List[Dict[str, Any]]]]":
+    """Return the queue of the shared callback worker pool on the running loop.
+
+    MD_CALLBACK_WORKERS workers serve every request, so concurrent jobs
+    share one bound on in-flight posts to MessyDesk.
+    """
+    loop = asyncio.get_running_loop()
+    if _callback_pool["loop"] is not loop:
+        queue: "asyncio.Queue[Tuple[CallbackDispatcher, List[Dict[str, Any]]]]" = asyncio.Queue()
+        _callback_pool.update(
+            queue=queue,
+            loop=loop,
+            workers=[asyncio.ensure_future(run_callback_worker(queue)) for _ in range(MD_CALLBACK_WORKERS)],
+        )
+    return _callback_pool["queue"]
+
+
+async def run_callback_worker(queue: "asyncio.Queue[Tuple[CallbackDispatcher, List[Dict[str, Any]]]]") -> None:
+    while True:
+        dispatcher, batch = await queue.get()
+        try:
+            delivered = await dispatcher._post(batch)
+        except Exception as exc:
+            log_event("warning", "md_callback_failed", url=dispatcher._url, files=len(batch), error=str(exc))
+            delivered = False
+        dispatcher._finish(batch, delivered)
+
+
+async def stop_callback_workers() -> None:
+    workers = _callback_pool["workers"]
+    _callback_pool.update(queue=None, loop=None, workers=[])
+    for worker in workers:
+        worker.cancel()
+    for worker in workers:
+        with suppress(asyncio.CancelledError):
+            await worker
+
+
+class CallbackDispatcher:
+    """Push one request's file descriptors to MessyDesk through the shared callback pool.
+
+    submit() is safe to call from job threads; descriptors submitted together
+    are posted in batches of MD_CALLBACK_BATCH_SIZE with retry and exponential
+    backoff, and marked "delivered" once MessyDesk accepted them.
+    """
+
+    def __init__(self, request_json: dict):
+        self._loop = asyncio.get_running_loop()
+        self._context = {
+            key: request_json.get(key)
+            for key in ('process', 'file', 'output_set', 'userId')
+            if request_json.get(key) is not None
+        }
+        self._url = MD_URL.rstrip('/') + MD_CALLBACK_PATH
+        self.delivered = 0
+        self.failed = 0
+        self.delivered_paths: set = set()
+        self._buffer: List[Dict[str, Any]] = []
+        self._flush_scheduled = False
+        self._pending_batches = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def submit(self, descriptor: Dict[str, Any]) -> None:
+        self._loop.call_soon_threadsafe(self._add, descriptor)
+
+    def _add(self, descriptor: Dict[str, Any]) -> None:
+        self._buffer.append(descriptor)
+        if not self._flush_scheduled:
+            # Descriptors arriving in the same loop pass share batches.
+            self._flush_scheduled = True
+            self._loop.call_soon(self._flush)
+
+    def _flush(self) -> None:
+        self._flush_scheduled = False
+        queue = get_callback_queue()
+        while self._buffer:
+            batch = self._buffer[:MD_CALLBACK_BATCH_SIZE]
+            del self._buffer[:MD_CALLBACK_BATCH_SIZE]
+            self._pending_batches += 1
+            self._idle.clear()
+            queue.put_nowait((self, batch))
+
+    def _finish(self, batch: List[Dict[str, Any]], delivered: bool) -> None:
+        if delivered:
+            for item in batch:
+                item["delivered"] = True
+                self.delivered_paths.add(item["path"])
+            self.delivered += len(batch)
+        else:
+            self.failed += len(batch)
+        self._pending_batches -= 1
+        if self._pending_batches == 0:
+            self._idle.set()
+
+    async def close(self) -> Dict[str, int]:
+        """Wait until every submitted descriptor has been posted or given up on."""
+        # Let submit() calls already made from job threads reach the buffer.
+        await asyncio.sleep(0)
+        self._flush()
+        await self._idle.wait()
+        return {"delivered": self.delivered, "failed": self.failed}
+
+    def mark_delivered(self, descriptors: List[Dict[str, Any]]) -> None:
+        """Flag delivered files on a (possibly copied) descriptor list for the response."""
+        for item in descriptors:
+            if item["path"] in self.delivered_paths:
+                item["delivered"] = True
+
+    async def _post(self, batch: List[Dict[str, Any]]) -> bool:
+        payload = {
+            **self._context,
+            "files": [{**item, "tmp_path": item["path"]} for item in batch],
+        }
+        session = await get_callback_session()
+        for attempt in range(MD_CALLBACK_RETRIES + 1):
+            try:
+                async with session.post(self._url, json=payload) as response:
+                    if response.status < 400:
+                        return True
+                    retryable = response.status == 429 or response.status >= 500
+                    error = f"HTTP {response.status}"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                retryable = True
+                error = str(exc) or exc.__class__.__name__
+            if not retryable or attempt == MD_CALLBACK_RETRIES:
+                log_event("warning", "md_callback_failed", url=self._url, files=len(batch), error=error, attempts=attempt + 1)
+                return False
+            await asyncio.sleep(MD_CALLBACK_RETRY_BACKOFF_SEC * (2 ** attempt))
+        return False
+
+
+_extract_executor: Optional[ThreadPoolExecutor] = None
+_compress_executor: Optional[ProcessPoolExecutor] = None
+_prefetch_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_extract_executor() -> ThreadPoolExecutor:
+    """Return the shared pool used for per-entry extraction inside a job."""
+    global _extract_executor
+    if _extract_executor is None:
+        _extract_executor = ThreadPoolExecutor(max_workers=EXTRACT_WORKERS, thread_name_prefix="zipfs-extract")
+    return _extract_executor
+
+
+def get_compress_executor() -> ProcessPoolExecutor:
+    """Return the process pool that deflates set files for the zip task."""
+    global _compress_executor
+    if _compress_executor is None:
+        _compress_executor = ProcessPoolExecutor(max_workers=ZIP_COMPRESS_WORKERS)
+    return _compress_executor
+
+
+def get_prefetch_executor() -> ThreadPoolExecutor:
+    """Return the I/O pool that reads set files ahead of the archive writer."""
+    global _prefetch_executor
+    if _prefetch_executor is None:
+        _prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="zipfs-prefetch")
+    return _prefetch_executor
+
+
 def get_db_name_from_file_path(file_path: str) -> str:
     """Infer database name from MessyDesk file path, fallback to env/default."""
     path_parts = file_path.replace('\\\\', '/').split('/')
@@ -247,9 +1004,16 @@ def sanitize_zip_filename(name: Optional[str], fallback_prefix: str = "set") ->
     return candidate
 
 
+IMAGE_EXTENSIONS = frozenset({'jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp'})
+# Formats that are already compressed and are stored as-is in "auto" mode.
+PRECOMPRESSED_EXTENSIONS = IMAGE_EXTENSIONS | {'pdf', 'zip'}
+# Formats that are always deflated in "auto" mode.
+TEXT_EXTENSIONS = frozenset({'txt', 'text', 'md', 'csv', 'tsv', 'json', 'xml', 'html', 'htm', 'log'})
+
+
 def infer_file_type(filename: str) -> str:
     ext = os.path.splitext(filename)[1].lower().lstrip('.')
-    if ext in {'jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp'}:
+    if ext in IMAGE_EXTENSIONS:
         return 'image'
     if ext == 'json':
         return 'json'
@@ -262,6 +1026,59 @@ def infer_file_type(filename: str) -> str:
     return 'text'
 
 
+CONTENT_HASH_ALGORITHMS = ('sha256', 'blake2b', 'xxh3_64', 'none')
+
+
+def get_content_hash_algorithm(request_json: dict) -> Optional[str]:
+    """Resolve the digest algorithm from task params or env; None disables hashing."""
+    task = request_json.get('task')
+    params = task.get('params', {}) if isinstance(task, dict) else {}
+    value = params.get('hash') if isinstance(params, dict) else None
+    algorithm = str(value or CONTENT_HASH).strip().lower()
+    if algorithm not in CONTENT_HASH_ALGORITHMS:
+        raise HTTPException(400, f"Unsupported hash: {value or CONTENT_HASH}")
+    if algorithm == 'xxh3_64' and xxhash is None:
+        raise HTTPException(400, "hash xxh3_64 requires the xxhash package")
+    return None if algorithm == 'none' else algorithm
+
+
+def new_content_hasher(algorithm: Optional[str]):
+    if algorithm is None:
+        return None
+    if algorithm == 'xxh3_64':
+        return xxhash.xxh3_64()
+    return hashlib.new(algorithm)
+
+
+def format_digest(algorithm: str, hasher) -> str:
+    return f"{algorithm}:{hasher.hexdigest()}"
+
+
+class HashingWriter:
+    """Write-through file wrapper that digests every byte written.
+
+    It has no seek(), so zipfile writes sequentially with data descriptors
+    and the digest matches the final archive bytes.
+    """
+
+    def __init__(self, fp, hasher):
+        self._fp = fp
+        self.hasher = hasher
+        self.size = 0
+
+    def write(self, data) -> int:
+        self.hasher.update(data)
+        self._fp.write(data)
+        self.size += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.size
+
+    def flush(self) -> None:
+        self._fp.flush()
+
+
 def to_disk_response(task_id: str, files: List[Dict[str, Any]], **extra: Any) -> Dict[str, Any]:
     payload: Dict[str, Any] = {
         "task": task_id,
@@ -274,6 +1091,18 @@ def to_disk_response(task_id: str, files: List[Dict[str, Any]], **extra: Any) ->
     return payload
 
 
+def to_list_response(task_id: str, listing: Dict[str, Any], **extra: Any) -> Dict[str, Any]:
+    payload: Dict[str, Any] = {
+        "task": task_id,
+        "response": {
+            "type": "list",
+            **listing,
+        },
+    }
+    payload.update(extra)
+    return payload
+
+
 def load_service_descriptor() -> Dict[str, Any]:
     try:
         descriptor = json.loads(SERVICE_DESCRIPTOR_PATH.read_text(encoding="utf-8"))
@@ -304,147 +1133,2600 @@ def load_help_markdown() -> str:
     raise HTTPException(status_code=404, detail="Help markdown file not found")
 
 
-def create_set_zip_in_tmp(request_json: dict) -> dict:
-    set_files = request_json.get('set_files')
-    if not isinstance(set_files, list) or len(set_files) == 0:
-        raise HTTPException(400, "Missing required field: set_files")
+ZIP_COMPRESSION_MODES = ('stored', 'deflate', 'auto')
 
-    set_rid = request_json.get('set_rid')
-    if not set_rid and isinstance(request_json.get('file'), dict):
-        set_rid = request_json['file'].get('@rid')
 
-    db_name = request_json.get('db_name')
-    if not db_name:
-        for item in set_files:
-            if isinstance(item, dict) and isinstance(item.get('path'), str):
-                maybe_db = get_db_name_from_file_path(item['path']) if not os.path.isabs(item['path']) else get_db_name_from_abs_path(item['path'])
-                if maybe_db:
-                    db_name = maybe_db
-                    break
-    if not db_name:
-        db_name = os.getenv("DB_NAME", "messydesk")
+def get_zip_compression(request_json: dict) -> str:
+    """Resolve set-zip compression from task params, message or env."""
+    task = request_json.get('task')
+    params = task.get('params', {}) if isinstance(task, dict) else {}
+    for value in (params.get('compression') if isinstance(params, dict) else None, request_json.get('compression'), ZIP_COMPRESSION):
+        if isinstance(value, str) and value.strip():
+            mode = value.strip().lower()
+            if mode not in ZIP_COMPRESSION_MODES:
+                raise HTTPException(400, f"Unsupported compression: {value}")
+            return mode
+    return 'stored'
 
-    tmp_root = os.path.join(MD_ROOT, "data", db_name, "tmp")
-    os.makedirs(tmp_root, exist_ok=True)
 
-    output_name = sanitize_zip_filename(request_json.get('zip_output_name'), "set")
-    final_zip_path = os.path.join(tmp_root, output_name)
-    partial_zip_path = final_zip_path + ".part"
+def deflate_file_to_part(src_path: str, part_path: str, level: int, chunk_size: int) -> Dict[str, int]:
+    """Raw-deflate src_path into part_path; runs in the compress process pool.
 
-    if os.path.exists(partial_zip_path):
-        os.remove(partial_zip_path)
+    level and chunk_size are passed by the caller: pool processes do not see
+    settings changed in the parent after they started.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc = 0
+    file_size = 0
+    with open(src_path, 'rb') as src, open(part_path, 'wb') as dst:
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            dst.write(compressor.compress(chunk))
+        dst.write(compressor.flush())
+        compress_size = dst.tell()
+    return {"CRC": crc, "file_size": file_size, "compress_size": compress_size}
 
-    zipped_files = 0
-    skipped_files = 0
-    file_names = []
 
-    try:
-        with zipfile.ZipFile(partial_zip_path, 'w', compression=zipfile.ZIP_STORED) as archive:
-            for entry in set_files:
-                if not isinstance(entry, dict):
-                    skipped_files += 1
-                    continue
+# Private ZipFile internals write_raw_entry relies on to append pre-compressed data.
+ZIPFILE_RAW_WRITE_ATTRS = ("_writing", "_seekable", "_writecheck", "_didModify", "start_dir")
 
-                file_path = entry.get('path')
-                if not isinstance(file_path, str):
-                    skipped_files += 1
-                    continue
 
-                try:
-                    abs_path = resolve_any_md_path(file_path)
-                except HTTPException:
-                    skipped_files += 1
-                    continue
+def iter_raw_entry_chunks(src, filename: str, compress_size: int) -> Iterator[bytes]:
+    """Yield compress_size bytes of compressed entry data from src."""
+    remaining = compress_size
+    while remaining > 0:
+        chunk = src.read(min(COPY_CHUNK_SIZE, remaining))
+        if not chunk:
+            raise OSError(f"Compressed data for {filename!r} is truncated")
+        remaining -= len(chunk)
+        yield chunk
 
-                if not os.path.exists(abs_path):
-                    skipped_files += 1
-                    continue
 
-                arc_name = entry.get('original_filename') or entry.get('label') or os.path.basename(abs_path)
-                archive.write(abs_path, arcname=arc_name)
-                file_names.append(arc_name)
-                zipped_files += 1
-
-            if zipped_files == 0:
-                raise HTTPException(404, "No valid files found to zip")
-
-            readme = [
-                "MessyDesk set output",
-                f"Created on: {time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}",
-                f"Set ID: {set_rid or 'unknown'}",
-                f"Files included: {zipped_files}",
-                "",
-                "File list:",
-                *file_names,
-            ]
-            archive.writestr('README.txt', "\n".join(readme) + "\n")
+def write_raw_entry(archive: zipfile.ZipFile, zinfo: zipfile.ZipInfo, src) -> None:
+    """Append already-compressed entry data with a header built from zinfo.
 
-        # Atomic rename marks zip as ready for backend downloader.
-        os.replace(partial_zip_path, final_zip_path)
-    finally:
-        if os.path.exists(partial_zip_path):
-            os.remove(partial_zip_path)
+    zinfo must carry final CRC, sizes and compress_type; src is a binary file
+    object positioned at the start of the compressed data. If this Python's
+    ZipFile lacks the internals used for the raw copy, the data is decoded
+    and written through the public API instead.
+    """
+    if not all(hasattr(archive, name) for name in ZIPFILE_RAW_WRITE_ATTRS):
+        write_decoded_entry(archive, zinfo, src)
+        return
+    if archive._writing:
+        raise ValueError("Can't write to the ZIP file while there is another write handle open on it.")
+    if archive._seekable:
+        archive.fp.seek(archive.start_dir)
+    zinfo.header_offset = archive.fp.tell()
+    archive._writecheck(zinfo)
+    archive._didModify = True
+    archive.fp.write(zinfo.FileHeader())
+    for chunk in iter_raw_entry_chunks(src, zinfo.filename, zinfo.compress_size):
+        archive.fp.write(chunk)
+    archive.filelist.append(zinfo)
+    archive.NameToInfo[zinfo.filename] = zinfo
+    archive.start_dir = archive.fp.tell()
 
-    return {
-        "status": "success",
-        "zip_output_name": output_name,
-        "zip_abs_path": final_zip_path,
-        "zip_tmp_path": f"data/{db_name}/tmp/{output_name}",
-        "zipped_files": zipped_files,
-        "skipped_files": skipped_files,
-    }
 
+def write_decoded_entry(archive: zipfile.ZipFile, zinfo: zipfile.ZipInfo, src) -> None:
+    """Fallback for write_raw_entry: decode the data and let ZipFile re-encode it."""
+    # ZipFile.open() resets CRC and sizes on zinfo; keep the expected values.
+    expected_crc = zinfo.CRC
+    chunks = iter_raw_entry_chunks(src, zinfo.filename, zinfo.compress_size)
+    decompressor = zlib.decompressobj(-15) if zinfo.compress_type == zipfile.ZIP_DEFLATED else None
+    with archive.open(zinfo, 'w') as dest:
+        for chunk in chunks:
+            dest.write(decompressor.decompress(chunk) if decompressor is not None else chunk)
+        if decompressor is not None:
+            dest.write(decompressor.flush())
+    if zinfo.CRC != expected_crc:
+        raise zipfile.BadZipFile(f"Bad CRC-32 for file {zinfo.filename!r}")
 
-@app.get("/")
-async def root():
-    return {"message": "zip API for MessyDesk"}
 
+def choose_entry_compression(abs_path: str, arc_name: str) -> str:
+    """Pick "stored" or "deflate" for one set file in auto mode.
 
-@app.get("/health")
-async def health() -> Dict[str, Any]:
-    return {"status": "ok", "service": "md-zip_fs"}
+    Known compressed formats are stored and text-like formats deflated; other
+    files are deflated only when a fast compression of a leading sample
+    reaches AUTO_COMPRESS_MAX_RATIO.
+    """
+    ext = os.path.splitext(arc_name)[1].lower().lstrip('.')
+    if ext in PRECOMPRESSED_EXTENSIONS:
+        return 'stored'
+    if ext in TEXT_EXTENSIONS:
+        return 'deflate'
+    try:
+        with open(abs_path, 'rb') as fh:
+            sample = fh.read(AUTO_COMPRESS_SAMPLE_BYTES)
+    except OSError:
+        return 'stored'
+    if not sample:
+        return 'stored'
+    ratio = len(zlib.compress(sample, 1)) / len(sample)
+    return 'deflate' if ratio <= AUTO_COMPRESS_MAX_RATIO else 'stored'
 
 
-@app.get("/config")
-async def config() -> Dict[str, Any]:
-    return load_service_descriptor()
+def advise_file(fd: int, length: int, advice_name: str) -> None:
+    """Pass a posix_fadvise hint where the platform has one; hints never fail a job."""
+    advice = getattr(os, advice_name, None)
+    if advice is None or not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(fd, 0, length, advice)
+    except OSError:
+        pass
 
 
-@app.get("/help")
-async def help_markdown() -> PlainTextResponse:
-    markdown = load_help_markdown()
-    return PlainTextResponse(markdown, media_type="text/markdown")
+def read_ahead(abs_path: str, buffer: bool) -> Optional[bytes]:
+    """Read a whole set file, or only ask the kernel to start reading it when not buffered."""
+    with open(abs_path, 'rb') as fh:
+        if not buffer:
+            advise_file(fh.fileno(), PREFETCH_MAX_FILE_BYTES, "POSIX_FADV_WILLNEED")
+            return None
+        advise_file(fh.fileno(), 0, "POSIX_FADV_SEQUENTIAL")
+        return fh.read()
 
 
-@app.post("/process")
-async def process_files(
-    message: UploadFile = File(...)
-):
-    process_rid = None
-    source_file_rid = None
-    output_set = None
-    extracted_count = 0
-    output_files: List[Dict[str, Any]] = []
-    status = "failed"
-    start_time = time.time()
-    print("Received /process request, starting processing...")
+_prefetch_budget = {"bytes": 0}
+_prefetch_budget_lock = threading.Lock()
 
-    try:
-        log_event("info", "process_start")
 
-        # Parse message JSON in-memory to avoid disk roundtrip overhead.
-        request_chunks = []
-        while True:
-            chunk = await message.read(REQUEST_READ_CHUNK_SIZE)
-            if not chunk:
-                break
-            request_chunks.append(chunk)
-        request_json = json.loads(b"".join(request_chunks).decode("utf-8"))
-        print(f"Received request: {json.dumps(request_json, indent=2)}")
+def reserve_prefetch_bytes(nbytes: int) -> bool:
+    """Take nbytes of the process-wide PREFETCH_MEMORY_BYTES budget if they fit."""
+    with _prefetch_budget_lock:
+        if _prefetch_budget["bytes"] + nbytes > PREFETCH_MEMORY_BYTES:
+            return False
+        _prefetch_budget["bytes"] += nbytes
+        return True
 
-        log_event("info", "request_parsed", has_payload=isinstance(request_json, dict))
 
-        # Validate
+def release_prefetch_bytes(nbytes: int) -> None:
+    with _prefetch_budget_lock:
+        _prefetch_budget["bytes"] -= nbytes
+
+
+class SetFilePrefetcher:
+    """Read set files ahead of a sequential archive writer.
+
+    Up to PREFETCH_FILES upcoming files are read concurrently in the prefetch
+    pool while the writer works on the current one. take() hands them back
+    strictly in order: the file's bytes, or None when the writer should read
+    it from disk itself (files over PREFETCH_MAX_FILE_BYTES, which only get a
+    read-ahead hint, or prefetching disabled). Buffered bytes are reserved
+    from one process-wide PREFETCH_MEMORY_BYTES budget shared by every
+    prefetcher, so concurrent set zips and parts cannot multiply it. When the
+    budget is exhausted a prefetcher waits on its own pending files, or, with
+    none in flight, lets the writer read the next file from disk.
+    """
+
+    def __init__(self, paths: List[str]):
+        self.paths = paths
+        self._next = 0
+        self._pending: "deque[Tuple[int, Any]]" = deque()
+        self._buffered = 0
+
+    def _fill(self) -> None:
+        while self._next < len(self.paths) and len(self._pending) < PREFETCH_FILES:
+            abs_path = self.paths[self._next]
+            try:
+                size = os.path.getsize(abs_path)
+            except OSError:
+                size = 0
+            buffer = size <= PREFETCH_MAX_FILE_BYTES
+            if buffer and not reserve_prefetch_bytes(size):
+                if self._pending:
+                    return
+                buffer = False
+            reserved = size if buffer else 0
+            self._buffered += reserved
+            self._pending.append((reserved, get_prefetch_executor().submit(read_ahead, abs_path, buffer)))
+            self._next += 1
+
+    def take(self) -> Optional[bytes]:
+        """Return the next file's bytes (None: read it from disk)."""
+        if PREFETCH_FILES == 0:
+            self._next += 1
+            return None
+        self._fill()
+        reserved, future = self._pending.popleft()
+        try:
+            return future.result()
+        except OSError:
+            # Let the writer's own open() report the problem.
+            return None
+        finally:
+            self._buffered -= reserved
+            release_prefetch_bytes(reserved)
+            self._fill()
+
+    def close(self) -> None:
+        while self._pending:
+            reserved, future = self._pending.popleft()
+            future.cancel()
+            release_prefetch_bytes(reserved)
+        self._buffered = 0
+
+    def __enter__(self) -> "SetFilePrefetcher":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def write_set_file(archive: zipfile.ZipFile, abs_path: str, arc_name: str, data: Optional[bytes]) -> int:
+    """Add one STORED set file from prefetched bytes or from disk; return its size."""
+    if data is None:
+        archive.write(abs_path, arcname=arc_name, compress_type=zipfile.ZIP_STORED)
+        return os.path.getsize(abs_path)
+    zinfo = zipfile.ZipInfo.from_file(abs_path, arcname=arc_name)
+    archive.writestr(zinfo, data, compress_type=zipfile.ZIP_STORED)
+    return len(data)
+
+
+def copy_raw_entry(archive: zipfile.ZipFile, previous_fp, info: "ZipEntry", abs_path: str, arc_name: str) -> None:
+    """Append an entry's compressed bytes from a previous archive without recompressing."""
+    zinfo = zipfile.ZipInfo.from_file(abs_path, arcname=arc_name)
+    zinfo.compress_type = info.compress_type
+    zinfo.CRC = info.CRC
+    zinfo.file_size = info.file_size
+    zinfo.compress_size = info.compress_size
+    previous_fp.seek(get_entry_data_offset(previous_fp, info.header_offset))
+    write_raw_entry(archive, zinfo, previous_fp)
+
+
+def write_set_entries(
+    archive: zipfile.ZipFile,
+    entries: List[Tuple[str, str]],
+    methods: List[str],
+    tmp_root: str,
+    control: Optional[JobControl] = None,
+    reuse: Optional[Tuple[Any, Dict[int, "ZipEntry"]]] = None,
+) -> None:
+    """Append set entries in order, deflating the "deflate" ones in the process pool.
+
+    Deflated entries are written as raw pre-compressed entries. At most two
+    rounds of work per pool worker are outstanding so staged compressed
+    parts do not pile up in tmp ahead of the writer. Stored entries are
+    read ahead by a SetFilePrefetcher. reuse is (previous archive handle,
+    {entry index: its record there}); those entries are copied raw.
+    """
+    reused = reuse[1] if reuse is not None else {}
+    executor = get_compress_executor()
+    window = ZIP_COMPRESS_WORKERS * 2
+    pending: List[Tuple[str, str, Optional[str], Any]] = []
+    in_flight = 0
+    next_index = 0
+    prefetcher = SetFilePrefetcher(
+        [
+            abs_path
+            for index, ((abs_path, _), method) in enumerate(zip(entries, methods))
+            if method != 'deflate' and index not in reused
+        ]
+    )
+    try:
+        while next_index < len(entries) or pending:
+            while next_index < len(entries) and in_flight < window:
+                abs_path, arc_name = entries[next_index]
+                if next_index in reused:
+                    pending.append((abs_path, arc_name, None, reused[next_index]))
+                elif methods[next_index] == 'deflate':
+                    part_path = os.path.join(tmp_root, f".zipfs_deflate_{uuid.uuid4().hex}.part")
+                    pending.append((abs_path, arc_name, part_path, executor.submit(deflate_file_to_part, abs_path, part_path, ZIP_COMPRESS_LEVEL, COPY_CHUNK_SIZE)))
+                    in_flight += 1
+                else:
+                    pending.append((abs_path, arc_name, None, None))
+                next_index += 1
+
+            if control is not None:
+                control.check_cancelled()
+            abs_path, arc_name, part_path, future = pending.pop(0)
+            if isinstance(future, ZipEntry):
+                copy_raw_entry(archive, reuse[0], future, abs_path, arc_name)
+                if control is not None:
+                    control.advance(1, future.file_size)
+                continue
+            if future is None:
+                size = write_set_file(archive, abs_path, arc_name, prefetcher.take())
+                if control is not None:
+                    control.advance(1, size)
+                continue
+            in_flight -= 1
+            stats = future.result()
+            zinfo = zipfile.ZipInfo.from_file(abs_path, arcname=arc_name)
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            zinfo.CRC = stats["CRC"]
+            zinfo.file_size = stats["file_size"]
+            zinfo.compress_size = stats["compress_size"]
+            try:
+                with open(part_path, 'rb') as part:
+                    write_raw_entry(archive, zinfo, part)
+            finally:
+                os.remove(part_path)
+            if control is not None:
+                control.advance(1, zinfo.file_size)
+    finally:
+        prefetcher.close()
+        for _, _, part_path, future in pending:
+            if part_path is None:
+                continue
+            future.cancel()
+            try:
+                future.result()
+            except BaseException:
+                pass
+            if part_path and os.path.exists(part_path):
+                os.remove(part_path)
+
+
+def resolve_set_entries(set_files: list) -> Tuple[List[Tuple[str, str]], int]:
+    """Return (abs_path, arc_name) pairs for usable set files and the skip count."""
+    entries: List[Tuple[str, str]] = []
+    skipped_files = 0
+    for entry in set_files:
+        if not isinstance(entry, dict):
+            skipped_files += 1
+            continue
+
+        file_path = entry.get('path')
+        if not isinstance(file_path, str):
+            skipped_files += 1
+            continue
+
+        try:
+            abs_path = resolve_any_md_path(file_path)
+        except HTTPException:
+            skipped_files += 1
+            continue
+
+        if not os.path.exists(abs_path):
+            skipped_files += 1
+            continue
+
+        arc_name = entry.get('original_filename') or entry.get('label') or os.path.basename(abs_path)
+        entries.append((abs_path, arc_name))
+    return entries, skipped_files
+
+
+def get_set_files(request_json: dict) -> list:
+    set_files = request_json.get('set_files')
+    if not isinstance(set_files, list) or len(set_files) == 0:
+        raise HTTPException(400, "Missing required field: set_files")
+    return set_files
+
+
+def get_set_rid(request_json: dict) -> Optional[str]:
+    set_rid = request_json.get('set_rid')
+    if not set_rid and isinstance(request_json.get('file'), dict):
+        set_rid = request_json['file'].get('@rid')
+    return set_rid
+
+
+def get_set_db_name(request_json: dict, set_files: list) -> str:
+    db_name = request_json.get('db_name')
+    if not db_name:
+        for item in set_files:
+            if isinstance(item, dict) and isinstance(item.get('path'), str):
+                maybe_db = get_db_name_from_file_path(item['path']) if not os.path.isabs(item['path']) else get_db_name_from_abs_path(item['path'])
+                if maybe_db:
+                    db_name = maybe_db
+                    break
+    if not db_name:
+        db_name = os.getenv("DB_NAME", "messydesk")
+    return db_name
+
+
+def get_entry_methods(entries: List[Tuple[str, str]], compression: str) -> List[str]:
+    if compression == 'auto':
+        return [choose_entry_compression(abs_path, arc_name) for abs_path, arc_name in entries]
+    return [compression] * len(entries)
+
+
+def build_set_readme(
+    set_rid: Optional[str], file_names: List[str], part: Optional[Tuple[int, int]] = None
+) -> str:
+    readme = [
+        "MessyDesk set output",
+        f"Created on: {time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}",
+        f"Set ID: {set_rid or 'unknown'}",
+    ]
+    if part is not None:
+        readme.append(f"Part: {part[0]} of {part[1]}")
+    readme += [
+        f"Files included: {len(file_names)}",
+        "",
+        "File list:",
+        *file_names,
+    ]
+    return "\n".join(readme) + "\n"
+
+
+def write_set_archive(
+    output,
+    entries: List[Tuple[str, str]],
+    methods: List[str],
+    tmp_root: str,
+    set_rid: Optional[str],
+    compression: str,
+    control: Optional[JobControl] = None,
+    part: Optional[Tuple[int, int]] = None,
+    reuse: Optional[Tuple[Any, Dict[int, "ZipEntry"]]] = None,
+) -> None:
+    """Write the set zip with its README; reuse is (previous archive handle, {index: record})."""
+    file_names = [arc_name for _, arc_name in entries]
+    with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_STORED) as archive:
+        if reuse or 'deflate' in methods:
+            write_set_entries(archive, entries, methods, tmp_root, control, reuse)
+        else:
+            with SetFilePrefetcher([abs_path for abs_path, _ in entries]) as prefetcher:
+                for abs_path, arc_name in entries:
+                    if control is not None:
+                        control.check_cancelled()
+                    size = write_set_file(archive, abs_path, arc_name, prefetcher.take())
+                    if control is not None:
+                        control.advance(1, size)
+
+        archive.writestr(
+            'README.txt',
+            build_set_readme(set_rid, file_names, part),
+            compress_type=zipfile.ZIP_STORED if compression == 'stored' else zipfile.ZIP_DEFLATED,
+        )
+
+
+# Bytes counted per entry on top of its data when sizing parts: local header,
+# central-directory record and their ZIP64 extra fields (the name is added
+# three times: both headers and the README file list).
+ZIP_PART_ENTRY_OVERHEAD = 128
+# Room left in every part for its README header and end-of-central-directory records.
+ZIP_PART_RESERVE_BYTES = 64 * 1024
+
+
+def get_deflate_bound(size: int) -> int:
+    """Largest raw-deflate output for size input bytes (zlib's compressBound)."""
+    return size + (size >> 12) + (size >> 14) + (size >> 25) + 13
+
+
+def get_max_part_size(request_json: dict) -> Optional[int]:
+    """Return the zip task's max_part_size in bytes, or None for a single archive."""
+    task = request_json.get('task')
+    params = task.get('params', {}) if isinstance(task, dict) else {}
+    value = params.get('max_part_size') if isinstance(params, dict) else None
+    if value is None:
+        value = request_json.get('max_part_size')
+    if value is None or value == '':
+        return None
+    try:
+        max_part_size = int(value)
+    except (TypeError, ValueError):
+        raise HTTPException(400, f"Invalid max_part_size: {value}")
+    if max_part_size <= ZIP_PART_RESERVE_BYTES:
+        raise HTTPException(400, f"max_part_size must be larger than {ZIP_PART_RESERVE_BYTES} bytes")
+    return max_part_size
+
+
+def partition_set_entries(
+    entries: List[Tuple[str, str]], sizes: List[int], max_part_size: int, compression: str = 'stored'
+) -> List[List[int]]:
+    """Split entry indices into consecutive parts that each fit max_part_size.
+
+    Set order is kept across parts. Entries are costed at their worst case:
+    the source size when stored, the deflate bound when the mode may deflate
+    (incompressible data grows slightly). A file too large for any part gets
+    a part of its own.
+    """
+    budget = max_part_size - ZIP_PART_RESERVE_BYTES
+    parts: List[List[int]] = [[]]
+    used = 0
+    for index, ((_, arc_name), size) in enumerate(zip(entries, sizes)):
+        data_size = size if compression == 'stored' else get_deflate_bound(size)
+        cost = data_size + ZIP_PART_ENTRY_OVERHEAD + 3 * len(arc_name.encode('utf-8'))
+        if parts[-1] and used + cost > budget:
+            parts.append([])
+            used = 0
+        parts[-1].append(index)
+        used += cost
+    return parts
+
+
+def get_part_names(output_name: str, count: int) -> List[str]:
+    """Name parts <base>_part01.zip, <base>_part02.zip, ... (a single part keeps output_name)."""
+    if count == 1:
+        return [output_name]
+    base = output_name[:-len('.zip')]
+    width = max(2, len(str(count)))
+    return [f"{base}_part{index:0{width}d}.zip" for index in range(1, count + 1)]
+
+
+def build_set_zip_part(
+    entries: List[Tuple[str, str]],
+    methods: List[str],
+    tmp_root: str,
+    output_name: str,
+    set_rid: Optional[str],
+    compression: str,
+    hash_algorithm: Optional[str],
+    db_name: str,
+    control: Optional[JobControl] = None,
+    part: Optional[Tuple[int, int]] = None,
+    reuse: Optional[Tuple[Any, Dict[int, "ZipEntry"]]] = None,
+) -> Dict[str, Any]:
+    """Write one self-contained set zip to tmp via a .part file and describe it."""
+    final_zip_path = os.path.join(tmp_root, output_name)
+    partial_zip_path = final_zip_path + ".part"
+    if os.path.exists(partial_zip_path):
+        os.remove(partial_zip_path)
+
+    hasher = new_content_hasher(hash_algorithm)
+    # Journal the .part name first so the GC can tell a crashed write of ours
+    # from another service's upload.
+    track_tmp_file(db_name, output_name + ".part")
+    _active_tmp_writes.add(partial_zip_path)
+    try:
+        with open(partial_zip_path, 'wb') as raw_output:
+            # Digest the archive as it is written; the writer is sequential only.
+            output = HashingWriter(raw_output, hasher) if hasher is not None else raw_output
+            write_set_archive(output, entries, methods, tmp_root, set_rid, compression, control, part, reuse)
+        archive_size = os.path.getsize(partial_zip_path)
+
+        # Atomic rename marks zip as ready for backend downloader.
+        os.replace(partial_zip_path, final_zip_path)
+        track_tmp_file(db_name, output_name)
+    finally:
+        _active_tmp_writes.discard(partial_zip_path)
+        if os.path.exists(partial_zip_path):
+            os.remove(partial_zip_path)
+    return {
+        "zip_output_name": output_name,
+        "zip_abs_path": final_zip_path,
+        "zip_tmp_path": f"data/{db_name}/tmp/{output_name}",
+        "zipped_files": len(entries),
+        "size": archive_size,
+        "digest": format_digest(hash_algorithm, hasher) if hasher is not None else None,
+    }
+
+
+def _manifest_path(db_name: str, set_rid: str) -> str:
+    digest = hashlib.sha1(set_rid.encode("utf-8")).hexdigest()
+    return os.path.join(get_state_dir(db_name, "manifests"), digest + ".json")
+
+
+def load_set_zip_manifest(db_name: str, set_rid: str) -> Optional[Dict[str, Any]]:
+    """Return the manifest of the set's last archive if its retained copy is intact."""
+    path = _manifest_path(db_name, set_rid)
+    try:
+        with open(path, 'r', encoding="utf-8") as fh:
+            manifest = json.load(fh)
+        archive_path = os.path.join(os.path.dirname(path), manifest["archive"])
+        if manifest.get("set_rid") != set_rid or os.path.getsize(archive_path) != manifest["archive_size"]:
+            return None
+        manifest["archive_path"] = archive_path
+        manifest["entries"] = [
+            dict(record, entry=ZipEntry(*record["entry"])) for record in manifest["entries"]
+        ]
+    except (OSError, ValueError, TypeError, KeyError):
+        return None
+    return manifest
+
+
+def plan_set_zip_reuse(
+    manifest: Optional[Dict[str, Any]],
+    entries: List[Tuple[str, str]],
+    stats: List[os.stat_result],
+    compression: str,
+) -> Dict[int, Tuple[str, "ZipEntry"]]:
+    """Map entry index -> (method, previous record) for files unchanged since the manifest.
+
+    A file is unchanged when path, archive name, size and mtime all match;
+    archives built with another compression mode are not reused.
+    """
+    if manifest is None or manifest.get("compression") != compression:
+        return {}
+    previous = {(record["path"], record["arc_name"]): record for record in manifest["entries"]}
+    reuse: Dict[int, Tuple[str, "ZipEntry"]] = {}
+    for index, ((abs_path, arc_name), stat) in enumerate(zip(entries, stats)):
+        record = previous.get((abs_path, arc_name))
+        if record and record["size"] == stat.st_size and record["mtime_ns"] == stat.st_mtime_ns:
+            reuse[index] = (record["method"], record["entry"])
+    return reuse
+
+
+def store_set_zip_manifest(
+    db_name: str,
+    set_rid: str,
+    zip_path: str,
+    entries: List[Tuple[str, str]],
+    stats: List[os.stat_result],
+    methods: List[str],
+    compression: str,
+) -> None:
+    """Retain a hardlink of the set's new archive and record what each entry was built from.
+
+    stats are taken before the build, so a file changed while it was being
+    zipped is not trusted next time. Without hardlink support nothing is kept.
+    """
+    manifest_path = _manifest_path(db_name, set_rid)
+    manifest_dir = os.path.dirname(manifest_path)
+    previous = load_set_zip_manifest(db_name, set_rid)
+    retained = f"{os.path.basename(manifest_path)[:-len('.json')]}_{uuid.uuid4().hex}.zip"
+    retained_path = os.path.join(manifest_dir, retained)
+    try:
+        records = read_zip_index(zip_path)[:len(entries)]
+        os.link(zip_path, retained_path)
+    except (OSError, zipfile.BadZipFile) as exc:
+        log_event("warning", "zip_manifest_skipped", set_rid=set_rid, error=str(exc))
+        return
+    manifest = {
+        "set_rid": set_rid,
+        "archive": retained,
+        "archive_size": os.path.getsize(retained_path),
+        "compression": compression,
+        "entries": [
+            {
+                "path": abs_path,
+                "arc_name": arc_name,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "method": method,
+                "entry": list(record),
+            }
+            for (abs_path, arc_name), stat, method, record in zip(entries, stats, methods, records)
+            if record.file_size == stat.st_size
+        ],
+    }
+    partial = f"{manifest_path}.{uuid.uuid4().hex}.part"
+    try:
+        with open(partial, 'w', encoding="utf-8") as fh:
+            json.dump(manifest, fh, separators=(",", ":"))
+        os.replace(partial, manifest_path)
+    except OSError as exc:
+        log_event("warning", "zip_manifest_write_failed", set_rid=set_rid, error=str(exc))
+        for path in (partial, retained_path):
+            if os.path.exists(path):
+                os.remove(path)
+        return
+    if previous is not None and previous["archive_path"] != retained_path:
+        with suppress(OSError):
+            os.remove(previous["archive_path"])
+
+
+def get_set_zip_job_key(request_json: dict) -> Tuple[Any, ...]:
+    """Identify a set-zip job by its inputs for request coalescing."""
+    task = request_json.get('task')
+    params = task.get('params', {}) if isinstance(task, dict) else {}
+    return (
+        "zip",
+        json.dumps(request_json.get('set_files'), sort_keys=True, default=str),
+        request_json.get('db_name'),
+        request_json.get('zip_output_name'),
+        request_json.get('compression'),
+        json.dumps(params, sort_keys=True, default=str),
+    )
+
+
+def create_set_zip_in_tmp(request_json: dict, control: Optional[JobControl] = None) -> dict:
+    """Zip the set's files into tmp and describe the result.
+
+    With max_part_size the set is split into consecutive, self-contained
+    parts (each with its own README) that are built concurrently in the
+    extract pool; "parts" lists every archive written. If any part fails,
+    the parts already written are removed.
+    """
+    set_files = get_set_files(request_json)
+    set_rid = get_set_rid(request_json)
+    db_name = get_set_db_name(request_json, set_files)
+    compression = get_zip_compression(request_json)
+    hash_algorithm = get_content_hash_algorithm(request_json)
+    max_part_size = get_max_part_size(request_json)
+
+    tmp_root = os.path.join(MD_ROOT, "data", db_name, "tmp")
+    os.makedirs(tmp_root, exist_ok=True)
+
+    output_name = sanitize_zip_filename(request_json.get('zip_output_name'), "set")
+
+    entries, skipped_files = resolve_set_entries(set_files)
+    zipped_files = len(entries)
+    if zipped_files == 0:
+        raise HTTPException(404, "No valid files found to zip")
+    file_names = [arc_name for _, arc_name in entries]
+    stats = [os.stat(abs_path) for abs_path, _ in entries]
+    sizes = [stat.st_size for stat in stats]
+    source_bytes = sum(sizes)
+    if control is not None:
+        control.set_totals(len(entries), source_bytes)
+
+    groups = partition_set_entries(entries, sizes, max_part_size, compression) if max_part_size else [list(range(zipped_files))]
+    # Single archives of a known set are rebuilt incrementally from the last one.
+    incremental = ZIP_MANIFEST_ENABLED and bool(set_rid) and len(groups) == 1
+    manifest = load_set_zip_manifest(db_name, set_rid) if incremental else None
+    reuse_plan = plan_set_zip_reuse(manifest, entries, stats, compression)
+    previous_fp = None
+    if reuse_plan:
+        # Hold the retained archive open: a concurrent rebuild of the set may unlink it.
+        try:
+            previous_fp = open(manifest["archive_path"], 'rb')
+        except OSError:
+            reuse_plan = {}
+    fresh = [index for index in range(zipped_files) if index not in reuse_plan]
+    methods = [reuse_plan[index][0] if index in reuse_plan else None for index in range(zipped_files)]
+    for index, method in zip(fresh, get_entry_methods([entries[index] for index in fresh], compression)):
+        methods[index] = method
+    part_names = get_part_names(output_name, len(groups))
+    assembly_start = time.perf_counter()
+
+    def build(number: int) -> Dict[str, Any]:
+        indices = groups[number]
+        return build_set_zip_part(
+            [entries[index] for index in indices],
+            [methods[index] for index in indices],
+            tmp_root,
+            part_names[number],
+            set_rid,
+            compression,
+            hash_algorithm,
+            db_name,
+            control,
+            (number + 1, len(groups)) if len(groups) > 1 else None,
+        )
+
+    if previous_fp is not None:
+        with previous_fp:
+            parts = [
+                build_set_zip_part(
+                    entries, methods, tmp_root, part_names[0], set_rid, compression, hash_algorithm, db_name, control,
+                    reuse=(previous_fp, {index: record for index, (_, record) in reuse_plan.items()}),
+                )
+            ]
+    elif len(groups) == 1:
+        parts = [build(0)]
+    else:
+        futures = [get_extract_executor().submit(build, number) for number in range(len(groups))]
+        concurrent.futures.wait(futures)
+        parts = [future.result() for future in futures if future.exception() is None]
+        failed = [future.exception() for future in futures if future.exception() is not None]
+        if failed:
+            for item in parts:
+                if os.path.exists(item["zip_abs_path"]):
+                    os.remove(item["zip_abs_path"])
+            raise failed[0]
+
+    if incremental:
+        store_set_zip_manifest(db_name, set_rid, parts[0]["zip_abs_path"], entries, stats, methods, compression)
+    if reuse_plan:
+        inc_metric("zipfs_zip_reused_entries_total", len(reuse_plan), db=db_name)
+
+    archive_size = sum(item["size"] for item in parts)
+    observe_metric("zipfs_zip_assembly_seconds", time.perf_counter() - assembly_start, task="zip", db=db_name)
+    inc_metric("zipfs_entries_total", zipped_files, task="zip", db=db_name)
+    inc_metric("zipfs_bytes_read_total", source_bytes, task="zip", db=db_name)
+    inc_metric("zipfs_bytes_written_total", archive_size, task="zip", db=db_name)
+
+    result = {
+        "status": "success",
+        "zip_output_name": output_name,
+        "zipped_files": zipped_files,
+        "skipped_files": skipped_files,
+        "compression": compression,
+        "size": archive_size,
+        "reused_files": len(reuse_plan),
+        "entry_compression": [
+            {"name": arc_name, "method": method} for arc_name, method in zip(file_names, methods)
+        ],
+        "parts": parts,
+    }
+    if len(parts) == 1:
+        result.update(
+            zip_abs_path=parts[0]["zip_abs_path"],
+            zip_tmp_path=parts[0]["zip_tmp_path"],
+            digest=parts[0]["digest"],
+        )
+    return result
+
+
+class ZipEntry(NamedTuple):
+    """Compact central-directory record; attribute names mirror zipfile.ZipInfo."""
+
+    filename: str
+    header_offset: int
+    compress_size: int
+    file_size: int
+    CRC: int
+    compress_type: int
+    flag_bits: int
+
+    def is_dir(self) -> bool:
+        return self.filename.endswith('/')
+
+
+def get_state_dir(db_name: str, kind: str) -> str:
+    """Return (and create) a service-owned directory under data/<db>/zipfs."""
+    path = os.path.join(MD_ROOT, "data", db_name, "zipfs", kind)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def get_archive_key(zip_path: str) -> Tuple[str, int, int]:
+    """Identify an archive by resolved path, size and mtime."""
+    resolved = os.path.realpath(zip_path)
+    stat = os.stat(resolved)
+    return resolved, stat.st_size, stat.st_mtime_ns
+
+
+def read_zip_index(zip_path) -> List[ZipEntry]:
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        return [
+            ZipEntry(
+                info.filename,
+                info.header_offset,
+                info.compress_size,
+                info.file_size,
+                info.CRC,
+                info.compress_type,
+                info.flag_bits,
+            )
+            for info in zip_ref.infolist()
+        ]
+
+
+_index_cache: "OrderedDict[Tuple[str, int, int], List[ZipEntry]]" = OrderedDict()
+_index_cache_state = {"entries": 0}
+_index_cache_lock = threading.Lock()
+
+
+def _index_cache_get(key: Tuple[str, int, int]) -> Optional[List[ZipEntry]]:
+    with _index_cache_lock:
+        entries = _index_cache.get(key)
+        if entries is not None:
+            _index_cache.move_to_end(key)
+        return entries
+
+
+def _index_cache_put(key: Tuple[str, int, int], entries: List[ZipEntry]) -> None:
+    if len(entries) > INDEX_CACHE_MAX_ENTRIES:
+        return
+    with _index_cache_lock:
+        previous = _index_cache.pop(key, None)
+        if previous is not None:
+            _index_cache_state["entries"] -= len(previous)
+        _index_cache[key] = entries
+        _index_cache_state["entries"] += len(entries)
+        while _index_cache_state["entries"] > INDEX_CACHE_MAX_ENTRIES and _index_cache:
+            _, evicted = _index_cache.popitem(last=False)
+            _index_cache_state["entries"] -= len(evicted)
+
+
+def clear_index_cache() -> None:
+    with _index_cache_lock:
+        _index_cache.clear()
+        _index_cache_state["entries"] = 0
+
+
+def _index_file_path(db_name: str, key: Tuple[str, int, int]) -> str:
+    digest = hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+    return os.path.join(get_state_dir(db_name, "index"), digest + ".json")
+
+
+def _load_index_file(path: str, key: Tuple[str, int, int]) -> Optional[List[ZipEntry]]:
+    try:
+        with open(path, 'r', encoding="utf-8") as fh:
+            stored = json.load(fh)
+        if tuple(stored.get("key", ())) != key:
+            return None
+        entries = [ZipEntry(*row) for row in stored["entries"]]
+    except (OSError, ValueError, TypeError, KeyError):
+        return None
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return entries
+
+
+def _store_index_file(path: str, key: Tuple[str, int, int], entries: List[ZipEntry]) -> None:
+    partial = f"{path}.{uuid.uuid4().hex}.part"
+    try:
+        with open(partial, 'w', encoding="utf-8") as fh:
+            json.dump({"key": list(key), "entries": [list(entry) for entry in entries]}, fh, separators=(",", ":"))
+        os.replace(partial, path)
+    except OSError as exc:
+        log_event("warning", "index_cache_write_failed", path=path, error=str(exc))
+        if os.path.exists(partial):
+            os.remove(partial)
+        return
+
+    index_dir = os.path.dirname(path)
+    try:
+        files = [entry for entry in os.scandir(index_dir) if entry.name.endswith(".json")]
+    except OSError:
+        return
+    if len(files) <= INDEX_CACHE_DISK_MAX_FILES:
+        return
+    files.sort(key=lambda entry: entry.stat().st_mtime)
+    for entry in files[:len(files) - INDEX_CACHE_DISK_MAX_FILES]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def load_zip_index(zip_path: str, db_name: Optional[str] = None) -> List[ZipEntry]:
+    """Return central-directory records for zip_path, served from cache when unchanged.
+
+    Lookup order is the in-memory LRU, then the db's on-disk index, then a
+    real central-directory parse whose result fills both caches.
+    """
+    started = time.perf_counter()
+    key = get_archive_key(zip_path)
+    entries = _index_cache_get(key)
+    if entries is not None:
+        observe_metric("zipfs_index_load_seconds", time.perf_counter() - started, db=db_name, source="memory")
+        return entries
+
+    index_path = _index_file_path(db_name, key) if db_name else None
+    if index_path:
+        entries = _load_index_file(index_path, key)
+        if entries is not None:
+            _index_cache_put(key, entries)
+            observe_metric("zipfs_index_load_seconds", time.perf_counter() - started, db=db_name, source="disk")
+            return entries
+
+    entries = read_zip_index(zip_path)
+    _index_cache_put(key, entries)
+    if index_path:
+        _store_index_file(index_path, key, entries)
+    observe_metric("zipfs_index_load_seconds", time.perf_counter() - started, db=db_name, source="archive")
+    return entries
+
+
+class ZipStreamSink:
+    """Write-only sink for zipfile; having no seek() makes zipfile emit data descriptors."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self.pending = 0
+        self.written = 0
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self.pending += len(data)
+        self.written += len(data)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        self.pending = 0
+        return data
+
+
+def prepare_set_zip_stream(request_json: dict) -> Dict[str, Any]:
+    """Validate a streamed zip request and resolve its entries before any byte is sent."""
+    set_files = get_set_files(request_json)
+    compression = get_zip_compression(request_json)
+    entries, skipped_files = resolve_set_entries(set_files)
+    if len(entries) == 0:
+        raise HTTPException(404, "No valid files found to zip")
+    return {
+        "set_rid": get_set_rid(request_json),
+        "db_name": get_set_db_name(request_json, set_files),
+        "output_name": sanitize_zip_filename(request_json.get('zip_output_name'), "set"),
+        "entries": entries,
+        "compression": compression,
+        "skipped_files": skipped_files,
+    }
+
+
+def iter_set_zip_stream(plan: Dict[str, Any]) -> Iterator[bytes]:
+    """Generate the set zip on the fly without touching tmp.
+
+    Entries use data descriptors (sizes follow the data) and switch to ZIP64
+    when a source file or the archive grows past the classic limits.
+    """
+    sink = ZipStreamSink()
+    assembly_start = time.perf_counter()
+    source_bytes = 0
+    file_names = [arc_name for _, arc_name in plan["entries"]]
+    prefetcher = SetFilePrefetcher([abs_path for abs_path, _ in plan["entries"]])
+    with prefetcher, zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED, compresslevel=ZIP_COMPRESS_LEVEL) as archive:
+        for abs_path, arc_name in plan["entries"]:
+            # Auto mode samples each file as it comes up, not all of them before the first byte.
+            method = choose_entry_compression(abs_path, arc_name) if plan["compression"] == 'auto' else plan["compression"]
+            zinfo = zipfile.ZipInfo.from_file(abs_path, arcname=arc_name)
+            zinfo.compress_type = zipfile.ZIP_DEFLATED if method == 'deflate' else zipfile.ZIP_STORED
+            data = prefetcher.take()
+            src_file = io.BytesIO(data) if data is not None else open(abs_path, 'rb')
+            with src_file as src, archive.open(zinfo, 'w') as dst:
+                while True:
+                    chunk = src.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    source_bytes += len(chunk)
+                    if sink.pending >= COPY_CHUNK_SIZE:
+                        yield sink.drain()
+            if sink.pending:
+                yield sink.drain()
+        archive.writestr(
+            'README.txt',
+            build_set_readme(plan["set_rid"], file_names),
+            compress_type=zipfile.ZIP_STORED if plan["compression"] == 'stored' else zipfile.ZIP_DEFLATED,
+        )
+    yield sink.drain()
+    labels = {"task": "zip", "db": plan["db_name"]}
+    observe_metric("zipfs_zip_assembly_seconds", time.perf_counter() - assembly_start, **labels)
+    inc_metric("zipfs_entries_total", len(file_names), **labels)
+    inc_metric("zipfs_bytes_read_total", source_bytes, **labels)
+    inc_metric("zipfs_bytes_written_total", sink.written, **labels)
+
+
+def is_stream_delivery(request_json: dict) -> bool:
+    task = request_json.get('task')
+    params = task.get('params', {}) if isinstance(task, dict) else {}
+    delivery = params.get('delivery') if isinstance(params, dict) else None
+    return str(delivery or request_json.get('delivery') or '').strip().lower() == 'stream'
+
+
+# Per-entry cost added to the compressed size when balancing workers, so a
+# bucket of many tiny files is not treated as free.
+EXTRACT_ENTRY_OVERHEAD = 4096
+
+
+def partition_by_size(weights: List[int], buckets: int) -> List[List[int]]:
+    """Spread item indices over buckets, largest first onto the lightest bucket."""
+    bucket_count = max(1, min(buckets, len(weights)))
+    loads = [0] * bucket_count
+    result: List[List[int]] = [[] for _ in range(bucket_count)]
+    for index in sorted(range(len(weights)), key=lambda i: weights[i], reverse=True):
+        target = loads.index(min(loads))
+        result[target].append(index)
+        loads[target] += weights[index]
+    for bucket in result:
+        bucket.sort()
+    return [bucket for bucket in result if bucket]
+
+
+def get_entry_data_offset(fp, header_offset: int) -> int:
+    """Return the offset of entry data by reading its local file header."""
+    fp.seek(header_offset)
+    header = fp.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile("Bad magic number for file header")
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    return header_offset + zipfile.sizeFileHeader + name_length + extra_length
+
+
+def read_entry_data_offset(zip_path: str, header_offset: int) -> int:
+    """Open zip_path and return the data offset of the entry at header_offset; blocking."""
+    with open(zip_path, 'rb') as fp:
+        return get_entry_data_offset(fp, header_offset)
+
+
+def can_read_entry_raw(info: ZipEntry) -> bool:
+    """Entries we decode ourselves; anything else goes through zipfile."""
+    return not (info.flag_bits & 0x1) and info.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+
+
+def iter_entry_chunks(fp, info: ZipEntry, chunk_size: Optional[int] = None) -> Iterator[bytes]:
+    """Yield decompressed entry bytes from a raw archive handle and verify CRC/size.
+
+    chunk_size defaults to COPY_CHUNK_SIZE as set when called.
+    """
+    chunk_size = chunk_size or COPY_CHUNK_SIZE
+    fp.seek(get_entry_data_offset(fp, info.header_offset))
+    decompressor = zlib.decompressobj(-15) if info.compress_type == zipfile.ZIP_DEFLATED else None
+    remaining = info.compress_size
+    crc = 0
+    written = 0
+    pending = b""
+    while remaining > 0 or pending:
+        if not pending:
+            pending = fp.read(min(chunk_size, remaining))
+            if not pending:
+                raise zipfile.BadZipFile(f"Truncated data for file {info.filename!r}")
+            remaining -= len(pending)
+        if decompressor is None:
+            data, pending = pending, b""
+        else:
+            # Bound output per call so highly compressed entries cannot balloon memory.
+            data = decompressor.decompress(pending, chunk_size)
+            pending = decompressor.unconsumed_tail
+        if data:
+            written += len(data)
+            # Stop at the declared size, as zipfile does; admission and
+            # Content-Length were sized from it.
+            if written > info.file_size:
+                raise zipfile.BadZipFile(f"Data for file {info.filename!r} exceeds its declared size")
+            crc = zlib.crc32(data, crc)
+            yield data
+    if decompressor is not None:
+        data = decompressor.flush()
+        if data:
+            written += len(data)
+            if written > info.file_size:
+                raise zipfile.BadZipFile(f"Data for file {info.filename!r} exceeds its declared size")
+            crc = zlib.crc32(data, crc)
+            yield data
+    if written != info.file_size or crc != info.CRC:
+        raise zipfile.BadZipFile(f"Bad CRC-32 for file {info.filename!r}")
+
+
+# Errors meaning "this kernel/filesystem cannot do it", not a real I/O failure.
+_ZERO_COPY_UNSUPPORTED = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+_zero_copy_state = {"copy_file_range": hasattr(os, "copy_file_range"), "sendfile": hasattr(os, "sendfile")}
+
+
+def copy_file_region(src_fd: int, dst_fd: int, offset: int, count: int) -> None:
+    """Copy count bytes from src_fd at offset to the current position of dst_fd.
+
+    Prefers os.copy_file_range, then os.sendfile, then a buffered pread loop.
+    A method that reports itself unsupported is disabled for the process.
+    """
+    copied = 0
+    for method in ("copy_file_range", "sendfile"):
+        if not _zero_copy_state[method]:
+            continue
+        try:
+            while copied < count:
+                if method == "copy_file_range":
+                    sent = os.copy_file_range(src_fd, dst_fd, count - copied, offset + copied)
+                else:
+                    sent = os.sendfile(dst_fd, src_fd, offset + copied, count - copied)
+                if sent == 0:
+                    raise zipfile.BadZipFile("Truncated data in zip archive")
+                copied += sent
+            return
+        except OSError as exc:
+            if exc.errno not in _ZERO_COPY_UNSUPPORTED or copied:
+                raise
+            _zero_copy_state[method] = False
+
+    while copied < count:
+        data = os.pread(src_fd, min(COPY_CHUNK_SIZE, count - copied), offset + copied)
+        if not data:
+            raise zipfile.BadZipFile("Truncated data in zip archive")
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dst_fd, view):]
+        copied += len(data)
+
+
+def verify_region_crc(fd: int, offset: int, info: ZipEntry, hasher=None, check_crc: bool = True) -> None:
+    """Read a STORED entry's data region once, checking its CRC and feeding hasher."""
+    buffer = bytearray(min(COPY_CHUNK_SIZE, max(info.compress_size, 1)))
+    view = memoryview(buffer)
+    crc = 0
+    done = 0
+    while done < info.compress_size:
+        wanted = min(len(buffer), info.compress_size - done)
+        read = os.preadv(fd, [view[:wanted]], offset + done)
+        if not read:
+            raise zipfile.BadZipFile(f"Truncated data for file {info.filename!r}")
+        if check_crc:
+            crc = zlib.crc32(view[:read], crc)
+        if hasher is not None:
+            hasher.update(view[:read])
+        done += read
+    if check_crc and crc != info.CRC:
+        raise zipfile.BadZipFile(f"Bad CRC-32 for file {info.filename!r}")
+
+
+def copy_stored_entry(
+    fp,
+    info: ZipEntry,
+    dest_path: str,
+    verify_crc: bool = VERIFY_STORED_CRC,
+    hasher=None,
+) -> None:
+    """Copy a STORED entry straight from the archive data region to dest_path.
+
+    CRC check and digest share one read pass over the source region.
+    """
+    data_offset = get_entry_data_offset(fp, info.header_offset)
+    if info.compress_size != info.file_size:
+        raise zipfile.BadZipFile(f"Size mismatch for stored file {info.filename!r}")
+    with open(dest_path, 'wb') as dst:
+        copy_file_region(fp.fileno(), dst.fileno(), data_offset, info.compress_size)
+    if verify_crc or hasher is not None:
+        verify_region_crc(fp.fileno(), data_offset, info, hasher=hasher, check_crc=verify_crc)
+
+
+def select_zip_entries(infos: List[ZipEntry], allowed_extensions: Optional[tuple]) -> List[ZipEntry]:
+    selected = []
+    for item in infos:
+        if item.is_dir():
+            continue
+        base_name = os.path.basename(item.filename)
+        if not base_name:
+            continue
+        if allowed_extensions is None:
+            selected.append(item)
+        else:
+            ext = os.path.splitext(base_name)[1].lower().lstrip('.')
+            if ext in allowed_extensions:
+                selected.append(item)
+    return selected
+
+
+def is_nested_archive(item: ZipEntry) -> bool:
+    return os.path.splitext(item.filename)[1].lower().lstrip('.') in NESTED_ARCHIVE_EXTENSIONS
+
+
+def select_unzip_entries(
+    infos: List[ZipEntry], allowed_extensions: Optional[tuple], recursive: bool = False
+) -> Tuple[List[ZipEntry], List[ZipEntry]]:
+    """Split an index into files to extract and, in recursive mode, archives to expand."""
+    if not recursive:
+        return select_zip_entries(infos, allowed_extensions), []
+    nested = [item for item in select_zip_entries(infos, None) if is_nested_archive(item)]
+    files = [item for item in select_zip_entries(infos, allowed_extensions) if not is_nested_archive(item)]
+    return files, nested
+
+
+def extract_entry(fp, zip_path: str, info: ZipEntry, dest_path: str, fallback: Dict[str, Any], hasher=None) -> int:
+    """Write one entry to dest_path using the worker's own archive handle.
+
+    Returns the number of bytes written; hasher, when given, sees every byte.
+    """
+    if can_read_entry_raw(info) and info.compress_type == zipfile.ZIP_STORED:
+        copy_stored_entry(fp, info, dest_path, hasher=hasher)
+        return info.file_size
+    written = 0
+    with open(dest_path, 'wb') as dst:
+        if can_read_entry_raw(info):
+            chunks = iter_entry_chunks(fp, info)
+        else:
+            # Encrypted or exotic methods: let zipfile decode them on a lazily opened handle.
+            if fallback.get("zip") is None:
+                fallback["zip"] = zipfile.ZipFile(zip_path, 'r')
+            chunks = iter_zipfile_chunks(fallback["zip"], info.filename)
+        for chunk in chunks:
+            if hasher is not None:
+                hasher.update(chunk)
+            dst.write(chunk)
+            written += len(chunk)
+    return written
+
+
+def iter_zipfile_chunks(zip_ref: zipfile.ZipFile, name: str) -> Iterator[bytes]:
+    with zip_ref.open(zip_ref.getinfo(name), 'r') as src:
+        while True:
+            chunk = src.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def iter_any_entry_chunks(fp, zip_source, info: ZipEntry) -> Iterator[bytes]:
+    """Entry bytes via the raw reader, or zipfile on zip_source (path or file) for exotic entries."""
+    if can_read_entry_raw(info):
+        yield from iter_entry_chunks(fp, info)
+        return
+    with zipfile.ZipFile(zip_source, 'r') as zip_ref:
+        yield from iter_zipfile_chunks(zip_ref, info.filename)
+
+
+_LINK_FALLBACK_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EACCES}
+
+
+def link_or_copy(src: str, dest: str) -> bool:
+    """Hardlink src to dest, copying when the filesystem refuses. Returns True if linked."""
+    try:
+        os.link(src, dest)
+        return True
+    except OSError as exc:
+        if exc.errno not in _LINK_FALLBACK_ERRNOS:
+            raise
+    shutil.copyfile(src, dest)
+    return False
+
+
+def get_blob_dir(db_name: Optional[str], hash_algorithm: Optional[str]) -> Optional[str]:
+    if not DEDUP_STORE_ENABLED or not db_name or hash_algorithm is None:
+        return None
+    return get_state_dir(db_name, "blobs")
+
+
+def _blob_path(blob_dir: str, digest: str) -> str:
+    algorithm, hexdigest = digest.split(":", 1)
+    return os.path.join(blob_dir, hexdigest[:2], f"{algorithm}-{hexdigest}")
+
+
+def _blob_ref_path(blob_dir: str, archive_key: Tuple[str, int, int], info: ZipEntry, hash_algorithm: str) -> str:
+    ref = hashlib.sha1(json.dumps([list(archive_key), info.header_offset, hash_algorithm]).encode("utf-8")).hexdigest()
+    return os.path.join(os.path.dirname(blob_dir), "blob_refs", ref)
+
+
+def find_blob(
+    blob_dir: str, archive_key: Tuple[str, int, int], info: ZipEntry, hash_algorithm: str
+) -> Optional[Tuple[str, str]]:
+    """Return (blob path, digest) for an entry extracted before from this exact archive.
+
+    Blobs are named by content digest. The fast path that skips reading the
+    entry is keyed on archive identity (path, size, mtime) and the entry's
+    header offset, never on CRC and size, which collide across archives.
+    """
+    try:
+        with open(_blob_ref_path(blob_dir, archive_key, info, hash_algorithm), 'r', encoding="utf-8") as fh:
+            digest = fh.read().strip()
+        blob_path = _blob_path(blob_dir, digest)
+        if os.path.getsize(blob_path) != info.file_size:
+            return None
+    except (OSError, ValueError):
+        return None
+    return blob_path, digest
+
+
+def add_blob(
+    blob_dir: str, archive_key: Tuple[str, int, int], info: ZipEntry, source_path: str, digest: str
+) -> bool:
+    """Store a freshly extracted file by digest and remember which entry produced it.
+
+    When a blob with the same digest already exists, source_path is replaced
+    by a link to it and True is returned. Skipped when links are not possible.
+    """
+    blob_path = _blob_path(blob_dir, digest)
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    deduplicated = False
+    try:
+        try:
+            os.link(source_path, blob_path)
+        except FileExistsError:
+            partial = f"{source_path}.{uuid.uuid4().hex}.link"
+            os.link(blob_path, partial)
+            os.replace(partial, source_path)
+            os.utime(blob_path)
+            deduplicated = True
+    except OSError as exc:
+        if exc.errno in _LINK_FALLBACK_ERRNOS:
+            return False
+        raise
+    ref_path = _blob_ref_path(blob_dir, archive_key, info, digest.split(":", 1)[0])
+    os.makedirs(os.path.dirname(ref_path), exist_ok=True)
+    partial = f"{ref_path}.{uuid.uuid4().hex}.part"
+    with open(partial, 'w', encoding="utf-8") as fh:
+        fh.write(digest)
+    os.replace(partial, ref_path)
+    return deduplicated
+
+
+_blob_prune_state: Dict[str, float] = {}
+
+
+def prune_blob_store(db_name: str, max_bytes: int = DEDUP_STORE_MAX_BYTES, max_age_sec: int = DEDUP_STORE_MAX_AGE_SEC) -> int:
+    """Remove unreferenced blobs by age, then least recently used over max_bytes.
+
+    A blob whose link count is above one is still linked from tmp and is
+    never removed. Returns the number of blobs removed.
+    """
+    blob_dir = os.path.join(MD_ROOT, "data", db_name, "zipfs", "blobs")
+    if not os.path.isdir(blob_dir):
+        return 0
+    now = time.time()
+    unreferenced = []
+    for bucket in os.scandir(blob_dir):
+        if not bucket.is_dir():
+            continue
+        for blob in os.scandir(bucket.path):
+            try:
+                stat = blob.stat()
+            except OSError:
+                continue
+            if stat.st_nlink <= 1:
+                unreferenced.append((stat.st_mtime, stat.st_size, blob.path))
+
+    # Entry refs only speed up lookups; drop those not used within max_age_sec.
+    refs_dir = os.path.join(MD_ROOT, "data", db_name, "zipfs", "blob_refs")
+    if os.path.isdir(refs_dir):
+        for ref in os.scandir(refs_dir):
+            try:
+                if now - ref.stat().st_mtime > max_age_sec:
+                    os.remove(ref.path)
+            except OSError:
+                continue
+
+    unreferenced.sort()
+    total = sum(size for _, size, _ in unreferenced)
+    removed = 0
+    for mtime, size, path in unreferenced:
+        if total <= max_bytes and now - mtime <= max_age_sec:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+    return removed
+
+
+def maybe_prune_blob_store(db_name: Optional[str]) -> None:
+    if not DEDUP_STORE_ENABLED or not db_name:
+        return
+    now = time.time()
+    if now - _blob_prune_state.get(db_name, 0.0) < DEDUP_PRUNE_INTERVAL_SEC:
+        return
+    _blob_prune_state[db_name] = now
+    try:
+        removed = prune_blob_store(db_name)
+    except OSError as exc:
+        log_event("warning", "dedup_prune_failed", db_name=db_name, error=str(exc))
+        return
+    if removed:
+        log_event("info", "dedup_pruned", db_name=db_name, removed=removed)
+
+
+_tmp_gc_lock = threading.Lock()
+# Absolute .part paths being written right now; the GC never touches them.
+_active_tmp_writes: set = set()
+
+
+def _tmp_journal_path(db_name: str) -> str:
+    return os.path.join(get_state_dir(db_name, "tmp_gc"), "tracked")
+
+
+def track_tmp_file(db_name: str, name: str) -> None:
+    """Record a tmp output without the zipfs_ prefix (e.g. a set zip) for the GC."""
+    with _tmp_gc_lock:
+        with open(_tmp_journal_path(db_name), 'a', encoding='utf-8') as journal:
+            journal.write(name + "\n")
+
+
+def _read_tmp_journal(path: str) -> List[str]:
+    try:
+        with open(path, 'r', encoding='utf-8') as journal:
+            return [line.rstrip("\n") for line in journal if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def gc_tmp_dir(db_name: str, now: Optional[float] = None) -> Dict[str, int]:
+    """Run one GC pass over data/<db>/tmp and return removal counts by reason.
+
+    Only files this service wrote are candidates: zipfs_* extractions, set
+    zips from the journal, stale .part files of our own (.zipfs_* or
+    journaled), stale checkpoints and set-zip
+    manifests older than ZIP_MANIFEST_MAX_AGE_SEC. At most TMP_GC_MAX_REMOVALS
+    files go per pass; the rest wait for the next one.
+    """
+    tmp_root = os.path.join(MD_ROOT, "data", db_name, "tmp")
+    if not os.path.isdir(tmp_root):
+        return {}
+    now = time.time() if now is None else now
+    journal_path = _tmp_journal_path(db_name)
+    with _tmp_gc_lock:
+        journal_names = set(_read_tmp_journal(journal_path))
+
+    removals: List[Tuple[str, str]] = []
+    tracked: List[Tuple[float, int, str]] = []
+    with os.scandir(tmp_root) as items:
+        for item in items:
+            try:
+                if not item.is_file(follow_symlinks=False):
+                    continue
+                stat = item.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if item.name.endswith(".part"):
+                own = item.name.startswith(".zipfs_") or item.name in journal_names
+                if own and item.path not in _active_tmp_writes and now - stat.st_mtime > TMP_GC_PART_GRACE_SEC:
+                    removals.append((item.path, "orphan_part"))
+            elif item.name.startswith("zipfs_") or item.name in journal_names:
+                # Last use is the later of write time and (relatime) read time.
+                tracked.append((max(stat.st_atime, stat.st_mtime), stat.st_size, item.path))
+
+    tracked.sort()
+    total = sum(size for _, size, _ in tracked)
+    for last_used, size, path in tracked:
+        if now - last_used > TMP_MAX_AGE_SEC:
+            removals.append((path, "age"))
+        elif TMP_QUOTA_BYTES > 0 and total > TMP_QUOTA_BYTES:
+            removals.append((path, "quota"))
+        else:
+            break
+        total -= size
+
+    # Checkpoints of unzips that were never redelivered.
+    checkpoint_dir = os.path.join(MD_ROOT, "data", db_name, "zipfs", "checkpoints")
+    if os.path.isdir(checkpoint_dir):
+        with os.scandir(checkpoint_dir) as items:
+            for item in items:
+                try:
+                    if now - item.stat().st_mtime > TMP_MAX_AGE_SEC:
+                        removals.append((item.path, "checkpoint"))
+                except OSError:
+                    continue
+
+    # Set-zip manifests and retained archives of sets not zipped for a while.
+    manifest_dir = os.path.join(MD_ROOT, "data", db_name, "zipfs", "manifests")
+    if os.path.isdir(manifest_dir):
+        with os.scandir(manifest_dir) as items:
+            for item in items:
+                try:
+                    if now - item.stat().st_mtime > ZIP_MANIFEST_MAX_AGE_SEC:
+                        removals.append((item.path, "manifest"))
+                except OSError:
+                    continue
+
+    removed: Dict[str, int] = {}
+    for path, reason in removals[:TMP_GC_MAX_REMOVALS]:
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        removed[reason] = removed.get(reason, 0) + 1
+        inc_metric("zipfs_tmp_gc_removed_total", db=db_name, reason=reason)
+
+    if journal_names:
+        with _tmp_gc_lock:
+            # Re-read under the lock so names appended during the pass are kept.
+            alive = [name for name in _read_tmp_journal(journal_path) if os.path.exists(os.path.join(tmp_root, name))]
+            compacted = journal_path + ".tmp"
+            with open(compacted, 'w', encoding='utf-8') as journal:
+                journal.writelines(name + "\n" for name in dict.fromkeys(alive))
+            os.replace(compacted, journal_path)
+    return removed
+
+
+async def run_tmp_gc_loop() -> None:
+    """Background task started by the app lifespan; one db per executor call."""
+    loop = asyncio.get_running_loop()
+    data_root = os.path.join(MD_ROOT, "data")
+    while True:
+        await asyncio.sleep(TMP_GC_INTERVAL_SEC)
+        try:
+            db_names = sorted(name for name in os.listdir(data_root) if os.path.isdir(os.path.join(data_root, name, "tmp")))
+        except OSError:
+            continue
+        for db_name in db_names:
+            try:
+                removed = await loop.run_in_executor(None, gc_tmp_dir, db_name)
+            except Exception as exc:
+                log_event("warning", "tmp_gc_failed", db_name=db_name, error=str(exc))
+                continue
+            if removed:
+                log_event("info", "tmp_gc", db_name=db_name, **removed)
+
+
+def remove_tmp_outputs(tmp_root: str, descriptors: List[Dict[str, Any]]) -> None:
+    for descriptor in descriptors:
+        try:
+            os.remove(os.path.join(tmp_root, descriptor["path"]))
+        except OSError:
+            pass
+
+
+def file_crc32(path: str) -> int:
+    crc = 0
+    with open(path, 'rb') as src:
+        while True:
+            chunk = src.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                return crc
+            crc = zlib.crc32(chunk, crc)
+
+
+class ExtractCheckpoint:
+    """Append-only journal of finished entries of one unzip, for resuming after a restart.
+
+    The first line identifies the job (process rid, archive key and the
+    options that decide which entries are selected and how descriptors look);
+    each further line records an entry index, its CRC and its descriptor.
+    """
+
+    def __init__(self, path: str, header: Dict[str, Any]):
+        self.path = path
+        self.header = header
+        self._lock = threading.Lock()
+        self._journal = None
+
+    @classmethod
+    def for_job(
+        cls,
+        db_name: str,
+        process_rid: str,
+        archive_key: Tuple[str, int, int],
+        allowed_extensions: Optional[tuple],
+        hash_algorithm: Optional[str],
+    ) -> "ExtractCheckpoint":
+        header = json.loads(json.dumps({
+            "process_rid": process_rid,
+            "archive": archive_key,
+            "allowed_extensions": sorted(allowed_extensions) if allowed_extensions is not None else None,
+            "hash": hash_algorithm,
+        }))
+        digest = hashlib.sha1(json.dumps(header, sort_keys=True).encode("utf-8")).hexdigest()
+        return cls(os.path.join(get_state_dir(db_name, "checkpoints"), digest + ".jsonl"), header)
+
+    def _load(self) -> Dict[int, Dict[str, Any]]:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as journal:
+                lines = journal.read().splitlines()
+        except FileNotFoundError:
+            return {}
+        records: Dict[int, Dict[str, Any]] = {}
+        try:
+            if not lines or json.loads(lines[0]) != self.header:
+                return {}
+            for line in lines[1:]:
+                record = json.loads(line)
+                records[record["index"]] = record
+        except (ValueError, KeyError, TypeError):
+            pass  # a line cut short by the crash ends the usable part
+        return records
+
+    def resume(self, tmp_root: str, entries: List[ZipEntry]) -> Dict[int, Dict[str, Any]]:
+        """Return verified descriptors by entry index and restart the journal with them.
+
+        An output is reused only if it still exists with the entry's size and
+        CRC; anything else is extracted again.
+        """
+        def verify(record: Dict[str, Any]) -> bool:
+            index = record["index"]
+            if not isinstance(index, int) or not 0 <= index < len(entries) or record.get("crc") != entries[index].CRC:
+                return False
+            path = os.path.join(tmp_root, record["descriptor"]["path"])
+            try:
+                return os.path.getsize(path) == entries[index].file_size and file_crc32(path) == entries[index].CRC
+            except OSError:
+                return False
+
+        records = list(self._load().values())
+        checks = list(get_extract_executor().map(verify, records)) if records else []
+        reused = {record["index"]: record for record, ok in zip(records, checks) if ok}
+        remove_tmp_outputs(tmp_root, [record["descriptor"] for record, ok in zip(records, checks) if not ok])
+
+        partial = self.path + ".tmp"
+        with open(partial, 'w', encoding='utf-8') as journal:
+            journal.write(json.dumps(self.header) + "\n")
+            for record in reused.values():
+                journal.write(json.dumps(record) + "\n")
+        os.replace(partial, self.path)
+        self._journal = open(self.path, 'a', encoding='utf-8')
+        if reused:
+            log_event("info", "checkpoint_resumed", checkpoint=os.path.basename(self.path), reused=len(reused))
+        return {index: record["descriptor"] for index, record in reused.items()}
+
+    def record(self, index: int, crc: int, descriptor: Dict[str, Any]) -> None:
+        line = json.dumps({"index": index, "crc": crc, "descriptor": descriptor}) + "\n"
+        with self._lock:
+            # Flushed to the OS per entry; that survives a container restart.
+            self._journal.write(line)
+            self._journal.flush()
+
+    def close(self) -> None:
+        """Drop the journal once the job has finished or failed for good."""
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def extract_entries_worker(
+    zip_path: str,
+    tmp_root: str,
+    entries: List[Tuple[int, ZipEntry]],
+    stop: threading.Event,
+    hash_algorithm: Optional[str] = None,
+    blob_dir: Optional[str] = None,
+    control: Optional[JobControl] = None,
+    on_file=None,
+    collect: bool = True,
+    db_name: Optional[str] = None,
+    checkpoint: Optional[ExtractCheckpoint] = None,
+) -> List[Tuple[int, Dict[str, Any]]]:
+    """Extract a bucket of entries sequentially on a private archive handle.
+
+    With collect=False descriptors are only passed to on_file and not kept,
+    and files already handed out are left in place if a later entry fails.
+    """
+    results: List[Tuple[int, Dict[str, Any]]] = []
+    fallback: Dict[str, Any] = {}
+    dest_path = None
+    archive_key = get_archive_key(zip_path) if blob_dir else None
+    try:
+        with open(zip_path, 'rb') as fp:
+            for index, info in entries:
+                if stop.is_set():
+                    break
+                if control is not None:
+                    control.check_cancelled()
+                entry_start = time.perf_counter()
+                safe_name = os.path.basename(info.filename)
+                tmp_filename = f"zipfs_{uuid.uuid4().hex}_{safe_name}"
+                dest_path = os.path.join(tmp_root, tmp_filename)
+                blob = find_blob(blob_dir, archive_key, info, hash_algorithm) if blob_dir else None
+                deduplicated = blob is not None
+                if blob is not None:
+                    link_or_copy(blob[0], dest_path)
+                    os.utime(blob[0])
+                    size, digest = info.file_size, blob[1]
+                else:
+                    hasher = new_content_hasher(hash_algorithm)
+                    size = extract_entry(fp, zip_path, info, dest_path, fallback, hasher=hasher)
+                    digest = format_digest(hash_algorithm, hasher) if hasher is not None else None
+                    if blob_dir and digest:
+                        deduplicated = add_blob(blob_dir, archive_key, info, dest_path, digest)
+                    inc_metric("zipfs_bytes_read_total", info.compress_size, task="unzip", db=db_name)
+                dest_path = None
+                elapsed = time.perf_counter() - entry_start
+                inc_metric("zipfs_entries_total", task="unzip", db=db_name)
+                inc_metric("zipfs_bytes_written_total", size, task="unzip", db=db_name)
+                if size and elapsed > 0:
+                    observe_metric("zipfs_entry_throughput_bytes_per_second", size / elapsed, task="unzip", db=db_name)
+
+                ext = os.path.splitext(safe_name)[1].lower().lstrip('.')
+                descriptor = {
+                    "path": tmp_filename,
+                    "label": safe_name,
+                    "type": infer_file_type(safe_name),
+                    "extension": ext or "bin",
+                    "size": size,
+                }
+                if digest:
+                    descriptor["digest"] = digest
+                if deduplicated:
+                    descriptor["deduplicated"] = True
+                if collect:
+                    results.append((index, descriptor))
+                if checkpoint is not None:
+                    checkpoint.record(index, info.CRC, descriptor)
+                if control is not None:
+                    control.advance(1, size)
+                if on_file is not None:
+                    on_file(descriptor)
+    except BaseException:
+        stop.set()
+        if dest_path and os.path.exists(dest_path):
+            os.remove(dest_path)
+        remove_tmp_outputs(tmp_root, [descriptor for _, descriptor in results])
+        raise
+    finally:
+        if fallback.get("zip") is not None:
+            fallback["zip"].close()
+    return results
+
+
+def write_tmp_file(
+    tmp_root: str,
+    name: str,
+    label: str,
+    chunks: Iterator[bytes],
+    hash_algorithm: Optional[str] = None,
+    db_name: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Write streamed member bytes to a new zipfs_* file in tmp and return its descriptor.
+
+    For sources without random access (inner archives, tar streams); the
+    partial file is removed if the stream fails.
+    """
+    started = time.perf_counter()
+    safe_name = os.path.basename(name)
+    tmp_filename = f"zipfs_{uuid.uuid4().hex}_{safe_name}"
+    dest_path = os.path.join(tmp_root, tmp_filename)
+    hasher = new_content_hasher(hash_algorithm)
+    size = 0
+    try:
+        with open(dest_path, 'wb') as dst:
+            for chunk in chunks:
+                if hasher is not None:
+                    hasher.update(chunk)
+                dst.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        raise
+    ext = os.path.splitext(safe_name)[1].lower().lstrip('.')
+    descriptor = {
+        "path": tmp_filename,
+        "label": label,
+        "type": infer_file_type(safe_name),
+        "extension": ext or "bin",
+        "size": size,
+    }
+    if hasher is not None:
+        descriptor["digest"] = format_digest(hash_algorithm, hasher)
+    elapsed = time.perf_counter() - started
+    inc_metric("zipfs_entries_total", task="unzip", db=db_name)
+    inc_metric("zipfs_bytes_written_total", size, task="unzip", db=db_name)
+    if size and elapsed > 0:
+        observe_metric("zipfs_entry_throughput_bytes_per_second", size / elapsed, task="unzip", db=db_name)
+    return descriptor
+
+
+class NestedExtraction:
+    """Options and shared limits while expanding archives found inside an archive.
+
+    Inner archives are opened in place from a spool (in memory when small)
+    and never written to tmp themselves. Their files get labels carrying the
+    inner path, e.g. "bundle/inner.zip/docs/a.txt".
+    """
+
+    def __init__(
+        self,
+        tmp_root: str,
+        allowed_extensions: Optional[tuple],
+        hash_algorithm: Optional[str] = None,
+        control: Optional[JobControl] = None,
+        on_file=None,
+        db_name: Optional[str] = None,
+    ):
+        self.tmp_root = tmp_root
+        self.allowed_extensions = allowed_extensions
+        self.hash_algorithm = hash_algorithm
+        self.control = control
+        self.on_file = on_file
+        self.db_name = db_name
+        self.stop = threading.Event()
+        self.bytes_used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, nbytes: int) -> None:
+        with self._lock:
+            if self.bytes_used + nbytes > NESTED_MAX_TOTAL_BYTES:
+                raise HTTPException(413, f"Nested archives expand beyond {NESTED_MAX_TOTAL_BYTES} bytes")
+            self.bytes_used += nbytes
+
+    def expand(self, fp, zip_source, info: ZipEntry, label_prefix: str, depth: int, written: List[Dict[str, Any]]) -> None:
+        """Extract the files of the archive stored in entry info, appending descriptors to written."""
+        label = label_prefix + info.filename
+        self.reserve(info.file_size)
+        # The zipfs_ prefix lets the tmp GC collect a spool left behind by a crash.
+        with tempfile.SpooledTemporaryFile(
+            max_size=NESTED_SPOOL_MEMORY_BYTES, prefix="zipfs_spool_", dir=self.tmp_root
+        ) as spool:
+            for chunk in iter_any_entry_chunks(fp, zip_source, info):
+                spool.write(chunk)
+            spool.seek(0)
+            try:
+                index = read_zip_index(spool)
+            except zipfile.BadZipFile:
+                raise HTTPException(400, f"Invalid or corrupted nested zip file: {label}")
+            files, nested = select_unzip_entries(index, self.allowed_extensions, depth < NESTED_MAX_DEPTH)
+            if self.control is not None:
+                self.control.add_totals(len(files), sum(item.file_size for item in files))
+            for item in files:
+                if self.stop.is_set():
+                    return
+                if self.control is not None:
+                    self.control.check_cancelled()
+                self.reserve(item.file_size)
+                written.append(self._write_file(spool, item, label + "/" + item.filename))
+            for item in nested:
+                self.expand(spool, spool, item, label + "/", depth + 1, written)
+
+    def _write_file(self, spool, item: ZipEntry, label: str) -> Dict[str, Any]:
+        descriptor = write_tmp_file(
+            self.tmp_root, item.filename, label, iter_any_entry_chunks(spool, spool, item), self.hash_algorithm, self.db_name
+        )
+        if self.control is not None:
+            self.control.advance(1, descriptor["size"])
+        if self.on_file is not None:
+            self.on_file(descriptor)
+        return descriptor
+
+    def expand_top_level(self, zip_path: str, info: ZipEntry) -> List[Dict[str, Any]]:
+        written: List[Dict[str, Any]] = []
+        try:
+            with open(zip_path, 'rb') as fp:
+                self.expand(fp, zip_path, info, "", 1, written)
+        except BaseException:
+            self.stop.set()
+            remove_tmp_outputs(self.tmp_root, written)
+            raise
+        return written
+
+
+def expand_nested_archives(zip_path: str, nested: List[ZipEntry], context: NestedExtraction) -> List[Dict[str, Any]]:
+    """Expand top-level inner archives in parallel on the extract pool; results keep entry order."""
+    if len(nested) == 1:
+        return context.expand_top_level(zip_path, nested[0])
+    executor = get_extract_executor()
+    futures = [executor.submit(context.expand_top_level, zip_path, info) for info in nested]
+    results: List[Dict[str, Any]] = []
+    outputs: List[List[Dict[str, Any]]] = []
+    first_error: Optional[BaseException] = None
+    for future in futures:
+        try:
+            outputs.append(future.result())
+        except BaseException as exc:
+            if first_error is None:
+                first_error = exc
+    if first_error is not None:
+        for written in outputs:
+            remove_tmp_outputs(context.tmp_root, written)
+        raise first_error
+    for written in outputs:
+        results.extend(written)
+    return results
+
+
+def find_zip_entry(index: List[ZipEntry], name: str) -> Optional[ZipEntry]:
+    for item in index:
+        if item.filename == name and not item.is_dir():
+            return item
+    return None
+
+
+def parse_range_header(value: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single "bytes=" range into inclusive (start, end).
+
+    Returns None when the header is absent or not a single byte range, so
+    the caller serves the whole entry. Raises 416 for unsatisfiable ranges.
+    """
+    if not value or not value.strip().lower().startswith("bytes="):
+        return None
+    spec = value.strip()[6:].strip()
+    if "," in spec or "-" not in spec:
+        return None
+    start_text, end_text = (part.strip() for part in spec.split("-", 1))
+    try:
+        if start_text:
+            start = int(start_text)
+            end = int(end_text) if end_text else size - 1
+        else:
+            suffix = int(end_text)
+            if suffix <= 0:
+                raise ValueError
+            start = max(size - suffix, 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        raise HTTPException(416, "Requested range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    if start > end:
+        return None
+    return start, min(end, size - 1)
+
+
+def iter_file_region(path: str, offset: int, length: int) -> Iterator[bytes]:
+    with open(path, 'rb') as fp:
+        fd = fp.fileno()
+        done = 0
+        while done < length:
+            chunk = os.pread(fd, min(COPY_CHUNK_SIZE, length - done), offset + done)
+            if not chunk:
+                raise zipfile.BadZipFile("Truncated data in zip archive")
+            done += len(chunk)
+            yield chunk
+
+
+def iter_zip_entry(zip_path: str, entry: ZipEntry) -> Iterator[bytes]:
+    if can_read_entry_raw(entry):
+        with open(zip_path, 'rb') as fp:
+            yield from iter_entry_chunks(fp, entry)
+        return
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        yield from iter_zipfile_chunks(zip_ref, entry.filename)
+
+
+def is_recursive_unzip(request_json: dict) -> bool:
+    task = request_json.get('task')
+    params = task.get('params', {}) if isinstance(task, dict) else {}
+    value = params.get('recursive') if isinstance(params, dict) else None
+    if value is None:
+        value = request_json.get('recursive')
+    return value is True or str(value).strip().lower() in ("1", "true", "yes", "on")
+
+
+def is_ndjson_response(request_json: dict) -> bool:
+    task = request_json.get('task')
+    params = task.get('params', {}) if isinstance(task, dict) else {}
+    mode = params.get('response_mode') if isinstance(params, dict) else None
+    return str(mode or request_json.get('response_mode') or '').strip().lower() == 'ndjson'
+
+
+def iter_ndjson_extraction(
+    task_id: str,
+    start_time: float,
+    extract_kwargs: Dict[str, Any],
+    on_close=None,
+    extract=None,
+    on_summary=None,
+) -> Iterator[bytes]:
+    """Run an extraction in the job pool and yield one NDJSON record per file.
+
+    File records are emitted as entries land in tmp (completion order), then
+    one summary record. A bounded queue applies backpressure to extraction;
+    if the client goes away the extraction is cancelled between entries.
+    on_close is called once the extraction thread has finished, on_summary
+    with the summary status. extract defaults to extract_zip_to_tmp.
+    """
+    extract = extract or extract_zip_to_tmp
+    records: "queue.Queue[Tuple[str, Dict[str, Any]]]" = queue.Queue(maxsize=NDJSON_QUEUE_SIZE)
+    control = JobControl()
+
+    def emit(kind: str, payload: Dict[str, Any]) -> None:
+        while True:
+            try:
+                records.put((kind, payload), timeout=0.5)
+                return
+            except queue.Full:
+                control.check_cancelled()
+
+    def run() -> None:
+        try:
+            extract(
+                **extract_kwargs,
+                control=control,
+                on_file=lambda descriptor: emit("file", descriptor),
+                collect=False,
+            )
+            emit("summary", {"status": "success"})
+        except JobCancelled:
+            pass
+        except HTTPException as exc:
+            emit("summary", {"status": "failed", "error": {"status_code": exc.status_code, "detail": exc.detail}})
+        except Exception as exc:
+            emit("summary", {"status": "failed", "error": {"status_code": 500, "detail": str(exc)}})
+        finally:
+            if on_close is not None:
+                on_close()
+
+    get_job_executor().submit(run)
+    try:
+        while True:
+            kind, payload = records.get()
+            if kind == "file":
+                yield (json.dumps({"record": "file", **payload}) + "\n").encode("utf-8")
+                continue
+            progress = control.snapshot()
+            summary = {
+                "record": "summary",
+                "task": task_id,
+                "total_files": progress["entries_done"],
+                "bytes_written": progress["bytes_written"],
+                "execution_time": round(time.time() - start_time, 1),
+                **payload,
+            }
+            log_event(
+                "info" if payload["status"] == "success" else "warning",
+                "process_summary",
+                status=payload["status"],
+                total_files=progress["entries_done"],
+                duration_sec=round(time.time() - start_time, 3),
+                response_mode="ndjson",
+            )
+            if on_summary is not None:
+                on_summary(payload["status"])
+            yield (json.dumps(summary) + "\n").encode("utf-8")
+            return
+    finally:
+        control.cancel_event.set()
+
+
+async def iter_admitted_ndjson(
+    admission: Tuple[int, str],
+    task_id: str,
+    start_time: float,
+    extract_kwargs,
+    extract=None,
+    metric_labels: Optional[Dict[str, str]] = None,
+):
+    """Reserve admission when the body starts, then stream iter_ndjson_extraction.
+
+    Acquiring inside the body means a response whose body never starts holds
+    nothing. A rejection arrives as a failed summary record carrying 503.
+    The request outcome is counted here from the summary record; a body
+    abandoned before its summary counts as cancelled.
+    """
+    admit_bytes, tmp_root = admission
+    outcome = {"status": "failed"}
+    records = None
+    try:
+        try:
+            await _admission.acquire(admit_bytes, tmp_root)
+        except HTTPException as exc:
+            yield (json.dumps({
+                "record": "summary",
+                "task": task_id,
+                "total_files": 0,
+                "bytes_written": 0,
+                "execution_time": round(time.time() - start_time, 1),
+                "status": "failed",
+                "error": {"status_code": exc.status_code, "detail": exc.detail},
+            }) + "\n").encode("utf-8")
+            return
+        outcome["status"] = "cancelled"
+        records = iter_ndjson_extraction(
+            task_id,
+            start_time,
+            extract_kwargs,
+            on_close=functools.partial(_admission.release_threadsafe, admit_bytes),
+            extract=extract,
+            on_summary=lambda status: outcome.update(status=status),
+        )
+        while True:
+            chunk = await run_in_threadpool(next, records, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        if records is not None:
+            # Once started, the extraction thread releases through on_close.
+            if inspect.getgeneratorstate(records) == inspect.GEN_CREATED:
+                await _admission.release(admit_bytes)
+            records.close()
+        labels = metric_labels or {}
+        inc_metric("zipfs_requests_total", status=outcome["status"], **labels)
+        observe_metric("zipfs_request_duration_seconds", time.time() - start_time, **labels)
+
+
+def get_unzip_admission_bytes(
+    zip_path: str, db_name: Optional[str], allowed_extensions: Optional[tuple], recursive: bool = False
+) -> int:
+    """Uncompressed bytes an unzip of the matching entries will write to tmp.
+
+    Inner archives count with their own size; what they expand to is bounded
+    by NESTED_MAX_TOTAL_BYTES instead.
+    """
+    try:
+        index = load_zip_index(zip_path, db_name)
+    except zipfile.BadZipFile:
+        raise HTTPException(400, "Invalid or corrupted zip file")
+    files, nested = select_unzip_entries(index, allowed_extensions, recursive)
+    return sum(item.file_size for item in files + nested)
+
+
+def get_set_zip_admission(request_json: dict) -> Tuple[int, str]:
+    """Source bytes of a set zip (an upper bound for a stored archive) and its tmp root."""
+    set_files = get_set_files(request_json)
+    tmp_root = os.path.join(MD_ROOT, "data", get_set_db_name(request_json, set_files), "tmp")
+    os.makedirs(tmp_root, exist_ok=True)
+    entries, _ = resolve_set_entries(set_files)
+    return sum(os.path.getsize(abs_path) for abs_path, _ in entries), tmp_root
+
+
+def list_zip_contents(zip_path: str, db_name: Optional[str] = None) -> Dict[str, Any]:
+    """Describe archive files from the central directory without reading entry data."""
+    try:
+        index = load_zip_index(zip_path, db_name)
+    except zipfile.BadZipFile:
+        raise HTTPException(400, "Invalid or corrupted zip file")
+
+    entries: List[Dict[str, Any]] = []
+    extensions: Dict[str, Dict[str, int]] = {}
+    total_size = 0
+    total_compressed = 0
+    for item in index:
+        if item.is_dir():
+            continue
+        base_name = os.path.basename(item.filename)
+        if not base_name:
+            continue
+        ext = os.path.splitext(base_name)[1].lower().lstrip('.') or "bin"
+        entries.append(
+            {
+                "name": item.filename,
+                "label": base_name,
+                "size": item.file_size,
+                "compressed_size": item.compress_size,
+                "ratio": round(item.compress_size / item.file_size, 3) if item.file_size else 1.0,
+                "type": infer_file_type(base_name),
+                "extension": ext,
+            }
+        )
+        totals = extensions.setdefault(ext, {"count": 0, "size": 0, "compressed_size": 0})
+        totals["count"] += 1
+        totals["size"] += item.file_size
+        totals["compressed_size"] += item.compress_size
+        total_size += item.file_size
+        total_compressed += item.compress_size
+
+    return {
+        "entries": entries,
+        "extensions": extensions,
+        "total_entries": len(entries),
+        "total_size": total_size,
+        "total_compressed_size": total_compressed,
+    }
+
+
+def extract_zip_to_tmp(
+    zip_path: str,
+    tmp_root: str,
+    allowed_extensions: Optional[tuple],
+    process_rid: Optional[str] = None,
+    db_name: Optional[str] = None,
+    hash_algorithm: Optional[str] = None,
+    control: Optional[JobControl] = None,
+    on_file=None,
+    collect: bool = True,
+    recursive: bool = False,
+) -> List[Dict[str, Any]]:
+    """Extract matching zip entries to tmp_root and return disk file descriptors.
+
+    Entries come from the cached central-directory index and are spread over
+    EXTRACT_WORKERS threads by compressed size; each worker reads through
+    its own file handle. on_file is called from worker threads as each file
+    lands in tmp. Returned descriptors keep central-directory order; with
+    collect=False nothing is kept and an empty list is returned. Blocking;
+    callers on the event loop should go through run_in_worker.
+
+    Large jobs with a process rid keep a checkpoint (see ExtractCheckpoint):
+    a redelivered message reuses verified outputs of the interrupted run and
+    extracts only the remaining entries. With recursive=True inner archives
+    are expanded after the outer files (see NestedExtraction) and are not
+    checkpointed.
+    """
+    checkpoint: Optional[ExtractCheckpoint] = None
+    reused: Dict[int, Dict[str, Any]] = {}
+    succeeded = False
+    nested_outputs: List[Dict[str, Any]] = []
+    try:
+        allowed_files, nested = select_unzip_entries(load_zip_index(zip_path, db_name), allowed_extensions, recursive)
+
+        if len(allowed_files) == 0 and len(nested) == 0:
+            raise HTTPException(404, "No files matching allowed extensions found in zip")
+        if control is not None:
+            control.set_totals(len(allowed_files), sum(info.file_size for info in allowed_files))
+
+        if CHECKPOINT_ENABLED and not recursive and process_rid and db_name and len(allowed_files) >= CHECKPOINT_MIN_ENTRIES:
+            checkpoint = ExtractCheckpoint.for_job(
+                db_name, process_rid, get_archive_key(zip_path), allowed_extensions, hash_algorithm
+            )
+            reused = checkpoint.resume(tmp_root, allowed_files)
+            for index, descriptor in reused.items():
+                if control is not None:
+                    control.advance(1, descriptor["size"])
+                if on_file is not None:
+                    on_file(descriptor)
+        pending = [index for index in range(len(allowed_files)) if index not in reused]
+
+        buckets = [
+            [pending[position] for position in bucket]
+            for bucket in partition_by_size(
+                [allowed_files[index].compress_size + EXTRACT_ENTRY_OVERHEAD for index in pending],
+                EXTRACT_WORKERS,
+            )
+        ]
+        stop = threading.Event()
+        worker_options = {
+            "hash_algorithm": hash_algorithm,
+            "blob_dir": get_blob_dir(db_name, hash_algorithm),
+            "control": control,
+            "on_file": on_file,
+            "collect": collect,
+            "db_name": db_name,
+            "checkpoint": checkpoint,
+        }
+        if not pending:
+            bucket_results = []
+        elif len(buckets) == 1:
+            bucket_results = [
+                extract_entries_worker(
+                    zip_path, tmp_root, [(index, allowed_files[index]) for index in buckets[0]], stop, **worker_options
+                )
+            ]
+        else:
+            executor = get_extract_executor()
+            futures = [
+                executor.submit(
+                    extract_entries_worker,
+                    zip_path,
+                    tmp_root,
+                    [(index, allowed_files[index]) for index in bucket],
+                    stop,
+                    **worker_options,
+                )
+                for bucket in buckets
+            ]
+            bucket_results = []
+            first_error: Optional[BaseException] = None
+            for future in futures:
+                try:
+                    bucket_results.append(future.result())
+                except BaseException as exc:
+                    if first_error is None:
+                        first_error = exc
+            if first_error is not None:
+                for results in bucket_results:
+                    remove_tmp_outputs(tmp_root, [descriptor for _, descriptor in results])
+                raise first_error
+
+        output_files: List[Optional[Dict[str, Any]]] = [None] * len(allowed_files)
+        if collect:
+            for index, descriptor in reused.items():
+                output_files[index] = descriptor
+        for results in bucket_results:
+            for index, descriptor in results:
+                output_files[index] = descriptor
+
+        if nested:
+            context = NestedExtraction(tmp_root, allowed_extensions, hash_algorithm, control, on_file, db_name)
+            try:
+                nested_outputs = expand_nested_archives(zip_path, nested, context)
+            except BaseException:
+                if collect:
+                    remove_tmp_outputs(tmp_root, [descriptor for descriptor in output_files if descriptor is not None])
+                raise
+        succeeded = True
+
+    except zipfile.BadZipFile:
+        raise HTTPException(400, "Invalid or corrupted zip file")
+    except (HTTPException, JobCancelled):
+        raise
+    except Exception as e:
+        log_event("error", "zip_processing_error", process_rid=process_rid, error=str(e))
+        raise HTTPException(500, f"Error processing zip file: {str(e)}")
+    finally:
+        # The checkpoint only outlives a crash; a failed job drops it with its outputs.
+        if checkpoint is not None:
+            if not succeeded and collect:
+                remove_tmp_outputs(tmp_root, list(reused.values()))
+            checkpoint.close()
+
+    maybe_prune_blob_store(db_name)
+    if not collect:
+        return []
+    return [descriptor for descriptor in output_files if descriptor is not None] + nested_outputs
+
+
+# Leading bytes of compressed streams tarfile's "r|*" mode can read.
+TAR_COMPRESSION_MAGIC = (b"\x1f\x8b", b"\xfd7zXZ\x00", b"BZh")
+# Uncompressed size assumed per compressed byte when admitting xz/bz2 tarballs.
+TAR_EXPANSION_ESTIMATE = 4
+
+
+def detect_archive_format(path: str) -> str:
+    """Return "tar" for plain or compressed tarballs and "zip" otherwise, from leading bytes."""
+    with open(path, 'rb') as fp:
+        head = fp.read(512)
+    if head.startswith(b"PK"):
+        return "zip"
+    if head.startswith(TAR_COMPRESSION_MAGIC) or head[257:262] == b"ustar":
+        return "tar"
+    return "zip"
+
+
+def get_tar_admission_bytes(tar_path: str) -> int:
+    """Estimate what a tarball unpacks to without reading through it.
+
+    Plain tars are about their own size; gzip stores the uncompressed size
+    (mod 4 GiB) in its last four bytes; other compressors get a fixed ratio.
+    """
+    size = os.path.getsize(tar_path)
+    with open(tar_path, 'rb') as fp:
+        magic = fp.read(6)
+        if magic.startswith(b"\x1f\x8b") and size >= 18:
+            fp.seek(-4, os.SEEK_END)
+            return max(size, struct.unpack("<I", fp.read(4))[0])
+    if magic.startswith(TAR_COMPRESSION_MAGIC):
+        return size * TAR_EXPANSION_ESTIMATE
+    return size
+
+
+def iter_tar_member_chunks(src) -> Iterator[bytes]:
+    while True:
+        chunk = src.read(COPY_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def extract_tar_to_tmp(
+    tar_path: str,
+    tmp_root: str,
+    allowed_extensions: Optional[tuple],
+    process_rid: Optional[str] = None,
+    db_name: Optional[str] = None,
+    hash_algorithm: Optional[str] = None,
+    control: Optional[JobControl] = None,
+    on_file=None,
+    collect: bool = True,
+    recursive: bool = False,
+) -> List[Dict[str, Any]]:
+    """Extract matching regular files of a tar, tar.gz, tar.bz2 or tar.xz to tmp_root.
+
+    The archive is read once, front to back, with tarfile's stream mode: no
+    seeks, so compressed tarballs decompress in a single pass. Members are
+    filtered by extension as they pass and written in archive order; links,
+    directories and devices are skipped. Takes the same arguments and returns
+    the same descriptors as extract_zip_to_tmp; recursive is not supported
+    for tarballs and is ignored. Blocking.
+    """
+    output_files: List[Dict[str, Any]] = []
+    try:
+        with open(tar_path, 'rb') as raw, tarfile.open(fileobj=raw, mode='r|*', bufsize=COPY_CHUNK_SIZE) as archive:
+            for member in archive:
+                if control is not None:
+                    control.check_cancelled()
+                if not member.isfile():
+                    continue
+                base_name = os.path.basename(member.name)
+                ext = os.path.splitext(base_name)[1].lower().lstrip('.')
+                if not base_name or (allowed_extensions is not None and ext not in allowed_extensions):
+                    continue
+                if control is not None:
+                    control.add_totals(1, member.size)
+                src = archive.extractfile(member)
+                descriptor = write_tmp_file(
+                    tmp_root, base_name, base_name, iter_tar_member_chunks(src), hash_algorithm, db_name
+                )
+                inc_metric("zipfs_bytes_read_total", member.size, task="unzip", db=db_name)
+                if collect:
+                    output_files.append(descriptor)
+                if control is not None:
+                    control.advance(1, descriptor["size"])
+                if on_file is not None:
+                    on_file(descriptor)
+        if not output_files and collect:
+            raise HTTPException(404, "No files matching allowed extensions found in tar")
+    except BaseException as exc:
+        remove_tmp_outputs(tmp_root, output_files)
+        if isinstance(exc, (tarfile.TarError, EOFError, zlib.error)):
+            raise HTTPException(400, "Invalid or corrupted tar file")
+        if isinstance(exc, (HTTPException, JobCancelled)) or not isinstance(exc, Exception):
+            raise
+        log_event("error", "tar_processing_error", process_rid=process_rid, error=str(exc))
+        raise HTTPException(500, f"Error processing tar file: {str(exc)}")
+    return output_files
+
+
+@app.get("/")
+async def root():
+    return {"message": "zip API for MessyDesk"}
+
+
+@app.get("/health")
+async def health() -> Dict[str, Any]:
+    return {"status": "ok", "service": "md-zip_fs"}
+
+
+@app.get("/config")
+async def config() -> Dict[str, Any]:
+    return load_service_descriptor()
+
+
+@app.get("/help")
+async def help_markdown() -> PlainTextResponse:
+    markdown = load_help_markdown()
+    return PlainTextResponse(markdown, media_type="text/markdown")
+
+
+@app.get("/admission")
+async def admission_state() -> Dict[str, Any]:
+    """Current admission budget, reservations, queue and free space per tmp dir."""
+    data_root = os.path.join(MD_ROOT, "data")
+    try:
+        tmp_roots = sorted(
+            os.path.join(data_root, name, "tmp")
+            for name in os.listdir(data_root)
+            if os.path.isdir(os.path.join(data_root, name, "tmp"))
+        )
+    except OSError:
+        tmp_roots = []
+    state = _admission.snapshot(tmp_roots)
+    state["tmp_free_bytes"] = {
+        os.path.relpath(path, MD_ROOT): free for path, free in state["tmp_free_bytes"].items()
+    }
+    return state
+
+
+@app.get("/metrics")
+async def metrics() -> PlainTextResponse:
+    # Off the job pool so scrapes still answer while every job worker is busy.
+    loop = asyncio.get_running_loop()
+    body = await loop.run_in_executor(None, render_metrics)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
+
+
+@app.get("/entry")
+async def stream_zip_entry(
+    path: str,
+    entry: str,
+    range_header: Optional[str] = Header(None, alias="Range"),
+) -> StreamingResponse:
+    """Stream one archive entry; STORED entries honour a single HTTP byte range."""
+    zip_path = resolve_md_relative_path(path)
+    if not os.path.isfile(zip_path):
+        raise HTTPException(404, "Zip file not found")
+    db_name = get_db_name_from_file_path(path)
+    try:
+        index = await run_in_io(load_zip_index, zip_path, db_name)
+    except zipfile.BadZipFile:
+        raise HTTPException(400, "Invalid or corrupted zip file")
+    item = find_zip_entry(index, entry)
+    if item is None:
+        raise HTTPException(404, "Entry not found in zip")
+
+    label = os.path.basename(item.filename)
+    media_type = mimetypes.guess_type(label)[0] or "application/octet-stream"
+    headers = {"Content-Disposition": f"inline; filename*=UTF-8''{quote(label)}"}
+
+    if can_read_entry_raw(item) and item.compress_type == zipfile.ZIP_STORED:
+        try:
+            data_offset = await run_in_io(read_entry_data_offset, zip_path, item.header_offset)
+        except zipfile.BadZipFile:
+            raise HTTPException(400, "Invalid or corrupted zip file")
+        headers["Accept-Ranges"] = "bytes"
+        byte_range = parse_range_header(range_header, item.file_size)
+        if byte_range is None:
+            headers["Content-Length"] = str(item.file_size)
+            return StreamingResponse(
+                iter_file_region(zip_path, data_offset, item.file_size), media_type=media_type, headers=headers
+            )
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{item.file_size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(
+            iter_file_region(zip_path, data_offset + start, end - start + 1),
+            status_code=206,
+            media_type=media_type,
+            headers=headers,
+        )
+
+    # Compressed entries cannot be seeked into; decode and stream the whole entry.
+    headers["Accept-Ranges"] = "none"
+    headers["Content-Length"] = str(item.file_size)
+    return StreamingResponse(iter_zip_entry(zip_path, item), media_type=media_type, headers=headers)
+
+
+async def read_message_json(message: UploadFile) -> Any:
+    # Parse message JSON in-memory to avoid disk roundtrip overhead.
+    request_chunks = []
+    while True:
+        chunk = await message.read(REQUEST_READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        request_chunks.append(chunk)
+    return json.loads(b"".join(request_chunks).decode("utf-8"))
+
+
+async def parse_process_message(message: UploadFile) -> Any:
+    try:
+        log_event("info", "process_start")
+        parse_start = time.perf_counter()
+        request_json = await read_message_json(message)
+        observe_metric("zipfs_request_parse_seconds", time.perf_counter() - parse_start, **get_metric_labels(request_json))
+        print(f"Received request: {json.dumps(request_json, indent=2)}")
+        log_event("info", "request_parsed", has_payload=isinstance(request_json, dict))
+        return request_json
+    except Exception as e:
+        log_event("error", "process_unhandled_exception", process_rid=None, error=str(e))
+        raise HTTPException(500, f"Processing failed: {str(e)}")
+
+
+@app.post("/process")
+async def process_files(
+    message: UploadFile = File(...)
+):
+    start_time = time.time()
+    print("Received /process request, starting processing...")
+    request_json = await parse_process_message(message)
+    return await execute_process_request(request_json, start_time)
+
+
+async def execute_process_request(request_json: Any, start_time: float, control: Optional["JobControl"] = None):
+    """Run one parsed queue message; shared by /process and the job API.
+
+    With a control object (job mode) the work reports progress, can be
+    cancelled between entries and is not coalesced with other requests.
+    """
+    process_rid = None
+    source_file_rid = None
+    output_set = None
+    extracted_count = 0
+    output_files: List[Dict[str, Any]] = []
+    status = "failed"
+    metric_labels = get_metric_labels(request_json)
+    inc_metric("zipfs_jobs_in_flight", **metric_labels)
+
+    try:
+        # Validate
         if not isinstance(request_json, dict):
             raise HTTPException(400, "Request payload must be a JSON object")
 
@@ -463,19 +3745,66 @@ async def process_files(
                 source_file_rid = source_file.get('@rid')
             output_set = request_json.get('set_rid') or request_json.get('output_set')
 
-            result = create_set_zip_in_tmp(request_json)
+            if is_stream_delivery(request_json):
+                if control is not None:
+                    raise HTTPException(400, "delivery=stream is not available for jobs")
+                if get_max_part_size(request_json):
+                    raise HTTPException(400, "max_part_size is not available with delivery=stream")
+                plan = await run_in_worker(prepare_set_zip_stream, request_json)
+                status = "success"
+                log_event(
+                    "info",
+                    "process_summary",
+                    status=status,
+                    process_rid=process_rid,
+                    source_file_rid=source_file_rid,
+                    output_set=output_set,
+                    total_files=len(plan["entries"]),
+                    successful_uploads=1,
+                    failed_uploads=plan["skipped_files"],
+                    duration_sec=round(time.time() - start_time, 3),
+                    zip_output_name=plan["output_name"],
+                    delivery="stream",
+                )
+                return StreamingResponse(
+                    iter_in_worker(iter_set_zip_stream(plan)),
+                    media_type="application/zip",
+                    headers={
+                        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(plan['output_name'])}",
+                        "X-Zipped-Files": str(len(plan["entries"])),
+                        "X-Skipped-Files": str(plan["skipped_files"]),
+                    },
+                )
+
+            result = await run_job_work(
+                control,
+                get_set_zip_job_key(request_json),
+                lambda previous: all(os.path.exists(item["zip_abs_path"]) for item in previous["parts"]),
+                create_set_zip_in_tmp,
+                request_json,
+                admission=functools.partial(get_set_zip_admission, request_json),
+            )
             end_time = time.time()
             status = "success"
-            archive_label = result.get("zip_output_name") or os.path.basename(result["zip_abs_path"])
-            archive_ext = os.path.splitext(archive_label)[1].lower().lstrip('.') or 'zip'
-            output_files = [
-                {
+            output_files = []
+            for part in result["parts"]:
+                archive_label = part["zip_output_name"]
+                archive_descriptor = {
                     "path": archive_label,
                     "label": archive_label,
                     "type": "zip",
-                    "extension": archive_ext,
+                    "extension": os.path.splitext(archive_label)[1].lower().lstrip('.') or 'zip',
+                    "size": part["size"],
                 }
-            ]
+                if part.get("digest"):
+                    archive_descriptor["digest"] = part["digest"]
+                output_files.append(archive_descriptor)
+            callback_extra: Dict[str, Any] = {}
+            if is_callback_enabled(request_json):
+                dispatcher = CallbackDispatcher(request_json)
+                for archive_descriptor in output_files:
+                    dispatcher.submit(archive_descriptor)
+                callback_extra["callbacks"] = await dispatcher.close()
             log_event(
                 "info",
                 "process_summary",
@@ -484,7 +3813,7 @@ async def process_files(
                 source_file_rid=source_file_rid,
                 output_set=output_set,
                 total_files=result.get('zipped_files', 0),
-                successful_uploads=1,
+                successful_uploads=len(output_files),
                 failed_uploads=result.get('skipped_files', 0),
                 duration_sec=round(end_time - start_time, 3),
                 zip_output_name=result.get('zip_output_name'),
@@ -496,6 +3825,10 @@ async def process_files(
                 status=status,
                 zipped_files=result.get("zipped_files", 0),
                 skipped_files=result.get("skipped_files", 0),
+                compression=result.get("compression"),
+                entry_compression=result.get("entry_compression", []),
+                reused_files=result.get("reused_files", 0),
+                **callback_extra,
             )
 
         if 'file' not in request_json or 'path' not in request_json['file']:
@@ -532,57 +3865,119 @@ async def process_files(
         if not project_rid:
             raise HTTPException(400, "Could not determine project_rid from message or file path")
 
+        archive_format = await run_in_io(detect_archive_format, zip_path)
+
+        # List task answers from the central directory only; nothing is written to tmp.
+        if task_id == 'list':
+            if archive_format != "zip":
+                raise HTTPException(400, "list is only available for zip archives")
+            listing = await run_in_io(list_zip_contents, zip_path, db_name)
+            end_time = time.time()
+            status = "success"
+            log_event(
+                "info",
+                "process_summary",
+                status=status,
+                process_rid=process_rid,
+                source_file_rid=source_file_rid,
+                output_set=output_set,
+                total_files=listing["total_entries"],
+                successful_uploads=0,
+                failed_uploads=0,
+                duration_sec=round(end_time - start_time, 3),
+            )
+            return to_list_response(
+                task_id,
+                listing,
+                execution_time=round(end_time - start_time, 1),
+                status=status,
+            )
+
         task = request_json.get('task')
         if not isinstance(task, dict):
             raise HTTPException(400, "Invalid task object")
         allowed_extensions = get_allowed_extensions(task, task_id)
-        try:
-            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                allowed_files = []
-                for item in zip_ref.infolist():
-                    if item.is_dir():
-                        continue
-                    base_name = os.path.basename(item.filename)
-                    if not base_name:
-                        continue
-                    if allowed_extensions is None:
-                        allowed_files.append(item)
-                    else:
-                        ext = os.path.splitext(base_name)[1].lower().lstrip('.')
-                        if ext in allowed_extensions:
-                            allowed_files.append(item)
-
-                total_allowed = len(allowed_files)
-                for _, file in enumerate(allowed_files, start=1):
-                    extracted_count += 1
-                    safe_name = os.path.basename(file.filename)
-                    tmp_filename = f"zipfs_{uuid.uuid4().hex}_{safe_name}"
-                    dest_path = os.path.join(tmp_root, tmp_filename)
-
-                    # Stream extract directly to data/<db>/tmp.
-                    with zip_ref.open(file, 'r') as src, open(dest_path, 'wb') as dst:
-                        shutil.copyfileobj(src, dst, length=COPY_CHUNK_SIZE)
-
-                    ext = os.path.splitext(safe_name)[1].lower().lstrip('.')
-                    output_files.append(
-                        {
-                            "path": tmp_filename,
-                            "label": safe_name,
-                            "type": infer_file_type(safe_name),
-                            "extension": ext or "bin",
-                        }
-                    )
-
-                if total_allowed == 0:
+        hash_algorithm = get_content_hash_algorithm(request_json)
+        recursive = is_recursive_unzip(request_json)
+        # Tarballs have no central directory: they are extracted in one sequential pass.
+        if archive_format == "tar":
+            extract = extract_tar_to_tmp
+            admission_bytes = functools.partial(get_tar_admission_bytes, zip_path)
+        else:
+            extract = extract_zip_to_tmp
+            admission_bytes = functools.partial(
+                get_unzip_admission_bytes, zip_path, db_name, allowed_extensions, recursive
+            )
+        if is_ndjson_response(request_json):
+            if control is not None:
+                raise HTTPException(400, "response_mode=ndjson is not available for jobs")
+            admit_bytes = await run_in_io(admission_bytes)
+            if archive_format == "zip":
+                selected = await run_in_io(
+                    lambda: sum(map(len, select_unzip_entries(load_zip_index(zip_path, db_name), allowed_extensions, recursive)))
+                )
+                if selected == 0:
                     raise HTTPException(404, "No files matching allowed extensions found in zip")
+            # The outcome is only known at the summary record; the body counts it.
+            status = None
+            return StreamingResponse(
+                iter_admitted_ndjson(
+                    (admit_bytes, tmp_root),
+                    task_id,
+                    start_time,
+                    {
+                        "zip_path": zip_path,
+                        "tmp_root": tmp_root,
+                        "allowed_extensions": allowed_extensions,
+                        "process_rid": process_rid,
+                        "db_name": db_name,
+                        "hash_algorithm": hash_algorithm,
+                        "recursive": recursive,
+                    },
+                    extract=extract,
+                    metric_labels=metric_labels,
+                ),
+                media_type="application/x-ndjson",
+            )
 
-        except zipfile.BadZipFile:
-            raise HTTPException(400, "Invalid or corrupted zip file")
-        except HTTPException:
-            raise
-        except Exception as e:
-            log_event("error", "zip_processing_error", process_rid=process_rid, error=str(e))
-            raise HTTPException(500, f"Error processing zip file: {str(e)}")
+        archive_key = get_archive_key(zip_path)
+        callbacks_enabled = is_callback_enabled(request_json)
+        flight_key = ("unzip", archive_key, allowed_extensions, hash_algorithm, recursive, callbacks_enabled)
+        dispatcher = None
+        owns_dispatcher = False
+        if callbacks_enabled:
+            # Coalesced callers share the dispatcher the running extraction submits to.
+            dispatcher = _flight_dispatchers.get(flight_key) if control is None else None
+            if dispatcher is None:
+                dispatcher = CallbackDispatcher(request_json)
+                owns_dispatcher = control is None
+                if owns_dispatcher:
+                    _flight_dispatchers[flight_key] = dispatcher
+        callback_extra = {}
+        try:
+            output_files = await run_job_work(
+                control,
+                flight_key,
+                lambda previous: all(os.path.exists(os.path.join(tmp_root, item["path"])) for item in previous),
+                extract,
+                zip_path,
+                tmp_root,
+                allowed_extensions,
+                process_rid=process_rid,
+                db_name=db_name,
+                hash_algorithm=hash_algorithm,
+                on_file=dispatcher.submit if dispatcher is not None else None,
+                recursive=recursive,
+                admission=lambda: (admission_bytes(), tmp_root),
+            )
+        finally:
+            if dispatcher is not None:
+                callback_extra["callbacks"] = await dispatcher.close()
+            if owns_dispatcher and _flight_dispatchers.get(flight_key) is dispatcher:
+                del _flight_dispatchers[flight_key]
+        if dispatcher is not None:
+            dispatcher.mark_delivered(output_files)
+        extracted_count = len(output_files)
 
         end_time = time.time()
         status = "success"
@@ -605,6 +4000,7 @@ async def process_files(
             total_files=extracted_count,
             current_file=extracted_count,
             status=status,
+            **callback_extra,
         )
 
     except HTTPException:
@@ -623,9 +4019,126 @@ async def process_files(
                 duration_sec=round(end_time - start_time, 3),
             )
         raise
+    except JobCancelled:
+        status = "cancelled"
+        log_event("info", "process_cancelled", process_rid=process_rid, source_file_rid=source_file_rid)
+        raise
     except Exception as e:
         log_event("error", "process_unhandled_exception", process_rid=process_rid, error=str(e))
         raise HTTPException(500, f"Processing failed: {str(e)}")
+    finally:
+        inc_metric("zipfs_jobs_in_flight", -1, **metric_labels)
+        if status is not None:
+            inc_metric("zipfs_requests_total", status=status, **metric_labels)
+            observe_metric("zipfs_request_duration_seconds", time.time() - start_time, **metric_labels)
+
+
+_jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+
+def prune_jobs() -> None:
+    """Drop expired finished jobs, then the oldest finished ones over JOB_REGISTRY_MAX."""
+    now = time.time()
+    for job_id, job in list(_jobs.items()):
+        if job["finished_at"] is not None and now - job["finished_at"] > JOB_RESULT_TTL_SEC:
+            del _jobs[job_id]
+    for job_id, job in list(_jobs.items()):
+        if len(_jobs) < JOB_REGISTRY_MAX:
+            break
+        if job["finished_at"] is not None:
+            del _jobs[job_id]
+
+
+def describe_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    description = {
+        "job_id": job["job_id"],
+        "task": job["task_id"],
+        "status": job["status"],
+        "created_at": job["created_at"],
+        "finished_at": job["finished_at"],
+        "progress": job["control"].snapshot(),
+    }
+    if job["error"] is not None:
+        description["error"] = job["error"]
+    return description
+
+
+def get_job(job_id: str) -> Dict[str, Any]:
+    job = _jobs.get(job_id)
+    if job is None:
+        raise HTTPException(404, "Job not found")
+    return job
+
+
+async def run_job(job: Dict[str, Any], request_json: Any) -> None:
+    if job["status"] == "queued":
+        job["status"] = "running"
+    try:
+        job["result"] = await execute_process_request(request_json, job["created_at"], control=job["control"])
+        job["status"] = "succeeded"
+    except JobCancelled:
+        job["status"] = "cancelled"
+    except HTTPException as exc:
+        job["status"] = "failed"
+        job["error"] = {"status_code": exc.status_code, "detail": exc.detail}
+    finally:
+        job["finished_at"] = time.time()
+        job["runner"] = None
+
+
+@app.post("/jobs", status_code=202)
+async def submit_job(message: UploadFile = File(...)) -> Dict[str, Any]:
+    """Queue a /process message and return its job id immediately."""
+    request_json = await parse_process_message(message)
+    prune_jobs()
+    if len(_jobs) >= JOB_REGISTRY_MAX:
+        raise HTTPException(503, "Job registry is full", headers={"Retry-After": "30"})
+
+    task = request_json.get('task') if isinstance(request_json, dict) else None
+    job_id = uuid.uuid4().hex
+    job: Dict[str, Any] = {
+        "job_id": job_id,
+        "task_id": task.get('id') if isinstance(task, dict) else None,
+        "status": "queued",
+        "created_at": time.time(),
+        "finished_at": None,
+        "control": JobControl(),
+        "result": None,
+        "error": None,
+    }
+    _jobs[job_id] = job
+    job["runner"] = asyncio.ensure_future(run_job(job, request_json))
+    return {"job_id": job_id, "status": job["status"]}
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str) -> Dict[str, Any]:
+    return describe_job(get_job(job_id))
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    job = get_job(job_id)
+    if job["status"] == "succeeded":
+        return job["result"]
+    if job["status"] == "failed":
+        raise HTTPException(job["error"]["status_code"], job["error"]["detail"])
+    if job["status"] == "cancelled":
+        raise HTTPException(410, "Job was cancelled")
+    raise HTTPException(409, f"Job is {job['status']}")
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str) -> Dict[str, Any]:
+    """Request cancellation; extraction stops before its next entry and removes partial files."""
+    job = get_job(job_id)
+    if job["finished_at"] is None:
+        job["control"].cancel_event.set()
+        job["status"] = "cancelling"
+        if job["runner"] is not None:
+            # Usually settles quickly; a job still waiting for a pool slot reports "cancelling".
+            await asyncio.wait([job["runner"]], timeout=1)
+    return describe_job(job)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,107 @@
+"""Compare STORED entry extraction paths.
+
+Builds a temporary archive of incompressible STORED entries and times:
+
+- ``copyfileobj``: zipfile.open + shutil.copyfileobj with COPY_CHUNK_SIZE (previous path),
+- ``zero_copy``: api.copy_stored_entry without CRC check,
+- ``zero_copy_crc``: api.copy_stored_entry followed by the CRC pass.
+
+Run from the repository root:
+
+    python bench/bench_stored_copy.py --entries 8 --entry-mb 64
+
+Prints one JSON object with MB/s per method.
+"""
+import argparse
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+
+def load_api(md_path: str):
+    os.environ["MD_PATH"] = md_path
+    sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+    return importlib.import_module("api")
+
+
+def build_archive(path: Path, entries: int, entry_bytes: int) -> None:
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED) as zf:
+        for index in range(entries):
+            with zf.open(zipfile.ZipInfo(f"scan_{index:04d}.jpg"), "w", force_zip64=True) as dst:
+                remaining = entry_bytes
+                while remaining > 0:
+                    block = os.urandom(min(1024 * 1024, remaining))
+                    dst.write(block)
+                    remaining -= len(block)
+
+
+def drop_outputs(out_dir: Path) -> None:
+    for item in out_dir.iterdir():
+        item.unlink()
+
+
+def run_copyfileobj(api, zip_path: Path, out_dir: Path) -> None:
+    with zipfile.ZipFile(zip_path) as zf:
+        for info in zf.infolist():
+            with zf.open(info) as src, open(out_dir / info.filename, "wb") as dst:
+                shutil.copyfileobj(src, dst, length=api.COPY_CHUNK_SIZE)
+
+
+def run_zero_copy(api, zip_path: Path, out_dir: Path, verify: bool) -> None:
+    with zipfile.ZipFile(zip_path) as zf:
+        infos = zf.infolist()
+    with open(zip_path, "rb") as fp:
+        for info in infos:
+            api.copy_stored_entry(fp, info, str(out_dir / info.filename), verify_crc=verify)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entries", type=int, default=8)
+    parser.add_argument("--entry-mb", type=int, default=64)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        api = load_api(workdir)
+        work = Path(workdir)
+        zip_path = work / "stored.zip"
+        out_dir = work / "out"
+        out_dir.mkdir()
+        entry_bytes = args.entry_mb * 1024 * 1024
+        build_archive(zip_path, args.entries, entry_bytes)
+        total_mb = args.entries * entry_bytes / (1024 * 1024)
+
+        methods = {
+            "copyfileobj": lambda: run_copyfileobj(api, zip_path, out_dir),
+            "zero_copy": lambda: run_zero_copy(api, zip_path, out_dir, verify=False),
+            "zero_copy_crc": lambda: run_zero_copy(api, zip_path, out_dir, verify=True),
+        }
+        results = {}
+        for name, func in methods.items():
+            timings = []
+            for _ in range(args.repeat):
+                drop_outputs(out_dir)
+                started = time.perf_counter()
+                func()
+                timings.append(time.perf_counter() - started)
+            best = min(timings)
+            results[name] = {"best_sec": round(best, 4), "mb_per_sec": round(total_mb / best, 1)}
+
+        print(json.dumps({
+            "entries": args.entries,
+            "entry_mb": args.entry_mb,
+            "copy_chunk_size": api.COPY_CHUNK_SIZE,
+            "zero_copy_methods": api._zero_copy_state,
+            "results": results,
+        }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""Measure unzip and set-zip throughput on synthetic corpora.
+
+Generates reproducible corpora under a temporary MD_PATH:
+
+- ``tiny``: many small deflated text files,
+- ``huge``: a few large STORED incompressible images,
+- ``nested``: files under deeply nested directories,
+- ``mixed``: compressible text and incompressible binaries side by side.
+
+For every corpus, chunk size (COPY_CHUNK_SIZE) and concurrency level it runs
+concurrent ``unzip`` requests through ``process_files`` and concurrent
+``create_set_zip_in_tmp`` calls. Each concurrent request gets its own copy of
+the archive and its own output name so single-flight does not merge them, and
+the central-directory index cache is cleared before every round.
+
+Run from the repository root:
+
+    python bench/bench_throughput.py --corpus tiny,huge --chunk-sizes 65536,1048576 --concurrency 1,4
+
+Prints one JSON document (optionally also written to --output) with MB/s,
+entries/s and p50/p99 request latency per scenario, plus the peak RSS of the
+whole run, so results can be diffed between commits.
+"""
+import argparse
+import asyncio
+import contextlib
+import importlib
+import io
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+DB_NAME = "bench"
+REL_ROOT = f"data/{DB_NAME}/projects/1_1/files"
+
+# name -> (entry count, entry bytes) at scale 1.
+CORPORA = {
+    "tiny": (5000, 512),
+    "huge": (4, 64 * 1024 * 1024),
+    "nested": (1000, 4096),
+    "mixed": (400, 256 * 1024),
+}
+
+
+def load_api(md_path: str, max_concurrency: int):
+    os.environ["MD_PATH"] = md_path
+    os.environ.setdefault("JOB_WORKERS", str(max_concurrency))
+    os.environ.setdefault("SINGLE_FLIGHT_TTL_SEC", "0")
+    # Measure full set-zip builds, not incremental reuse of the previous round.
+    os.environ.setdefault("ZIP_MANIFEST_ENABLED", "false")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+    return importlib.import_module("api")
+
+
+def text_block(rng: random.Random, size: int) -> bytes:
+    words = [b"zip", b"messydesk", b"archive", b"entry", b"set", b"export", b"tmp", b"stored"]
+    out = bytearray()
+    while len(out) < size:
+        out += rng.choice(words) + b" "
+    return bytes(out[:size])
+
+
+def corpus_files(name: str, scale: float, seed: int):
+    """Yield (relative name, bytes, compress_type) for a corpus."""
+    rng = random.Random(f"{name}:{seed}")
+    count, size = CORPORA[name]
+    count = max(1, int(count * scale)) if name != "huge" else CORPORA[name][0]
+    size = size if name != "huge" else max(1024 * 1024, int(size * scale))
+    for index in range(count):
+        if name == "tiny":
+            yield f"notes/note_{index:05d}.txt", text_block(rng, rng.randint(size // 2, size * 2)), zipfile.ZIP_DEFLATED
+        elif name == "huge":
+            yield f"scans/scan_{index:03d}.jpg", rng.randbytes(size), zipfile.ZIP_STORED
+        elif name == "nested":
+            depth = "/".join(f"level{level}_{rng.randint(0, 3)}" for level in range(12))
+            yield f"{depth}/item_{index:05d}.json", text_block(rng, size), zipfile.ZIP_DEFLATED
+        elif index % 2:
+            yield f"mixed/photo_{index:04d}.png", rng.randbytes(size), zipfile.ZIP_STORED
+        else:
+            yield f"mixed/doc_{index:04d}.txt", text_block(rng, size), zipfile.ZIP_DEFLATED
+
+
+def build_corpus(root: Path, name: str, scale: float, seed: int, copies: int) -> dict:
+    """Write the corpus as loose set files and as `copies` identical archives."""
+    set_dir = root / REL_ROOT / "sets" / name
+    zip_paths = [f"{REL_ROOT}/archives/{name}_{copy:02d}.zip" for copy in range(copies)]
+    (root / REL_ROOT / "archives").mkdir(parents=True, exist_ok=True)
+    first_zip = root / zip_paths[0]
+    set_files = []
+    total_bytes = 0
+    with zipfile.ZipFile(first_zip, "w") as zf:
+        for arc_name, data, compress_type in corpus_files(name, scale, seed):
+            zf.writestr(arc_name, data, compress_type=compress_type)
+            target = set_dir / arc_name
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.write_bytes(data)
+            set_files.append({"path": str(target.relative_to(root)), "label": arc_name.replace("/", "_")})
+            total_bytes += len(data)
+    for rel_path in zip_paths[1:]:
+        shutil.copyfile(first_zip, root / rel_path)
+    return {"zip_paths": zip_paths, "set_files": set_files, "entries": len(set_files), "bytes": total_bytes}
+
+
+def unzip_message(rel_zip_path: str) -> dict:
+    return {
+        "task": {"id": "unzip", "params": {"allowed_extensions": ["txt", "jpg", "png", "json"], "hash": "none"}},
+        "file": {"@rid": "#1:1", "project_rid": "#1:1", "path": rel_zip_path, "type": "zip"},
+        "process": {"@rid": "#2:1"},
+        "output_set": "#3:1",
+    }
+
+
+def zip_message(set_files: list, output_name: str, compression: str) -> dict:
+    return {
+        "task": {"id": "zip", "params": {"compression": compression, "hash": "none"}},
+        "set_rid": "#3:1",
+        "db_name": DB_NAME,
+        "zip_output_name": output_name,
+        "set_files": set_files,
+    }
+
+
+def reset_state(api, root: Path) -> None:
+    api.clear_index_cache()
+    for kind in ("tmp", "zipfs"):
+        shutil.rmtree(root / "data" / DB_NAME / kind, ignore_errors=True)
+
+
+async def timed(coro) -> float:
+    started = time.perf_counter()
+    await coro
+    return time.perf_counter() - started
+
+
+async def run_unzip(api, corpus: dict, concurrency: int) -> list:
+    async def one(rel_zip_path):
+        upload = api.UploadFile(filename="message.json", file=io.BytesIO(json.dumps(unzip_message(rel_zip_path)).encode()))
+        return await api.process_files(upload)
+
+    return await asyncio.gather(*(timed(one(path)) for path in corpus["zip_paths"][:concurrency]))
+
+
+async def run_set_zip(api, corpus: dict, concurrency: int, compression: str) -> list:
+    messages = [zip_message(corpus["set_files"], f"bench_{slot:02d}.zip", compression) for slot in range(concurrency)]
+    return await asyncio.gather(
+        *(timed(api.run_in_worker(api.create_set_zip_in_tmp, message)) for message in messages)
+    )
+
+
+def percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux and bytes on macOS. It is the maximum over the
+    # process lifetime, so it is only meaningful for the run as a whole.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).resolve().parents[1],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def run_scenarios(api, root: Path, corpora: dict, args) -> list:
+    results = []
+    for name, corpus in corpora.items():
+        for chunk_size in args.chunk_sizes:
+            api.COPY_CHUNK_SIZE = chunk_size
+            for concurrency in args.concurrency:
+                for operation in ("unzip", "zip"):
+                    latencies = []
+                    wall = 0.0
+                    for _ in range(args.repeat):
+                        reset_state(api, root)
+                        started = time.perf_counter()
+                        if operation == "unzip":
+                            latencies += await run_unzip(api, corpus, concurrency)
+                        else:
+                            latencies += await run_set_zip(api, corpus, concurrency, args.zip_compression)
+                        wall += time.perf_counter() - started
+                    requests = concurrency * args.repeat
+                    results.append({
+                        "corpus": name,
+                        "operation": operation,
+                        "chunk_size": chunk_size,
+                        "concurrency": concurrency,
+                        "requests": requests,
+                        "mb_per_sec": round(corpus["bytes"] * requests / wall / (1024 * 1024), 1),
+                        "entries_per_sec": round(corpus["entries"] * requests / wall, 1),
+                        "p50_sec": round(percentile(latencies, 50), 4),
+                        "p99_sec": round(percentile(latencies, 99), 4),
+                    })
+                    print(json.dumps(results[-1]), file=sys.stderr)
+    return results
+
+
+def parse_int_list(value: str) -> list:
+    return [int(item) for item in value.split(",") if item.strip()]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", default=",".join(CORPORA), help="comma-separated subset of %s" % ", ".join(CORPORA))
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies entry counts (and huge entry size)")
+    parser.add_argument("--chunk-sizes", type=parse_int_list, default=[64 * 1024, 1024 * 1024])
+    parser.add_argument("--concurrency", type=parse_int_list, default=[1, 4])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--zip-compression", default="stored", choices=["stored", "deflate", "auto"])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.corpus.split(",") if name.strip()]
+    unknown = [name for name in names if name not in CORPORA]
+    if unknown:
+        parser.error(f"unknown corpus: {', '.join(unknown)}")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        root = Path(workdir)
+        (root / "data").mkdir()
+        api = load_api(workdir, max(args.concurrency))
+        copies = max(args.concurrency)
+        build_started = time.perf_counter()
+        corpora = {name: build_corpus(root, name, args.scale, args.seed, copies) for name in names}
+        build_sec = time.perf_counter() - build_started
+        # The service prints each request; keep stdout for the report.
+        with contextlib.redirect_stdout(sys.stderr):
+            results = asyncio.run(run_scenarios(api, root, corpora, args))
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "job_workers": api.JOB_WORKERS,
+        "extract_workers": api.EXTRACT_WORKERS,
+        "zip_compression": args.zip_compression,
+        "scale": args.scale,
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "corpus_build_sec": round(build_sec, 2),
+        "peak_rss_mb": peak_rss_mb(),
+        "corpora": {name: {"entries": item["entries"], "bytes": item["bytes"]} for name, item in corpora.items()},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,22 @@
+import asyncio
+import errno
+import hashlib
 import io
 import json
 import os
 import sys
 import importlib
+import tarfile
 import tempfile
+import threading
+import time
 import unittest
 import zipfile
+import zlib
 from pathlib import Path
+from unittest import mock
 
+from aiohttp import web
 from fastapi import HTTPException
 from starlette.datastructures import UploadFile
 
@@ -77,6 +86,27 @@ class ZipFsApiTests(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(result["total_files"], 3)
         self.assertEqual(len(result["response"]["files"]), 3)
 
+    async def test_unzip_descriptors_carry_size_and_digest(self):
+        rel_zip_path = "data/dir_test/projects/1_4/files/a/b/c/source/digest.zip"
+        abs_zip_path = Path(self.tempdir.name) / rel_zip_path
+        abs_zip_path.parent.mkdir(parents=True, exist_ok=True)
+        stored = os.urandom(5000)
+        deflated = b"digest me " * 500
+        with zipfile.ZipFile(abs_zip_path, "w") as zf:
+            zf.writestr("stored.jpg", stored, compress_type=zipfile.ZIP_STORED)
+            zf.writestr("deflated.txt", deflated, compress_type=zipfile.ZIP_DEFLATED)
+
+        result = await self._call_process(self._build_message(rel_zip_path))
+        files = {item["label"]: item for item in result["response"]["files"]}
+        self.assertEqual(files["stored.jpg"]["size"], len(stored))
+        self.assertEqual(files["stored.jpg"]["digest"], "sha256:" + hashlib.sha256(stored).hexdigest())
+        self.assertEqual(files["deflated.txt"]["digest"], "sha256:" + hashlib.sha256(deflated).hexdigest())
+
+        message = self._build_message(rel_zip_path)
+        message["task"]["params"] = {"hash": "none"}
+        result = await self._call_process(message)
+        self.assertNotIn("digest", result["response"]["files"][0])
+
     async def test_process_filters_by_allowed_extensions(self):
         rel_zip_path = "data/dir_test/projects/1_4/files/a/b/c/source/mixed.zip"
         self._create_zip_in_md_path(
@@ -134,6 +164,413 @@ class ZipFsApiTests(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(ctx.exception.status_code, 400)
         self.assertIn("Invalid or corrupted zip file", str(ctx.exception.detail))
 
+    async def test_list_task_reports_entries_without_extracting(self):
+        rel_zip_path = "data/dir_test/projects/1_4/files/a/b/c/source/listing.zip"
+        abs_zip_path = Path(self.tempdir.name) / rel_zip_path
+        abs_zip_path.parent.mkdir(parents=True, exist_ok=True)
+        with zipfile.ZipFile(abs_zip_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("docs/", b"")
+            zf.writestr("docs/a.txt", b"a" * 1000)
+            zf.writestr("docs/b.txt", b"b" * 500)
+            zf.writestr("img/photo.jpg", b"jpg-bytes", compress_type=zipfile.ZIP_STORED)
+        tmp_root = Path(self.tempdir.name) / "data" / "dir_test" / "tmp"
+        before = set(os.listdir(tmp_root)) if tmp_root.exists() else set()
+
+        message = self._build_message(rel_zip_path)
+        message["task"] = {"id": "list", "params": {}}
+        result = await self._call_process(message)
+
+        self.assertEqual(result["status"], "success")
+        listing = result["response"]
+        self.assertEqual(listing["type"], "list")
+        self.assertEqual([item["name"] for item in listing["entries"]], ["docs/a.txt", "docs/b.txt", "img/photo.jpg"])
+        self.assertEqual(listing["entries"][2]["type"], "image")
+        self.assertEqual(listing["entries"][2]["ratio"], 1.0)
+        self.assertLess(listing["entries"][0]["ratio"], 0.1)
+        self.assertEqual(listing["extensions"]["txt"]["count"], 2)
+        self.assertEqual(listing["extensions"]["txt"]["size"], 1500)
+        self.assertEqual(listing["total_size"], 1509)
+        self.assertEqual(set(os.listdir(tmp_root)), before)
+
+    async def _read_streaming_response(self, response):
+        chunks = []
+        async for chunk in response.body_iterator:
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    async def test_entry_endpoint_streams_ranges_and_deflated_entries(self):
+        rel_zip_path = "data/dir_test/projects/1_4/files/a/b/c/source/preview.zip"
+        abs_zip_path = Path(self.tempdir.name) / rel_zip_path
+        abs_zip_path.parent.mkdir(parents=True, exist_ok=True)
+        image = bytes(range(256)) * 40
+        text = b"preview text " * 1000
+        with zipfile.ZipFile(abs_zip_path, "w") as zf:
+            zf.writestr("img/scan.png", image, compress_type=zipfile.ZIP_STORED)
+            zf.writestr("docs/notes.txt", text, compress_type=zipfile.ZIP_DEFLATED)
+
+        full = await self.api.stream_zip_entry(rel_zip_path, "img/scan.png", None)
+        self.assertEqual(full.status_code, 200)
+        self.assertEqual(await self._read_streaming_response(full), image)
+
+        partial = await self.api.stream_zip_entry(rel_zip_path, "img/scan.png", "bytes=100-199")
+        self.assertEqual(partial.status_code, 206)
+        self.assertEqual(partial.headers["content-range"], f"bytes 100-199/{len(image)}")
+        self.assertEqual(await self._read_streaming_response(partial), image[100:200])
+
+        suffix = await self.api.stream_zip_entry(rel_zip_path, "img/scan.png", "bytes=-10")
+        self.assertEqual(await self._read_streaming_response(suffix), image[-10:])
+
+        deflated = await self.api.stream_zip_entry(rel_zip_path, "docs/notes.txt", "bytes=0-9")
+        self.assertEqual(deflated.status_code, 200)
+        self.assertEqual(await self._read_streaming_response(deflated), text)
+
+        with self.assertRaises(HTTPException) as ctx:
+            await self.api.stream_zip_entry(rel_zip_path, "img/scan.png", f"bytes={len(image)}-")
+        self.assertEqual(ctx.exception.status_code, 416)
+
+        with self.assertRaises(HTTPException) as ctx:
+            await self.api.stream_zip_entry(rel_zip_path, "missing.txt", None)
+        self.assertEqual(ctx.exception.status_code, 404)
+
+        with self.assertRaises(HTTPException) as ctx:
+            await self.api.stream_zip_entry("../../etc/passwd", "x", None)
+        self.assertEqual(ctx.exception.status_code, 400)
+
+    async def test_unzip_ndjson_streams_file_records_then_summary(self):
+        rel_zip_path = "data/dir_test/projects/1_4/files/a/b/c/source/ndjson.zip"
+        entries = {f"docs/file_{i:03d}.txt": f"line {i}".encode() for i in range(40)}
+        entries["skip.bin"] = b"ignored"
+        self._create_zip_in_md_path(rel_zip_path, entries)
+
+        message = self._build_message(rel_zip_path)
+        message["task"]["params"] = {"allowed_extensions": ["txt"], "response_mode": "ndjson"}
+
+        def requests_total():
+            counts = {}
+            for status in ("success", "failed", "cancelled"):
+                key = self.api._metric_key("zipfs_requests_total", {"task": "unzip", "db": "dir_test", "status": status})
+                counts[status] = self.api._metric_values.get(key, 0)
+            return counts
+
+        baseline = requests_total()
+        response = await self._call_process(message)
+        self.assertEqual(response.media_type, "application/x-ndjson")
+        lines = (await self._read_streaming_response(response)).decode("utf-8").splitlines()
+        records = [json.loads(line) for line in lines]
+
+        files = [record for record in records if record["record"] == "file"]
+        self.assertEqual(sorted(item["label"] for item in files), sorted(name.split("/")[-1] for name in entries if name.endswith(".txt")))
+        for item in files:
+            self.assertTrue((Path(self.tempdir.name) / "data/dir_test/tmp" / item["path"]).exists())
+        self.assertEqual(records[-1]["record"], "summary")
+        self.assertEqual(records[-1]["status"], "success")
+        self.assertEqual(records[-1]["total_files"], 40)
+
+        # Admission is reserved only once the body starts and released when it stops.
+        admission = self.api._admission
+        dropped = await self._call_process(message)
+        self.assertEqual((admission.in_flight_jobs, admission.in_flight_bytes), (0, 0))
+        del dropped
+        abandoned = await self._call_process(message)
+        body = abandoned.body_iterator
+        self.assertEqual(json.loads(await body.__anext__())["record"], "file")
+        await body.aclose()
+        for _ in range(100):
+            if admission.in_flight_jobs == 0:
+                break
+            await asyncio.sleep(0.02)
+        self.assertEqual((admission.in_flight_jobs, admission.in_flight_bytes), (0, 0))
+
+        # The request counter follows the summary record, not the response headers.
+        rejection = HTTPException(503, "Not enough tmp capacity")
+        with mock.patch.object(admission, "acquire", side_effect=rejection):
+            rejected = await self._call_process(message)
+            summary = json.loads(await self._read_streaming_response(rejected))
+        self.assertEqual(summary["error"]["status_code"], 503)
+        counts = requests_total()
+        self.assertEqual(
+            {status: counts[status] - baseline[status] for status in counts},
+            {"success": 1, "failed": 1, "cancelled": 1},
+        )
+
+        message["task"]["params"]["allowed_extensions"] = ["pdf"]
+        with self.assertRaises(HTTPException) as ctx:
+            await self._call_process(message)
+        self.assertEqual(ctx.exception.status_code, 404)
+
+    async def test_metrics_endpoint_reports_stage_histograms_and_counters(self):
+        rel_zip_path = "data/metrics_db/projects/1_4/files/a/source/metrics.zip"
+        self._create_zip_in_md_path(rel_zip_path, {"a.txt": b"a" * 1000, "b.txt": b"b" * 2000})
+        with mock.patch.object(self.api, "_tmp_usage_cache", (0.0, {})):
+            await self._call_process(self._build_message(rel_zip_path))
+            response = await self.api.metrics()
+        body = response.body.decode("utf-8")
+        samples = {}
+        for line in body.splitlines():
+            if line and not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = float(value)
+
+        labels = 'db="metrics_db",task="unzip"'
+        self.assertIn("# TYPE zipfs_request_duration_seconds histogram", body)
+        self.assertEqual(samples['zipfs_requests_total{db="metrics_db",status="success",task="unzip"}'], 1)
+        self.assertEqual(samples[f"zipfs_jobs_in_flight{{{labels}}}"], 0)
+        self.assertEqual(samples[f"zipfs_entries_total{{{labels}}}"], 2)
+        self.assertEqual(samples[f"zipfs_bytes_written_total{{{labels}}}"], 3000)
+        self.assertEqual(samples[f"zipfs_request_parse_seconds_count{{{labels}}}"], 1)
+        self.assertEqual(samples[f'zipfs_entry_throughput_bytes_per_second_bucket{{{labels},le="+Inf"}}'], 2)
+        self.assertEqual(samples['zipfs_index_load_seconds_count{db="metrics_db",source="archive"}'], 1)
+        self.assertEqual(samples['zipfs_tmp_disk_usage_bytes{db="metrics_db"}'], 3000)
+        self.assertIn('zipfs_executor_queue_depth{pool="job"}', samples)
+
+    async def test_admission_queues_over_budget_and_rejects_after_timeout(self):
+        controller = self.api.AdmissionController()
+        tmp_root = self.tempdir.name
+        with mock.patch.multiple(
+            self.api, ADMISSION_MAX_INFLIGHT_BYTES=150, ADMISSION_MIN_FREE_BYTES=0, ADMISSION_QUEUE_TIMEOUT_SEC=5
+        ):
+            await controller.acquire(100, tmp_root)
+            waiter = asyncio.ensure_future(controller.acquire(100, tmp_root))
+            await asyncio.sleep(0.05)
+            self.assertFalse(waiter.done())
+            self.assertEqual(controller.snapshot([])["waiting"], 1)
+            await controller.release(100)
+            await asyncio.wait_for(waiter, 1)
+            self.assertEqual(controller.in_flight_bytes, 100)
+
+            with mock.patch.object(self.api, "ADMISSION_QUEUE_TIMEOUT_SEC", 0.1):
+                with self.assertRaises(HTTPException) as ctx:
+                    await controller.acquire(100, tmp_root)
+            self.assertEqual(ctx.exception.status_code, 503)
+            self.assertIn("Retry-After", ctx.exception.headers)
+            self.assertEqual(controller.rejected_total, 1)
+            await controller.release(100)
+            self.assertEqual((controller.in_flight_bytes, controller.in_flight_jobs), (0, 0))
+
+    async def test_unzip_rejected_when_tmp_disk_cannot_hold_it(self):
+        rel_zip_path = "data/dir_test/projects/1_4/files/a/b/c/source/admission.zip"
+        self._create_zip_in_md_path(rel_zip_path, {"big.txt": b"x" * 4096})
+        with mock.patch.object(self.api, "ADMISSION_MIN_FREE_BYTES", 1 << 62):
+            with self.assertRaises(HTTPException) as ctx:
+                await self._call_process(self._build_message(rel_zip_path))
+        self.assertEqual(ctx.exception.status_code, 503)
+        self.assertFalse(any((Path(self.tempdir.name) / "data/dir_test/tmp").glob("zipfs_*_big.txt")))
+
+        state = await self.api.admission_state()
+        self.assertEqual(state["in_flight_bytes"], 0)
+        self.assertGreaterEqual(state["rejected_total"], 1)
+        self.assertIn("data/dir_test/tmp", state["tmp_free_bytes"])
+
+    def test_tmp_gc_removes_by_age_quota_and_orphaned_parts(self):
+        tmp_root = Path(self.tempdir.name) / "data" / "gc_db" / "tmp"
+        tmp_root.mkdir(parents=True, exist_ok=True)
+        now = time.time()
+
+        def make(name, size, age):
+            path = tmp_root / name
+            path.write_bytes(b"x" * size)
+            os.utime(path, (now - age, now - age))
+            return path
+
+        expired = make("zipfs_aaa_old.txt", 10, 7200)
+        set_zip = make("export.zip", 10, 7200)
+        self.api.track_tmp_file("gc_db", "export.zip")
+        foreign = make("backend_upload.bin", 10, 7200)
+        lru = make("zipfs_bbb_lru.txt", 600, 300)
+        recent = make("zipfs_ccc_recent.txt", 600, 10)
+        orphan = make("crashed.zip.part", 10, 7200)
+        self.api.track_tmp_file("gc_db", "crashed.zip.part")
+        spool = make(".zipfs_deflate_0123.part", 10, 7200)
+        foreign_part = make("other_service_upload.pdf.part", 10, 7200)
+        active = make("running.zip.part", 10, 7200)
+        self.api._active_tmp_writes.add(str(active))
+        try:
+            with mock.patch.multiple(self.api, TMP_MAX_AGE_SEC=3600, TMP_QUOTA_BYTES=1000, TMP_GC_PART_GRACE_SEC=600):
+                removed = self.api.gc_tmp_dir("gc_db", now=now)
+        finally:
+            self.api._active_tmp_writes.discard(str(active))
+
+        self.assertEqual(removed, {"orphan_part": 2, "age": 2, "quota": 1})
+        for path in (expired, set_zip, orphan, spool, lru):
+            self.assertFalse(path.exists(), path.name)
+        # .part files this service did not write are someone else's upload in progress.
+        for path in (foreign, foreign_part, recent, active):
+            self.assertTrue(path.exists(), path.name)
+        journal = Path(self.tempdir.name) / "data" / "gc_db" / "zipfs" / "tmp_gc" / "tracked"
+        self.assertEqual(journal.read_text(encoding="utf-8"), "")
+
+    async def test_unzip_resumes_from_checkpoint_after_restart(self):
+        rel_zip_path = "data/dir_test/projects/1_4/files/a/b/c/source/resume.zip"
+        entries = {f"docs/part_{i}.txt": (f"part {i} " * 200).encode() for i in range(6)}
+        self._create_zip_in_md_path(rel_zip_path, entries)
+        tmp_root = Path(self.tempdir.name) / "data" / "dir_test" / "tmp"
+        checkpoint_dir = Path(self.tempdir.name) / "data" / "dir_test" / "zipfs" / "checkpoints"
+
+        with mock.patch.multiple(self.api, CHECKPOINT_MIN_ENTRIES=0, SINGLE_FLIGHT_TTL_SEC=0):
+            # A run that dies before finishing leaves its journal behind.
+            with mock.patch.object(self.api.ExtractCheckpoint, "close"):
+                first = await self._call_process(self._build_message(rel_zip_path))
+            journals = list(checkpoint_dir.glob("*.jsonl"))
+            self.assertEqual(len(journals), 1)
+            first_files = first["response"]["files"]
+            (tmp_root / first_files[1]["path"]).unlink()
+            (tmp_root / first_files[2]["path"]).write_bytes(b"corrupted")
+            lines = journals[0].read_text(encoding="utf-8").splitlines()
+            kept = [line for line in lines[1:] if json.loads(line)["index"] != 5]
+            journals[0].write_text("\n".join([lines[0]] + kept + ['{"index": 5, "cr']), encoding="utf-8")
+
+            real_extract = self.api.extract_entry
+            extracted = []
+
+            def counting_extract(fp, zip_path, info, *args, **kwargs):
+                extracted.append(info.filename)
+                return real_extract(fp, zip_path, info, *args, **kwargs)
+
+            with mock.patch.object(self.api, "extract_entry", side_effect=counting_extract):
+                second = await self._call_process(self._build_message(rel_zip_path))
+
+        self.assertEqual(len(extracted), 3)
+        self.assertEqual(second["total_files"], 6)
+        files = second["response"]["files"]
+        self.assertEqual([item["label"] for item in files], [os.path.basename(name) for name in entries])
+        self.assertEqual(files[0]["path"], first_files[0]["path"])
+        for item, name in zip(files, entries):
+            self.assertEqual((tmp_root / item["path"]).read_bytes(), entries[name])
+        self.assertFalse((tmp_root / first_files[2]["path"]).exists())
+        self.assertEqual(list(checkpoint_dir.glob("*.jsonl")), [])
+
+    async def test_recursive_unzip_expands_nested_archives_with_limits(self):
+        def zip_bytes(entries):
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+                for name, content in entries.items():
+                    zf.writestr(name, content)
+            return buffer.getvalue()
+
+        deep = zip_bytes({"b.txt": b"deep"})
+        inner = zip_bytes({"docs/a.txt": b"inner", "deep.zip": deep, "skip.bin": b"x"})
+        rel_zip_path = "data/dir_test/projects/1_4/files/a/b/c/source/nested.zip"
+        self._create_zip_in_md_path(
+            rel_zip_path,
+            {"top.txt": b"top", "bundle/inner.zip": inner, "inner2.zip": zip_bytes({"c.txt": b"second"})},
+        )
+        tmp_root = Path(self.tempdir.name) / "data" / "dir_test" / "tmp"
+        message = self._build_message(rel_zip_path)
+        message["task"]["params"] = {"allowed_extensions": ["txt"], "recursive": True}
+        patcher = mock.patch.object(self.api, "SINGLE_FLIGHT_TTL_SEC", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        real_spool = tempfile.SpooledTemporaryFile
+        with mock.patch.object(self.api.tempfile, "SpooledTemporaryFile", side_effect=real_spool) as spool:
+            result = await self._call_process(message)
+        # Spools that reach tmp carry the prefix the tmp GC collects.
+        self.assertTrue(all(call.kwargs["prefix"].startswith("zipfs_") for call in spool.call_args_list))
+        self.assertEqual(spool.call_count, 3)
+        files = {item["label"]: item for item in result["response"]["files"]}
+        self.assertEqual(
+            set(files),
+            {"top.txt", "bundle/inner.zip/docs/a.txt", "bundle/inner.zip/deep.zip/b.txt", "inner2.zip/c.txt"},
+        )
+        self.assertEqual((tmp_root / files["bundle/inner.zip/deep.zip/b.txt"]["path"]).read_bytes(), b"deep")
+        self.assertEqual(files["inner2.zip/c.txt"]["digest"], "sha256:" + hashlib.sha256(b"second").hexdigest())
+
+        with mock.patch.object(self.api, "NESTED_MAX_DEPTH", 1):
+            result = await self._call_process(message)
+        self.assertNotIn("bundle/inner.zip/deep.zip/b.txt", {item["label"] for item in result["response"]["files"]})
+
+        before = set(tmp_root.iterdir())
+        with mock.patch.object(self.api, "NESTED_MAX_TOTAL_BYTES", len(inner)):
+            with self.assertRaises(HTTPException) as ctx:
+                await self._call_process(message)
+        self.assertEqual(ctx.exception.status_code, 413)
+        self.assertEqual(set(tmp_root.iterdir()), before)
+
+    async def test_unzip_streams_compressed_tarballs(self):
+        entries = {"docs/a.txt": b"alpha", "b.txt": b"beta" * 1000, "skip.bin": b"x"}
+        tmp_root = Path(self.tempdir.name) / "data" / "dir_test" / "tmp"
+        for suffix, mode in (("tar.gz", "w:gz"), ("tar.xz", "w:xz")):
+            rel_path = f"data/dir_test/projects/1_4/files/a/b/c/source/bundle.{suffix}"
+            target = Path(self.tempdir.name) / rel_path
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with tarfile.open(target, mode) as tf:
+                tf.addfile(tarfile.TarInfo("docs"), None)
+                for name, content in entries.items():
+                    info = tarfile.TarInfo(name)
+                    info.size = len(content)
+                    tf.addfile(info, io.BytesIO(content))
+            message = self._build_message(rel_path)
+            message["task"]["params"] = {"allowed_extensions": ["txt"]}
+
+            result = await self._call_process(message)
+
+            files = result["response"]["files"]
+            self.assertEqual([item["label"] for item in files], ["a.txt", "b.txt"])
+            self.assertEqual((tmp_root / files[1]["path"]).read_bytes(), entries["b.txt"])
+            self.assertEqual(files[0]["digest"], "sha256:" + hashlib.sha256(b"alpha").hexdigest())
+            if suffix == "tar.gz":
+                self.assertGreaterEqual(self.api.get_tar_admission_bytes(str(target)), sum(map(len, entries.values())))
+
+        target.write_bytes(b"\xfd7zXZ\x00" + b"garbage" * 10)
+        with self.assertRaises(HTTPException) as ctx:
+            await self._call_process(self._build_message(rel_path))
+        self.assertEqual(ctx.exception.status_code, 400)
+
+    async def test_set_zip_prefetches_sources_within_memory_budget(self):
+        src_dir = Path(self.tempdir.name) / "data" / "dir_test" / "projects" / "1_4" / "files" / "prefetch"
+        src_dir.mkdir(parents=True, exist_ok=True)
+        contents = {"a.txt": b"aaaaa", "big.bin": b"B" * 100, "c.txt": b"ccccc", "d.txt": b"ddddd"}
+        for name, data in contents.items():
+            (src_dir / name).write_bytes(data)
+        message = {
+            "task": {"id": "zip", "params": {"compression": "stored"}},
+            "set_rid": "#127:6",
+            "db_name": "dir_test",
+            "zip_output_name": "prefetch.zip",
+            "set_files": [
+                {"path": f"data/dir_test/projects/1_4/files/prefetch/{name}", "label": name} for name in contents
+            ],
+        }
+        real_read_ahead = self.api.read_ahead
+        reads = []
+
+        def recording_read_ahead(abs_path, buffer):
+            reads.append((os.path.basename(abs_path), buffer))
+            return real_read_ahead(abs_path, buffer)
+
+        with mock.patch.multiple(
+            self.api, PREFETCH_FILES=3, PREFETCH_MEMORY_BYTES=10, PREFETCH_MAX_FILE_BYTES=10
+        ), mock.patch.object(self.api, "read_ahead", side_effect=recording_read_ahead):
+            prefetcher = self.api.SetFilePrefetcher([str(src_dir / name) for name in contents])
+            prefetcher._fill()
+            self.assertEqual(prefetcher._buffered, 10)
+            self.assertEqual(len(prefetcher._pending), 3)
+            # The budget is process-wide: a concurrent prefetcher gets nothing buffered.
+            self.assertEqual(self.api._prefetch_budget["bytes"], 10)
+            with self.api.SetFilePrefetcher([str(src_dir / "c.txt")]) as other:
+                self.assertIsNone(other.take())
+            with prefetcher:
+                self.assertEqual([prefetcher.take() for _ in contents], [b"aaaaa", None, b"ccccc", b"ddddd"])
+            self.assertEqual(self.api._prefetch_budget["bytes"], 0)
+            result = await self._call_process(message)
+
+        self.assertIn(("big.bin", False), reads)
+        self.assertIn(("d.txt", True), reads)
+        self.assertEqual(result["zipped_files"], 4)
+        with zipfile.ZipFile(Path(self.tempdir.name) / "data" / "dir_test" / "tmp" / "prefetch.zip") as zf:
+            self.assertEqual(zf.namelist(), [*contents, "README.txt"])
+            for name, data in contents.items():
+                self.assertEqual(zf.read(name), data)
+
+    def test_partition_set_entries_sizes_deflate_parts_at_worst_case(self):
+        entries = [("/src/a.bin", "a.bin"), ("/src/b.bin", "b.bin")]
+        sizes = [1024 * 1024, 1024 * 1024]
+        max_part_size = self.api.ZIP_PART_RESERVE_BYTES + 2 * 1024 * 1024 + 2 * 200
+        self.assertEqual(self.api.partition_set_entries(entries, sizes, max_part_size, "stored"), [[0, 1]])
+        # Incompressible data grows when deflated, so the same two files no longer fit together.
+        self.assertEqual(self.api.partition_set_entries(entries, sizes, max_part_size, "deflate"), [[0], [1]])
+        self.assertEqual(self.api.partition_set_entries(entries, sizes, max_part_size, "auto"), [[0], [1]])
+
     async def test_zip_task_creates_archive_in_tmp_without_backend_callback(self):
         data_root = Path(self.tempdir.name) / "data" / "dir_test"
         src_dir = data_root / "projects" / "1_4" / "files" / "set_export"
@@ -168,12 +605,611 @@ class ZipFsApiTests(unittest.IsolatedAsyncioTestCase):
 
         zip_path = Path(self.tempdir.name) / "data" / "dir_test" / "tmp" / output_name
         self.assertTrue(zip_path.exists())
+        archive_bytes = zip_path.read_bytes()
+        descriptor = result["response"]["files"][0]
+        self.assertEqual(descriptor["size"], len(archive_bytes))
+        self.assertEqual(descriptor["digest"], "sha256:" + hashlib.sha256(archive_bytes).hexdigest())
         with zipfile.ZipFile(zip_path, "r") as zf:
             names = set(zf.namelist())
             self.assertIn("a.txt", names)
             self.assertIn("b.jpg", names)
             self.assertIn("README.txt", names)
 
+    async def test_zip_task_splits_set_into_self_contained_parts(self):
+        src_dir = Path(self.tempdir.name) / "data" / "dir_test" / "projects" / "1_4" / "files" / "parts"
+        src_dir.mkdir(parents=True, exist_ok=True)
+        names = [f"scan_{index}.jpg" for index in range(5)]
+        for index, name in enumerate(names):
+            (src_dir / name).write_bytes(bytes([index]) * 40 * 1024)
+        message = {
+            "task": {"id": "zip", "params": {"max_part_size": 64 * 1024 + 100 * 1024}},
+            "set_rid": "#127:7",
+            "db_name": "dir_test",
+            "zip_output_name": "volumes.zip",
+            "set_files": [{"path": f"data/dir_test/projects/1_4/files/parts/{name}", "label": name} for name in names],
+        }
+
+        result = await self._call_process(message)
+
+        files = result["response"]["files"]
+        self.assertEqual(result["zipped_files"], 5)
+        self.assertEqual(
+            [item["label"] for item in files], ["volumes_part01.zip", "volumes_part02.zip", "volumes_part03.zip"]
+        )
+        tmp_root = Path(self.tempdir.name) / "data" / "dir_test" / "tmp"
+        self.assertFalse((tmp_root / "volumes.zip").exists())
+        archived = []
+        for number, item in enumerate(files, start=1):
+            archive_bytes = (tmp_root / item["path"]).read_bytes()
+            self.assertLessEqual(len(archive_bytes), 64 * 1024 + 100 * 1024)
+            self.assertEqual(item["digest"], "sha256:" + hashlib.sha256(archive_bytes).hexdigest())
+            with zipfile.ZipFile(io.BytesIO(archive_bytes)) as zf:
+                members = [name for name in zf.namelist() if name != "README.txt"]
+                readme = zf.read("README.txt").decode("utf-8")
+                self.assertIn(f"Part: {number} of 3", readme)
+                self.assertIn(f"Files included: {len(members)}", readme)
+                archived += members
+        self.assertEqual(archived, names)
+
+        message["task"]["params"]["max_part_size"] = "tiny"
+        with self.assertRaises(HTTPException) as ctx:
+            await self._call_process(message)
+        self.assertEqual(ctx.exception.status_code, 400)
+
+    async def test_zip_task_rebuilds_set_incrementally_from_manifest(self):
+        data_root = Path(self.tempdir.name) / "data" / "dir_test"
+        src_dir = data_root / "projects" / "1_4" / "files" / "incremental"
+        src_dir.mkdir(parents=True, exist_ok=True)
+        for name, data in {"a.txt": b"alpha" * 100, "b.txt": b"beta" * 100, "c.txt": b"gamma"}.items():
+            (src_dir / name).write_bytes(data)
+
+        def message(names):
+            return {
+                "task": {"id": "zip", "params": {"compression": "deflate"}},
+                "set_rid": "#127:8",
+                "db_name": "dir_test",
+                "zip_output_name": "incremental.zip",
+                "set_files": [
+                    {"path": f"data/dir_test/projects/1_4/files/incremental/{name}", "label": name} for name in names
+                ],
+            }
+
+        patcher = mock.patch.multiple(self.api, SINGLE_FLIGHT_TTL_SEC=0, ZIP_MANIFEST_ENABLED=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        first = await self._call_process(message(["a.txt", "b.txt", "c.txt"]))
+        self.assertEqual(first["reused_files"], 0)
+
+        (src_dir / "c.txt").write_bytes(b"gamma changed")
+        (src_dir / "d.txt").write_bytes(b"delta")
+        second = await self._call_process(message(["a.txt", "b.txt", "c.txt", "d.txt"]))
+
+        self.assertEqual(second["reused_files"], 2)
+        self.assertEqual([item["method"] for item in second["entry_compression"]], ["deflate"] * 4)
+        with zipfile.ZipFile(data_root / "tmp" / "incremental.zip") as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.namelist(), ["a.txt", "b.txt", "c.txt", "d.txt", "README.txt"])
+            self.assertEqual(zf.getinfo("a.txt").compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(zf.read("a.txt"), b"alpha" * 100)
+            self.assertEqual(zf.read("c.txt"), b"gamma changed")
+            self.assertIn("Files included: 4", zf.read("README.txt").decode("utf-8"))
+        key = hashlib.sha1(b"#127:8").hexdigest()
+        retained = sorted(path.suffix for path in (data_root / "zipfs" / "manifests").glob(key + "*"))
+        self.assertEqual(retained, [".json", ".zip"])
+
+        (data_root / "tmp" / "incremental.zip").unlink()
+        third = await self._call_process(message(["b.txt", "d.txt"]))
+        self.assertEqual(third["reused_files"], 2)
+        with zipfile.ZipFile(data_root / "tmp" / "incremental.zip") as zf:
+            self.assertEqual(zf.read("d.txt"), b"delta")
+
+    async def test_zip_task_deflate_mode_writes_compressed_entries(self):
+        src_dir = Path(self.tempdir.name) / "data" / "dir_test" / "projects" / "1_4" / "files" / "set_deflate"
+        src_dir.mkdir(parents=True, exist_ok=True)
+        text = ("MessyDesk line of text\n" * 5000).encode("utf-8")
+        (src_dir / "notes.txt").write_bytes(text)
+        (src_dir / "data.json").write_bytes(json.dumps({"rows": list(range(2000))}).encode("utf-8"))
+
+        output_name = "set_deflate_test.zip"
+        message = {
+            "task": {"id": "zip", "params": {"compression": "deflate"}},
+            "set_rid": "#127:6",
+            "db_name": "dir_test",
+            "zip_output_name": output_name,
+            "set_files": [
+                {"path": "data/dir_test/projects/1_4/files/set_deflate/notes.txt", "label": "notes.txt"},
+                {"path": "data/dir_test/projects/1_4/files/set_deflate/data.json", "label": "data.json"},
+            ],
+        }
+
+        result = await self._call_process(message)
+
+        self.assertEqual(result["compression"], "deflate")
+        tmp_root = Path(self.tempdir.name) / "data" / "dir_test" / "tmp"
+        self.assertFalse([name for name in os.listdir(tmp_root) if name.startswith(".zipfs_deflate_")])
+        with zipfile.ZipFile(tmp_root / output_name, "r") as zf:
+            self.assertIsNone(zf.testzip())
+            info = zf.getinfo("notes.txt")
+            self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+            self.assertLess(info.compress_size, len(text) // 10)
+            self.assertEqual(zf.read("notes.txt"), text)
+            self.assertEqual(zf.namelist(), ["notes.txt", "data.json", "README.txt"])
+
+    async def test_zip_task_auto_mode_chooses_method_per_entry(self):
+        src_dir = Path(self.tempdir.name) / "data" / "dir_test" / "projects" / "1_4" / "files" / "set_auto"
+        src_dir.mkdir(parents=True, exist_ok=True)
+        (src_dir / "scan.jpg").write_bytes(b"jpeg " * 4000)
+        (src_dir / "table.csv").write_bytes(b"a,b,c\n" * 4000)
+        (src_dir / "noise.dat").write_bytes(os.urandom(20000))
+        (src_dir / "repeat.dat").write_bytes(b"\x00\x01" * 20000)
+
+        output_name = "set_auto_test.zip"
+        base = "data/dir_test/projects/1_4/files/set_auto/"
+        message = {
+            "task": {"id": "zip", "params": {"compression": "auto"}},
+            "set_rid": "#127:7",
+            "db_name": "dir_test",
+            "zip_output_name": output_name,
+            "set_files": [
+                {"path": base + name, "label": name}
+                for name in ("scan.jpg", "table.csv", "noise.dat", "repeat.dat")
+            ],
+        }
+
+        result = await self._call_process(message)
+
+        methods = {item["name"]: item["method"] for item in result["entry_compression"]}
+        self.assertEqual(
+            methods,
+            {"scan.jpg": "stored", "table.csv": "deflate", "noise.dat": "stored", "repeat.dat": "deflate"},
+        )
+        zip_path = Path(self.tempdir.name) / "data" / "dir_test" / "tmp" / output_name
+        with zipfile.ZipFile(zip_path, "r") as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.getinfo("scan.jpg").compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(zf.getinfo("repeat.dat").compress_type, zipfile.ZIP_DEFLATED)
+
+    async def test_zip_task_stream_delivery_skips_tmp(self):
+        src_dir = Path(self.tempdir.name) / "data" / "dir_stream" / "projects" / "1_4" / "files" / "set_stream"
+        src_dir.mkdir(parents=True, exist_ok=True)
+        big = os.urandom(3 * 1024 * 1024 + 17)
+        (src_dir / "big.bin").write_bytes(big)
+        (src_dir / "notes.txt").write_text("streamed notes\n" * 100, encoding="utf-8")
+
+        base = "data/dir_stream/projects/1_4/files/set_stream/"
+        message = {
+            "task": {"id": "zip", "params": {"delivery": "stream", "compression": "auto"}},
+            "set_rid": "#127:8",
+            "db_name": "dir_stream",
+            "zip_output_name": "streamed.zip",
+            "set_files": [
+                {"path": base + "big.bin", "label": "big.bin"},
+                {"path": base + "notes.txt", "label": "notes.txt"},
+                {"path": base + "missing.txt", "label": "missing.txt"},
+            ],
+        }
+
+        real_choose = self.api.choose_entry_compression
+        threads = set()
+
+        def recording_choose(*args):
+            threads.add(threading.current_thread().name)
+            return real_choose(*args)
+
+        with mock.patch.object(self.api, "choose_entry_compression", side_effect=recording_choose) as choose:
+            response = await self._call_process(message)
+            # Auto mode decides per entry while streaming, not before the first byte.
+            self.assertEqual(choose.call_count, 0)
+            chunks = [chunk async for chunk in response.body_iterator]
+            self.assertEqual(choose.call_count, 2)
+        # The body is produced in the job pool, so JOB_WORKERS bounds concurrent streams.
+        self.assertTrue(all(name.startswith("zipfs-job") for name in threads), threads)
+
+        self.assertEqual(response.media_type, "application/zip")
+        self.assertEqual(response.headers["x-skipped-files"], "1")
+        self.assertGreater(len(chunks), 1)
+        with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.namelist(), ["big.bin", "notes.txt", "README.txt"])
+            self.assertEqual(zf.read("big.bin"), big)
+            self.assertTrue(zf.getinfo("big.bin").flag_bits & 0x08)
+            self.assertEqual(zf.getinfo("notes.txt").compress_type, zipfile.ZIP_DEFLATED)
+        self.assertFalse((Path(self.tempdir.name) / "data" / "dir_stream" / "tmp").exists())
+
+    async def test_identical_concurrent_unzips_are_coalesced(self):
+        rel_zip_path = "data/dir_test/projects/1_4/files/a/b/c/source/coalesce.zip"
+        self._create_zip_in_md_path(rel_zip_path, {"docs/one.txt": b"1", "docs/two.txt": b"2"})
+        calls = []
+        original = self.api.extract_zip_to_tmp
+
+        def counting_extract(*args, **kwargs):
+            calls.append(args)
+            return original(*args, **kwargs)
+
+        with mock.patch.object(self.api, "extract_zip_to_tmp", counting_extract):
+            first, second = await asyncio.gather(
+                self._call_process(self._build_message(rel_zip_path)),
+                self._call_process(self._build_message(rel_zip_path)),
+            )
+            redelivered = await self._call_process(self._build_message(rel_zip_path))
+            self.assertEqual(len(calls), 1)
+
+            paths = [item["path"] for item in first["response"]["files"]]
+            self.assertEqual([item["path"] for item in second["response"]["files"]], paths)
+            self.assertEqual([item["path"] for item in redelivered["response"]["files"]], paths)
+
+            # Once the adapter has consumed the outputs, a redelivery extracts again.
+            tmp_root = Path(self.tempdir.name) / "data" / "dir_test" / "tmp"
+            for path in paths:
+                (tmp_root / path).unlink()
+            fresh = await self._call_process(self._build_message(rel_zip_path))
+            self.assertEqual(len(calls), 2)
+            self.assertTrue(all((tmp_root / item["path"]).exists() for item in fresh["response"]["files"]))
+
+    def _upload(self, payload):
+        return UploadFile(filename="request.json", file=io.BytesIO(json.dumps(payload).encode("utf-8")))
+
+    async def _wait_for_job(self, job_id):
+        for _ in range(200):
+            status = await self.api.job_status(job_id)
+            if status["finished_at"] is not None:
+                return status
+            await asyncio.sleep(0.01)
+        self.fail("job did not finish")
+
+    async def test_job_api_submit_poll_and_result(self):
+        rel_zip_path = "data/dir_test/projects/1_4/files/a/b/c/source/job.zip"
+        self._create_zip_in_md_path(rel_zip_path, {"docs/a.txt": b"alpha", "docs/b.txt": b"beta"})
+
+        submitted = await self.api.submit_job(self._upload(self._build_message(rel_zip_path)))
+        status = await self._wait_for_job(submitted["job_id"])
+
+        self.assertEqual(status["status"], "succeeded")
+        self.assertEqual(status["progress"]["entries_done"], 2)
+        self.assertEqual(status["progress"]["bytes_written"], 9)
+        result = await self.api.job_result(submitted["job_id"])
+        self.assertEqual(result["response"]["type"], "disk")
+        self.assertEqual(result["total_files"], 2)
+
+        with self.assertRaises(HTTPException) as ctx:
+            await self.api.job_status("missing")
+        self.assertEqual(ctx.exception.status_code, 404)
+
+    async def test_job_api_cancel_removes_partial_outputs(self):
+        rel_zip_path = "data/dir_cancel/projects/1_4/files/a/source/cancel.zip"
+        self._create_zip_in_md_path(rel_zip_path, {f"docs/{i}.txt": b"x" * 100 for i in range(20)})
+        tmp_root = Path(self.tempdir.name) / "data" / "dir_cancel" / "tmp"
+
+        release = threading.Event()
+        blockers = [
+            asyncio.ensure_future(self.api.run_in_worker(release.wait, 5))
+            for _ in range(self.api.JOB_WORKERS)
+        ]
+        try:
+            submitted = await self.api.submit_job(self._upload(self._build_message(rel_zip_path)))
+            await asyncio.sleep(0.05)
+            cancelled = await self.api.cancel_job(submitted["job_id"])
+            self.assertEqual(cancelled["status"], "cancelling")
+        finally:
+            release.set()
+            await asyncio.gather(*blockers)
+
+        status = await self._wait_for_job(submitted["job_id"])
+        self.assertEqual(status["status"], "cancelled")
+        self.assertEqual(os.listdir(tmp_root), [])
+        with self.assertRaises(HTTPException) as ctx:
+            await self.api.job_result(submitted["job_id"])
+        self.assertEqual(ctx.exception.status_code, 410)
+
+    async def _start_callback_stub(self, statuses):
+        received = []
+
+        async def handle(request):
+            received.append(await request.json())
+            status = statuses.pop(0) if statuses else 200
+            return web.json_response({"ok": status < 400}, status=status)
+
+        stub = web.Application()
+        stub.router.add_post("/api/nomad/process/files/tmp", handle)
+        runner = web.AppRunner(stub)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.addAsyncCleanup(runner.cleanup)
+        self.addAsyncCleanup(self.api.close_callback_session)
+        return f"http://127.0.0.1:{port}", received
+
+    async def test_callbacks_push_extracted_files_to_messydesk(self):
+        url, received = await self._start_callback_stub([503])
+        rel_zip_path = "data/dir_test/projects/1_4/files/a/b/c/source/callback.zip"
+        self._create_zip_in_md_path(rel_zip_path, {"docs/a.txt": b"a", "docs/b.txt": b"b", "docs/c.txt": b"c"})
+
+        message = self._build_message(rel_zip_path)
+        message["task"]["params"] = {"callback": True}
+        with mock.patch.object(self.api, "MD_URL", url), mock.patch.object(
+            self.api, "MD_CALLBACK_RETRY_BACKOFF_SEC", 0.01
+        ):
+            result = await self._call_process(message)
+
+        self.assertEqual(result["callbacks"], {"delivered": 3, "failed": 0})
+        self.assertTrue(all(item["delivered"] for item in result["response"]["files"]))
+        # First post hit the 503 and was retried.
+        self.assertEqual(len(received), 4)
+        posted = {item["tmp_path"] for body in received for item in body["files"]}
+        self.assertEqual(posted, {item["path"] for item in result["response"]["files"]})
+        self.assertEqual(received[0]["process"], {"@rid": "#106:13"})
+        self.assertEqual(received[0]["output_set"], "#127:5")
+
+    async def test_coalesced_callback_requests_share_delivery_counts(self):
+        url, received = await self._start_callback_stub([])
+        rel_zip_path = "data/dir_test/projects/1_4/files/a/b/c/source/callback-join.zip"
+        self._create_zip_in_md_path(rel_zip_path, {"docs/a.txt": b"a", "docs/b.txt": b"b"})
+
+        message = self._build_message(rel_zip_path)
+        message["task"]["params"] = {"callback": True}
+        with mock.patch.object(self.api, "MD_URL", url), mock.patch.object(self.api, "MD_CALLBACK_WORKERS", 1):
+            first, second = await asyncio.gather(self._call_process(message), self._call_process(message))
+
+        self.assertEqual(first["callbacks"], {"delivered": 2, "failed": 0})
+        self.assertEqual(second["callbacks"], {"delivered": 2, "failed": 0})
+        self.assertTrue(all(item.get("delivered") for item in second["response"]["files"]))
+        self.assertEqual(len(received), 2)
+        self.assertEqual(self.api._flight_dispatchers, {})
+        self.assertEqual(len(self.api._callback_pool["workers"]), 1)
+
+    async def test_callbacks_report_failures_without_failing_the_job(self):
+        url, received = await self._start_callback_stub([400])
+        rel_zip_path = "data/dir_test/projects/1_4/files/a/b/c/source/callback-fail.zip"
+        self._create_zip_in_md_path(rel_zip_path, {"docs/only.txt": b"only"})
+
+        message = self._build_message(rel_zip_path)
+        message["task"]["params"] = {"callback": True}
+        with mock.patch.object(self.api, "MD_URL", url):
+            result = await self._call_process(message)
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(result["callbacks"], {"delivered": 0, "failed": 1})
+        self.assertNotIn("delivered", result["response"]["files"][0])
+        self.assertEqual(len(received), 1)
+
+    async def test_health_responds_while_job_pool_is_saturated(self):
+        rel_zip_path = "data/dir_test/projects/1_4/files/a/b/c/source/queued.zip"
+        self._create_zip_in_md_path(rel_zip_path, {"docs/queued.txt": b"hello"})
+
+        release = threading.Event()
+        blockers = [
+            asyncio.ensure_future(self.api.run_in_worker(release.wait, 5))
+            for _ in range(self.api.JOB_WORKERS)
+        ]
+        real_detect = self.api.detect_archive_format
+        with mock.patch.object(self.api, "detect_archive_format", side_effect=real_detect) as detect:
+            queued = asyncio.ensure_future(self._call_process(self._build_message(rel_zip_path)))
+            await asyncio.sleep(0.05)
+        try:
+            self.assertFalse(queued.done())
+            # The archive header is sniffed without waiting for a job worker.
+            detect.assert_called_once()
+            health = await asyncio.wait_for(self.api.health(), timeout=1)
+            self.assertEqual(health["status"], "ok")
+            list_message = self._build_message(rel_zip_path)
+            list_message["task"]["id"] = "list"
+            listing = await asyncio.wait_for(self._call_process(list_message), timeout=1)
+            self.assertEqual(len(listing["response"]["entries"]), 1)
+            preview = await asyncio.wait_for(self.api.stream_zip_entry(rel_zip_path, "docs/queued.txt", None), timeout=1)
+            self.assertEqual(await self._read_streaming_response(preview), b"hello")
+        finally:
+            release.set()
+            await asyncio.gather(*blockers)
+
+        result = await asyncio.wait_for(queued, timeout=5)
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(result["total_files"], 1)
+
+    async def test_duplicates_coalesce_while_job_pool_is_saturated(self):
+        rel_zip_path = "data/dir_test/projects/1_4/files/a/b/c/source/saturated.zip"
+        self._create_zip_in_md_path(rel_zip_path, {"docs/one.txt": b"1"})
+        real_extract = self.api.extract_zip_to_tmp
+        real_estimate = self.api.get_unzip_admission_bytes
+
+        release = threading.Event()
+        blockers = [
+            asyncio.ensure_future(self.api.run_in_worker(release.wait, 5))
+            for _ in range(self.api.JOB_WORKERS)
+        ]
+        with mock.patch.object(self.api, "SINGLE_FLIGHT_TTL_SEC", 0), mock.patch.object(
+            self.api, "extract_zip_to_tmp", side_effect=real_extract
+        ) as extract, mock.patch.object(self.api, "get_unzip_admission_bytes", side_effect=real_estimate) as estimate:
+            try:
+                first = asyncio.ensure_future(self._call_process(self._build_message(rel_zip_path)))
+                await asyncio.sleep(0.05)
+                second = asyncio.ensure_future(self._call_process(self._build_message(rel_zip_path)))
+                await asyncio.sleep(0.05)
+                self.assertFalse(first.done())
+            finally:
+                release.set()
+                await asyncio.gather(*blockers)
+            first, second = await asyncio.wait_for(asyncio.gather(first, second), timeout=5)
+
+        # The duplicate attached to the queued run instead of extracting (or estimating) again.
+        self.assertEqual(extract.call_count, 1)
+        self.assertEqual(estimate.call_count, 1)
+        self.assertEqual(first["response"]["files"], second["response"]["files"])
+
+    async def test_parallel_extraction_keeps_central_directory_order(self):
+        rel_zip_path = "data/dir_test/projects/1_4/files/a/b/c/source/many.zip"
+        abs_zip_path = Path(self.tempdir.name) / rel_zip_path
+        abs_zip_path.parent.mkdir(parents=True, exist_ok=True)
+        names = [f"docs/file_{i:03d}.txt" for i in range(40)]
+        with zipfile.ZipFile(abs_zip_path, "w") as zf:
+            for i, name in enumerate(names):
+                compression = zipfile.ZIP_DEFLATED if i % 2 else zipfile.ZIP_STORED
+                zf.writestr(name, (f"content {i} " * (i * 50 + 1)).encode("utf-8"), compress_type=compression)
+
+        result = await self._call_process(self._build_message(rel_zip_path))
+
+        files = result["response"]["files"]
+        self.assertEqual([item["label"] for item in files], [os.path.basename(name) for name in names])
+        tmp_root = Path(self.tempdir.name) / "data" / "dir_test" / "tmp"
+        for i, item in enumerate(files):
+            expected = (f"content {i} " * (i * 50 + 1)).encode("utf-8")
+            self.assertEqual((tmp_root / item["path"]).read_bytes(), expected)
+
+    async def test_corrupted_entry_returns_400_and_removes_partial_output(self):
+        rel_zip_path = "data/dir_test/projects/1_4/files/a/b/c/source/bad-crc.zip"
+        abs_zip_path = self._create_zip_in_md_path(
+            rel_zip_path,
+            {"docs/good.txt": b"good data", "docs/bad.txt": b"original payload"},
+        )
+        raw = abs_zip_path.read_bytes()
+        abs_zip_path.write_bytes(raw.replace(b"original payload", b"tampered payload"))
+        tmp_root = Path(self.tempdir.name) / "data" / "dir_test" / "tmp"
+        before = set(os.listdir(tmp_root)) if tmp_root.exists() else set()
+
+        with self.assertRaises(HTTPException) as ctx:
+            await self._call_process(self._build_message(rel_zip_path))
+
+        self.assertEqual(ctx.exception.status_code, 400)
+        self.assertEqual(set(os.listdir(tmp_root)), before)
+
+    def test_entry_inflation_stops_at_declared_size(self):
+        abs_zip_path = self._create_zip_in_md_path(
+            "data/dir_test/projects/1_4/files/a/b/c/source/oversized.zip",
+            {"big.txt": b"x" * (4 * 1024 * 1024)},
+        )
+        info = self.api.read_zip_index(str(abs_zip_path))[0]._replace(file_size=10)
+        yielded = 0
+        with open(abs_zip_path, "rb") as fp, self.assertRaises(zipfile.BadZipFile):
+            for chunk in self.api.iter_entry_chunks(fp, info, chunk_size=64 * 1024):
+                yielded += len(chunk)
+        self.assertLessEqual(yielded, 10)
+
+    def test_stored_copy_falls_back_when_zero_copy_is_unavailable(self):
+        abs_zip_path = self._create_zip_in_md_path(
+            "data/dir_test/projects/1_4/files/a/b/c/source/stored.zip",
+            {"scan.jpg": os.urandom(300000)},
+        )
+        with zipfile.ZipFile(abs_zip_path) as zf:
+            info = zf.infolist()[0]
+            expected = zf.read(info)
+
+        saved = dict(self.api._zero_copy_state)
+        try:
+            for state in ({"copy_file_range": False, "sendfile": True}, {"copy_file_range": False, "sendfile": False}):
+                self.api._zero_copy_state.update(state)
+                dest = Path(self.tempdir.name) / "stored_copy.out"
+                with open(abs_zip_path, "rb") as fp:
+                    self.api.copy_stored_entry(fp, info, str(dest), verify_crc=True)
+                self.assertEqual(dest.read_bytes(), expected)
+        finally:
+            self.api._zero_copy_state.update(saved)
+
+    def test_raw_entry_write_falls_back_without_zipfile_internals(self):
+        src = Path(self.tempdir.name) / "raw_source.txt"
+        text = b"raw entry text " * 4000
+        src.write_bytes(text)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        deflated = compressor.compress(text) + compressor.flush()
+
+        for attrs in (self.api.ZIPFILE_RAW_WRITE_ATTRS, ("_no_such_internal",)):
+            buffer = io.BytesIO()
+            with mock.patch.object(self.api, "ZIPFILE_RAW_WRITE_ATTRS", attrs):
+                with zipfile.ZipFile(buffer, "w") as archive:
+                    for name, method, data in (
+                        ("deflated.txt", zipfile.ZIP_DEFLATED, deflated),
+                        ("stored.txt", zipfile.ZIP_STORED, text),
+                    ):
+                        zinfo = zipfile.ZipInfo.from_file(str(src), arcname=name)
+                        zinfo.compress_type = method
+                        zinfo.CRC = zlib.crc32(text)
+                        zinfo.file_size = len(text)
+                        zinfo.compress_size = len(data)
+                        self.api.write_raw_entry(archive, zinfo, io.BytesIO(data))
+            with zipfile.ZipFile(buffer) as zf:
+                self.assertIsNone(zf.testzip())
+                self.assertEqual(zf.getinfo("deflated.txt").compress_type, zipfile.ZIP_DEFLATED)
+                self.assertEqual(zf.read("deflated.txt"), text)
+                self.assertEqual(zf.read("stored.txt"), text)
+
+    async def test_repeated_unzip_uses_cached_central_directory(self):
+        rel_zip_path = "data/dir_test/projects/1_4/files/a/b/c/source/cached.zip"
+        self._create_zip_in_md_path(rel_zip_path, {"docs/a.txt": b"alpha", "docs/b.pdf": b"%PDF-1.4"})
+
+        first = await self._call_process(self._build_message(rel_zip_path))
+        self.assertEqual(first["total_files"], 2)
+
+        message = self._build_message(rel_zip_path)
+        message["task"]["params"] = {"allowed_extensions": "pdf"}
+        with mock.patch.object(self.api.zipfile, "ZipFile", side_effect=AssertionError("central directory parsed")):
+            from_memory = await self._call_process(message)
+            self.api.clear_index_cache()
+            from_disk = await self._call_process(message)
+
+        self.assertEqual([item["label"] for item in from_memory["response"]["files"]], ["b.pdf"])
+        self.assertEqual([item["label"] for item in from_disk["response"]["files"]], ["b.pdf"])
+
+    async def test_index_cache_invalidates_when_archive_changes(self):
+        rel_zip_path = "data/dir_test/projects/1_4/files/a/b/c/source/changing.zip"
+        abs_zip_path = self._create_zip_in_md_path(rel_zip_path, {"one.txt": b"1"})
+        await self._call_process(self._build_message(rel_zip_path))
+
+        self._create_zip_in_md_path(rel_zip_path, {"one.txt": b"1", "two.txt": b"22"})
+        os.utime(abs_zip_path, ns=(1, 1))
+        result = await self._call_process(self._build_message(rel_zip_path))
+
+        self.assertEqual(result["total_files"], 2)
+
+    async def test_dedup_store_hardlinks_repeat_extractions(self):
+        rel_zip_path = "data/dir_dedup/projects/1_4/files/a/source/dedup.zip"
+        self._create_zip_in_md_path(rel_zip_path, {"docs/a.txt": b"same content", "img/b.jpg": b"jpeg-bytes"})
+        tmp_root = Path(self.tempdir.name) / "data" / "dir_dedup" / "tmp"
+
+        with mock.patch.object(self.api, "DEDUP_STORE_ENABLED", True), mock.patch.object(
+            self.api, "SINGLE_FLIGHT_TTL_SEC", 0
+        ):
+            first = await self._call_process(self._build_message(rel_zip_path))
+            second = await self._call_process(self._build_message(rel_zip_path))
+
+            for before, after in zip(first["response"]["files"], second["response"]["files"]):
+                self.assertNotEqual(before["path"], after["path"])
+                self.assertTrue(after.get("deduplicated"))
+                self.assertEqual(before["digest"], after["digest"])
+                self.assertEqual(
+                    os.stat(tmp_root / before["path"]).st_ino,
+                    os.stat(tmp_root / after["path"]).st_ino,
+                )
+
+                self.assertTrue(os.access(tmp_root / after["path"], os.W_OK))
+
+            # Same name and size in another archive is not a hit; the same bytes share the blob.
+            other_zip_path = "data/dir_dedup/projects/1_4/files/a/source/other.zip"
+            self._create_zip_in_md_path(other_zip_path, {"docs/a.txt": b"SAME CONTENT", "img/b.jpg": b"jpeg-bytes"})
+            third = await self._call_process(self._build_message(other_zip_path))
+            files = {item["label"]: item for item in third["response"]["files"]}
+            self.assertEqual((tmp_root / files["a.txt"]["path"]).read_bytes(), b"SAME CONTENT")
+            self.assertNotIn("deduplicated", files["a.txt"])
+            self.assertTrue(files["b.jpg"]["deduplicated"])
+
+            # Blobs still linked from tmp survive pruning; unreferenced ones go.
+            self.assertEqual(self.api.prune_blob_store("dir_dedup", max_bytes=0), 0)
+            for item in first["response"]["files"] + second["response"]["files"] + third["response"]["files"]:
+                (tmp_root / item["path"]).unlink()
+            self.assertEqual(self.api.prune_blob_store("dir_dedup", max_bytes=0), 3)
+
+    def test_link_or_copy_falls_back_to_copy(self):
+        src = Path(self.tempdir.name) / "link_src.bin"
+        dest = Path(self.tempdir.name) / "link_dest.bin"
+        src.write_bytes(b"payload")
+        with mock.patch.object(self.api.os, "link", side_effect=OSError(errno.EXDEV, "cross-device")):
+            self.assertFalse(self.api.link_or_copy(str(src), str(dest)))
+        self.assertEqual(dest.read_bytes(), b"payload")
+
+    def test_partition_by_size_balances_buckets(self):
+        buckets = self.api.partition_by_size([100, 1, 1, 50, 50], 2)
+        self.assertEqual(sorted(sum(buckets, [])), [0, 1, 2, 3, 4])
+        loads = sorted(sum([100, 1, 1, 50, 50][i] for i in bucket) for bucket in buckets)
+        self.assertEqual(loads, [101, 101])
+
 
 if __name__ == "__main__":
     unittest.main()